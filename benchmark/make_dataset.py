@@ -0,0 +1,181 @@
+#This makes a synthetic ESPRESSO dataset: raw frames of every DPR TYPE that the pipeline needs, with
+#headers like those of the ESO archive, and the static calibration files, so that espresso_pipeline.py
+#can be run (together with the stand-in esorex in this folder) without downloading any data. The frames
+#only hold a small image, as the pipeline itself never reads the data.
+#
+#Usage: python3 make_dataset.py folder [--exposures 20] [--copies 5] [--binning 2x1] [--fiber sky]
+#                                      [--size 64] [--compress gz]
+
+
+#The raw calibration frames of one night, with how many of each the archive usually gives (for --copies 1).
+#The CONTAM frame is the only one of which the pipeline takes exactly one.
+CALIBRATIONS = {'BIAS':5,'DARK':3,'LED':5,'ORDERDEF,LAMP,OFF':1,'ORDERDEF,OFF,LAMP':1,'FLAT,LAMP,OFF':5,'FLAT,OFF,LAMP':5,
+    'WAVE,FP,FP':1,'WAVE,FP,THAR':1,'WAVE,THAR,FP':1,'CONTAM,OFF,FP':1,'EFF,SKY,SKY':1,'FLUX,STD,SKY':1}
+
+#The static calibration files (by PRO CATG) that come with a dataset. There is one MASK_TABLE per CCF mask.
+STATICS = ['CCD_GEOM','INST_CONFIG','LED_FF_GAIN_WINDOWS','STATIC_WAVE_MATRIX_A','STATIC_WAVE_MATRIX_B','REF_LINE_TABLE_A',
+    'REF_LINE_TABLE_B','STATIC_DLL_MATRIX_A','STATIC_DLL_MATRIX_B','STD_TABLE','EXT_TABLE','MASK_LUT','FLUX_TEMPLATE',
+    'MASK_TABLE','MASK_TABLE']
+
+
+def header_card(keyword,value=None):
+    """This formats a single 80-character header card. Keywords longer than 8 characters or with spaces
+    are written as HIERARCH keywords."""
+    if isinstance(value,bool):
+        value = 'T' if value else 'F'
+    elif isinstance(value,str):
+        value = "'"+value.replace("'","''").ljust(8)+"'"
+    elif value != None:
+        if hasattr(value,'item'):#A numpy number.
+            value = value.item()
+        value = repr(value)
+    if len(keyword) > 8 or ' ' in keyword:
+        card = f'HIERARCH {keyword} = {value}'
+    elif value == None:
+        card = keyword
+    else:
+        card = f'{keyword:<8}= {value:>20}'
+    return(card[:80].ljust(80))
+
+
+def header_block(cards):
+    """This turns a list of (keyword,value) pairs into a header, including the END card, padded to a
+    whole number of 2880-byte blocks."""
+    text = ''.join([header_card(keyword,value) for keyword,value in cards])+'END'.ljust(80)
+    return((text+' '*(-len(text)%2880)).encode('ascii'))
+
+
+def image_hdu(data,cards=[],name=None,primary=False):
+    """This returns the bytes of an image HDU with data (a numpy array, or None for an empty primary
+    HDU) and the extra header cards."""
+    import numpy as np
+    bitpix = {'u1':8,'i2':16,'i4':32,'i8':64,'f4':-32,'f8':-64}
+    if data is None:
+        data = np.zeros((0,),dtype='u1')
+    data = np.asarray(data)
+    data = data.astype(data.dtype.newbyteorder('>'))
+    shape = [] if data.size == 0 else list(data.shape)
+    if primary:
+        first = [('SIMPLE',True)]
+    else:
+        first = [('XTENSION','IMAGE')]
+    first += [('BITPIX',bitpix[data.dtype.str[1:]]),('NAXIS',len(shape))]+[(f'NAXIS{i+1}',n) for i,n in enumerate(shape[::-1])]
+    if primary:
+        first.append(('EXTEND',True))
+    else:
+        first += [('PCOUNT',0),('GCOUNT',1)]
+    if name != None:
+        first.append(('EXTNAME',name))
+    body = data.tobytes()
+    return(header_block(first+list(cards))+body+b'\0'*(-len(body)%2880))
+
+
+def table_hdu(columns,name=None):
+    """This returns the bytes of a binary table HDU with columns, a dictionary of equally long numpy
+    arrays of floats (written as D) or integers (written as J)."""
+    import numpy as np
+    formats = {key:('D','>f8') if np.asarray(value).dtype.kind == 'f' else ('J','>i4') for key,value in columns.items()}
+    rows = np.zeros(len(next(iter(columns.values()))),dtype=[(key,formats[key][1]) for key in columns])
+    for key,value in columns.items():
+        rows[key] = value
+    cards = [('XTENSION','BINTABLE'),('BITPIX',8),('NAXIS',2),('NAXIS1',rows.dtype.itemsize),('NAXIS2',len(rows)),
+        ('PCOUNT',0),('GCOUNT',1),('TFIELDS',len(columns))]
+    for i,key in enumerate(columns):
+        cards += [(f'TTYPE{i+1}',key),(f'TFORM{i+1}',formats[key][0])]
+    if name != None:
+        cards.append(('EXTNAME',name))
+    body = rows.tobytes()
+    return(header_block(cards)+body+b'\0'*(-len(body)%2880))
+
+
+def write_fits(filename,hdus):
+    """This writes a fits file made of hdus (the bytes returned by image_hdu and table_hdu), by way of a
+    temporary file, so that a file that is being watched never appears half-written."""
+    import os
+    with open(str(filename)+'.tmp','wb') as f:
+        for hdu in hdus:
+            f.write(hdu)
+    os.replace(str(filename)+'.tmp',filename)
+
+
+def compress_file(filename,method):
+    """This compresses filename to filename.gz (method gz) or filename.Z (method Z, with the compress
+    program), as the ESO archive does, and removes the original."""
+    import gzip
+    import os
+    import shutil
+    import subprocess
+    if method == 'gz':
+        with open(filename,'rb') as f_in, gzip.open(str(filename)+'.gz','wb') as f_out:
+            shutil.copyfileobj(f_in,f_out)
+        os.remove(filename)
+    elif method == 'Z':
+        subprocess.run(['compress','-f',str(filename)],check=True)
+
+
+def raw_frame(folder,mjd,dpr_type,binx,biny,size,target='WASP-76',programme='1102.C-0744(C)',compress=None):
+    """This writes a raw frame of type dpr_type, taken at mjd, into folder, and returns its path. The
+    file is named after its DATE-OBS, as the ESO archive does."""
+    import datetime
+    import numpy as np
+    from pathlib import Path
+    date = (datetime.datetime(1858,11,17)+datetime.timedelta(days=mjd)).isoformat(timespec='milliseconds')
+    science = dpr_type.startswith('OBJECT')
+    cards = [('DATE-OBS',date),('MJD-OBS',mjd),('EXPTIME',600.0 if science else 10.0),('OBJECT',target if science else dpr_type),
+        ('ESO DPR CATG','SCIENCE' if science else 'CALIB'),('ESO DPR TYPE',dpr_type),('ESO DET BINX',binx),('ESO DET BINY',biny),
+        ('ESO INS MODE','SINGLEHR'),('ESO OBS PROG ID',programme if science else '60.A-9036(A)'),
+        ('ESO TEL3 AIRM START',1.2+0.2*np.sin(mjd*100)),('ESO TEL3 AIRM END',1.2+0.2*np.sin(mjd*100+0.1))]
+    data = np.random.default_rng(int(mjd*1e5)).integers(0,1000,(size,size)).astype('i2')
+    filename = Path(folder)/f'ESPRE.{date[:23]}.fits'
+    write_fits(filename,[image_hdu(data,cards,primary=True)])
+    if compress != None:
+        compress_file(filename,compress)
+        filename = Path(str(filename)+'.'+compress)
+    return(filename)
+
+
+def static_file(folder,pro_catg,number=0):
+    """This writes a static calibration file with the given PRO CATG into folder, and returns its path."""
+    from pathlib import Path
+    filename = Path(folder)/f'M.ESPRESSO.2019-01-01T00:00:00.{number:03d}.fits'
+    cards = [('ESO PRO CATG',pro_catg),('ESO INS MODE','SINGLEHR'),('DATE','2019-01-01T00:00:00')]
+    write_fits(filename,[image_hdu(None,cards,primary=True)])
+    return(filename)
+
+
+def make_dataset(folder,exposures=20,copies=1,binning='2x1',fiber='sky',size=64,compress=None,start=59000.0):
+    """This writes a synthetic dataset into folder: copies times the usual number of calibration frames
+    of each type (see CALIBRATIONS), taken in the afternoon before the night starting at mjd start, the
+    static calibration files, and the given number of science exposures of 10 minutes each during the
+    night. Returns the list of files that were written."""
+    import os
+    os.makedirs(folder,exist_ok=True)
+    binx,biny = [int(i) for i in binning.split('x')]
+    files = []
+    mjd = start-0.2
+    for dpr_type,n in CALIBRATIONS.items():
+        for i in range(1 if dpr_type == 'CONTAM,OFF,FP' else n*copies):
+            files.append(raw_frame(folder,mjd,dpr_type,binx,biny,size,compress=compress))
+            mjd += 60/86400
+    science = 'OBJECT,SKY' if fiber.lower() == 'sky' else 'OBJECT,FP'
+    for i in range(exposures):
+        files.append(raw_frame(folder,start+0.05+i*660/86400,science,binx,biny,size,compress=compress))
+    for i,pro_catg in enumerate(STATICS):
+        files.append(static_file(folder,pro_catg,i))
+    return(files)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Make a synthetic ESPRESSO dataset for testing and benchmarking espresso_pipeline.py.')
+    parser.add_argument('folder',type=str,help='The folder in which the frames are written.')
+    parser.add_argument('--exposures',type=int,default=20,help='Number of science exposures.')
+    parser.add_argument('--copies',type=int,default=1,help='Multiplies the number of calibration frames of each type.')
+    parser.add_argument('--binning',type=str,default='2x1',choices=['1x1','2x1','4x2'],help='The detector binning.')
+    parser.add_argument('--fiber',type=str,default='sky',choices=['sky','FP'],help='What fiber B was pointed at during the science exposures.')
+    parser.add_argument('--size',type=int,default=64,help='The frames hold an image of size x size pixels.')
+    parser.add_argument('--compress',type=str,default=None,choices=['gz','Z'],help='Compress the raw frames, as the ESO archive does.')
+    args = parser.parse_args()
+    files = make_dataset(args.folder,exposures=args.exposures,copies=args.copies,binning=args.binning,fiber=args.fiber,
+        size=args.size,compress=args.compress)
+    print(f'---Wrote {len(files)} files to {args.folder}')
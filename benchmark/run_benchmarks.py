@@ -0,0 +1,268 @@
+#This times espresso_pipeline.py on synthetic datasets (see make_dataset.py), with the stand-in esorex
+#in this folder instead of the DRS, so that the time spent by the script itself can be measured and
+#compared between versions. There are three groups of benchmarks:
+#
+#driver    The steps of the script that do not involve esorex, for datasets with more and more
+#          calibration frames: reading the headers (without and with the header index), create_sof
+#          (which also writes the sof files), check_files_exist and moving products with move_to.
+#cascade   Complete runs (calibrations and science) with recipes that take no time, for more and more
+#          science exposures. The overhead is the wall time minus the time spent in esorex.
+#parallel  The speed-up of the science exposures with --nproc, and of the calibrations with --ncal, with
+#          recipes that take a fixed time.
+#transfer  Moving products from a scratch folder on another filesystem (tmpfs, /dev/shm) to the output
+#          folder with transfer_file, which streams and checksums the copy, and a complete run with
+#          --scratch there. These stop with an error if a copy does not arrive intact.
+#
+#Usage: python3 run_benchmarks.py [--quick] [--only driver,cascade,parallel,transfer] [--folder /tmp/espresso_benchmark]
+#                                 [--output benchmark_results.json]
+#
+#The results are printed and written to a json file, together with the version of the script (its git
+#commit, if it is in a git repository), so that the results of different versions can be compared.
+import os
+import sys
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from make_dataset import make_dataset
+
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PIPELINE = os.path.join(os.path.dirname(BENCHMARK_FOLDER),'espresso_pipeline.py')
+
+#The sizes of the benchmarks: the multiples of the usual number of calibration frames (driver), the
+#numbers of science exposures (cascade), and the numbers of parallel exposures and recipes (parallel).
+SIZES = {'copies':[1,5,20],'exposures':[10,50,150],'nproc':[1,2,4,8],'ncal':[1,2,4],'megabytes':[1,64,512]}
+QUICK_SIZES = {'copies':[1,5],'exposures':[5,20],'nproc':[1,4],'ncal':[1,4],'megabytes':[1,64]}
+
+#A folder on another filesystem than the benchmark folder, for the transfer benchmarks.
+TMPFS = '/dev/shm'
+
+
+
+def load_pipeline():
+    """This returns the functions and tables of espresso_pipeline.py as a dictionary. The script parses
+    its command line as soon as it is run, so only the part before that is executed."""
+    source = open(PIPELINE).read()
+    namespace = {'__name__':'espresso_pipeline'}
+    exec(compile(source[:source.index('\nimport argparse')],PIPELINE,'exec'),namespace)
+    return(namespace)
+
+
+def timed(function,*args,**kwargs):
+    """This calls function and returns the time it took, in seconds. Its output is not printed."""
+    import contextlib
+    import io
+    import time
+    output = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            function(*args,**kwargs)
+    except SystemExit:#The script exits after printing an ERROR.
+        print(output.getvalue()[-3000:])
+        raise RuntimeError(f'{function.__name__} stopped the script.')
+    return(time.perf_counter()-start)
+
+
+def run_pipeline(inpath,outpath,options=[],environment={},scired_only=False):
+    """This runs espresso_pipeline.py on inpath with the stand-in esorex, from a scratch folder next to
+    outpath, and returns its wall time and the time spent in esorex (summed over all recipes), in seconds.
+    The output folder is emptied first, unless only the science frames are reduced (scired_only), which
+    needs the calibrations of an earlier run."""
+    import json
+    import shutil
+    import subprocess
+    import time
+    if not scired_only:
+        shutil.rmtree(outpath,ignore_errors=True)
+    else:
+        os.remove(os.path.join(outpath,'profile_report.json'))
+    workdir = str(outpath)+'_work'
+    shutil.rmtree(workdir,ignore_errors=True)
+    os.makedirs(workdir)
+    env = dict(os.environ)
+    env['PATH'] = BENCHMARK_FOLDER+os.pathsep+env['PATH']
+    env.update(environment)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable,PIPELINE,str(inpath),str(outpath),'2x1','sky','1' if scired_only else '0']+options,cwd=workdir,env=env,
+        capture_output=True,text=True)
+    wall = time.perf_counter()-start
+    if result.returncode != 0 or not os.path.isfile(os.path.join(outpath,'profile_report.json')):
+        print(result.stdout[-3000:]+result.stderr[-3000:])
+        raise RuntimeError(f'espresso_pipeline.py failed on {inpath}.')
+    with open(os.path.join(outpath,'profile_report.json')) as f:
+        esorex = sum([record['wall'] for record in json.load(f)['records']])
+    shutil.rmtree(workdir,ignore_errors=True)
+    return(wall,esorex)
+
+
+def driver_benchmarks(folder,sizes):
+    """This times the steps of the script that do not involve esorex (see the top of this file)."""
+    import glob
+    import shutil
+    from pathlib import Path
+    pipeline = load_pipeline()
+    results = []
+    for copies in sizes['copies']:
+        inpath = Path(folder)/f'driver_{copies}'
+        outpath = Path(folder)/f'driver_{copies}_out'
+        shutil.rmtree(inpath,ignore_errors=True)
+        shutil.rmtree(outpath,ignore_errors=True)
+        files = make_dataset(inpath,exposures=20,copies=copies)
+        os.makedirs(outpath)
+        result = {'benchmark':'driver','files':len(files)}
+        result['headers_cold'] = timed(pipeline['index_headers'],files,outpath/'index.sqlite')
+        result['headers_warm'] = timed(pipeline['index_headers'],files,outpath/'index.sqlite')
+        result['create_sof_cold'] = timed(pipeline['create_sof'],inpath,outpath,'2x1')
+        result['create_sof_warm'] = timed(pipeline['create_sof'],inpath,outpath,'2x1')
+        sof_files = sorted(glob.glob(str(outpath/'*.txt')))
+        for path,tag in [line for i in sof_files for line in pipeline['read_sof'](i)]:
+            if not os.path.exists(path):#The products of the recipes, as they would be at the time their sof files are used.
+                shutil.copy(files[-1],path)
+        result['check_files_exist'] = timed(lambda: [pipeline['check_files_exist'](Path(i)) for i in sof_files])
+        workdir = outpath/'scratch'
+        os.makedirs(workdir)
+        for i in range(len(files)):
+            shutil.copy(files[0],workdir/f'product_{i}.fits')
+        result['move_to'] = timed(lambda: [pipeline['move_to'](f'product_{i}.fits',outpath,workdir=workdir) for i in range(len(files))])
+        results.append(result)
+        shutil.rmtree(inpath)
+        shutil.rmtree(outpath)
+    return(results)
+
+
+def cascade_benchmarks(folder,sizes):
+    """This times complete runs with recipes that take no time, for more and more science exposures."""
+    import shutil
+    from pathlib import Path
+    results = []
+    for exposures in sizes['exposures']:
+        inpath = Path(folder)/f'cascade_{exposures}'
+        shutil.rmtree(inpath,ignore_errors=True)
+        make_dataset(inpath,exposures=exposures)
+        wall,esorex = run_pipeline(inpath,Path(folder)/f'cascade_{exposures}_out',environment={'MOCK_ESOREX_PIXELS':'64'})
+        results.append({'benchmark':'cascade','exposures':exposures,'wall':wall,'esorex':esorex,'overhead':wall-esorex,
+            'overhead_per_exposure':(wall-esorex)/exposures})
+        shutil.rmtree(inpath)
+        shutil.rmtree(Path(folder)/f'cascade_{exposures}_out')
+    return(results)
+
+
+def parallel_benchmarks(folder,sizes):
+    """This measures the speed-up of --nproc (science exposures that take 1 s each, reduced against the
+    calibrations of a first run) and of --ncal (calibration recipes that take 0.5 s each), relative to
+    running them one at a time."""
+    import shutil
+    from pathlib import Path
+    inpath = Path(folder)/'parallel'
+    outpath = Path(folder)/'parallel_out'
+    shutil.rmtree(inpath,ignore_errors=True)
+    make_dataset(inpath,exposures=max(sizes['nproc'])*2)
+    results = []
+    run_pipeline(inpath,outpath,environment={'MOCK_ESOREX_PIXELS':'64'})
+    for nproc in sizes['nproc']:
+        wall,esorex = run_pipeline(inpath,outpath,options=['--nproc',str(nproc),'--mem_budget','1000'],
+            environment={'MOCK_ESOREX_SLEEP':'espdr_sci_red=1,0','MOCK_ESOREX_PIXELS':'64'},scired_only=True)
+        results.append({'benchmark':'parallel','option':'nproc','value':nproc,'wall':wall})
+    for ncal in sizes['ncal']:
+        wall,esorex = run_pipeline(inpath,outpath,options=['--ncal',str(ncal),'--mem_budget','1000'],
+            environment={'MOCK_ESOREX_SLEEP':'espdr_sci_red=0,0.5','MOCK_ESOREX_PIXELS':'64'})
+        results.append({'benchmark':'parallel','option':'ncal','value':ncal,'wall':wall})
+    for result in results:
+        first = [i for i in results if i['option'] == result['option']][0]
+        result['speedup'] = first['wall']/result['wall']
+    shutil.rmtree(inpath)
+    shutil.rmtree(outpath,ignore_errors=True)
+    return(results)
+
+
+def transfer_benchmarks(folder,sizes):
+    """This times transfer_file for files of the given sizes (in MB) that are moved from TMPFS to folder,
+    checking that each arrives complete (with the checksum of the original) and that the original is
+    removed, and then runs the whole pipeline with its scratch folders in TMPFS. Nothing is done if
+    TMPFS is not on another filesystem than folder."""
+    import shutil
+    import tempfile
+    from pathlib import Path
+    os.makedirs(folder,exist_ok=True)
+    if not os.path.isdir(TMPFS) or os.stat(TMPFS).st_dev == os.stat(folder).st_dev:
+        print(f'WARNING: {TMPFS} is not on another filesystem than {folder}. Skipping the transfer benchmarks.')
+        return([])
+    pipeline = load_pipeline()
+    scratch = Path(tempfile.mkdtemp(prefix='espresso_benchmark_',dir=TMPFS))
+    outpath = Path(folder)/'transfer_out'
+    shutil.rmtree(outpath,ignore_errors=True)
+    os.makedirs(outpath)
+    results = []
+    try:
+        for megabytes in sizes['megabytes']:
+            source = scratch/f'product_{megabytes}.fits'
+            with open(source,'wb') as f:
+                for i in range(megabytes):
+                    f.write(os.urandom(1024**2))
+            checksum = pipeline['file_checksum'](source)
+            wall = timed(pipeline['transfer_file'],source,outpath/source.name)
+            if os.path.exists(source) or pipeline['file_checksum'](outpath/source.name) != checksum:
+                raise RuntimeError(f'transfer_file did not move {source} to {outpath} intact.')
+            results.append({'benchmark':'transfer','megabytes':megabytes,'wall':wall,'speed':megabytes/wall})
+        inpath = Path(folder)/'transfer'
+        shutil.rmtree(inpath,ignore_errors=True)
+        make_dataset(inpath,exposures=3)
+        wall,esorex = run_pipeline(inpath,outpath/'run',options=['--scratch',str(scratch)],environment={'MOCK_ESOREX_PIXELS':'64'})
+        products = [i for i in os.listdir(outpath/'run'/'SCIENCE_PRODUCTS') if i.endswith('.fits')]
+        if len(products) == 0:
+            raise RuntimeError(f'The run with --scratch {scratch} made no science products.')
+        results.append({'benchmark':'transfer','megabytes':'run','wall':wall,'speed':'-'})
+        shutil.rmtree(inpath)
+    finally:
+        shutil.rmtree(scratch,ignore_errors=True)
+        shutil.rmtree(outpath,ignore_errors=True)
+    return(results)
+
+
+BENCHMARKS = {'driver':driver_benchmarks,'cascade':cascade_benchmarks,'parallel':parallel_benchmarks,
+    'transfer':transfer_benchmarks}
+
+
+def script_version():
+    """This returns the git commit of espresso_pipeline.py, or None if it is not in a git repository."""
+    import subprocess
+    try:
+        return(subprocess.run(['git','rev-parse','--short','HEAD'],cwd=os.path.dirname(PIPELINE),capture_output=True,
+            text=True).stdout.strip() or None)
+    except OSError:
+        return(None)
+
+
+def print_results(results):
+    """This prints the results of each benchmark as a table."""
+    for name in BENCHMARKS:
+        rows = [i for i in results if i['benchmark'] == name]
+        if len(rows) == 0:
+            continue
+        columns = [i for i in rows[0] if i != 'benchmark']
+        print(f'==========>>>>> {name.upper()} <<<<<==========')
+        print('  '.join([f'{i:>16}' for i in columns]))
+        for row in rows:
+            print('  '.join([f'{row[i]:>16.3f}' if isinstance(row[i],float) else f'{row[i]:>16}' for i in columns]))
+
+
+if __name__ == '__main__':
+    import argparse
+    import datetime
+    import json
+    import tempfile
+    parser = argparse.ArgumentParser(description='Time espresso_pipeline.py on synthetic data, with a stand-in for esorex.')
+    parser.add_argument('--quick',action='store_true',help='Use smaller datasets, e.g. to check that the benchmarks run.')
+    parser.add_argument('--only',type=str,default=','.join(BENCHMARKS),help='Comma-separated benchmarks to run (driver, cascade, parallel, transfer).')
+    parser.add_argument('--folder',type=str,default=os.path.join(tempfile.gettempdir(),'espresso_benchmark'),help='Folder in which the datasets are made.')
+    parser.add_argument('--output',type=str,default='benchmark_results.json',help='File to which the results are written.')
+    args = parser.parse_args()
+    sizes = QUICK_SIZES if args.quick else SIZES
+    results = []
+    for name in args.only.split(','):
+        print(f'---Running the {name} benchmarks')
+        results += BENCHMARKS[name.strip()](args.folder,sizes)
+    print_results(results)
+    with open(args.output,'w') as f:
+        json.dump({'version':script_version(),'date':datetime.datetime.now().isoformat(timespec='seconds'),'quick':args.quick,
+            'results':results},f,indent=1)
+    print(f'---Wrote {args.output}')
@@ -132,7 +132,438 @@
 #==============================================================================================#
 
 
-def create_sof(inpath,outpath,binning,sky=True):
+import threading
+
+
+#The header keywords that are needed to sort the raw frames and static calibration files, and the
+#names of the columns in which they are stored in the header index (see index_headers).
+HEADER_COLUMNS = {'dpr_type':'ESO DPR TYPE','exptime':'EXPTIME','binx':'ESO DET BINX','biny':'ESO DET BINY',
+    'mjd_obs':'MJD-OBS','pro_catg':'ESO PRO CATG','object':'OBJECT','prog_id':'ESO OBS PROG ID','ins_mode':'ESO INS MODE'}
+
+
+def parse_card(card):
+    """This parses a single 80-character header card into its keyword and value. HIERARCH keywords are
+    returned without the HIERARCH prefix (e.g. 'ESO DPR TYPE'), strings are stripped of their quotes,
+    and numbers and logicals are converted. Cards without a value (e.g. COMMENT) return None."""
+    if card.startswith('HIERARCH '):
+        keyword,equals,rest = card[9:].partition('=')
+        if equals == '':
+            return(keyword.strip(),None)
+    elif card[8:10] == '= ':
+        keyword,rest = card[0:8],card[10:]
+    else:
+        return(card[0:8].strip(),None)
+    keyword = keyword.strip()
+    rest = rest.strip()
+    if rest.startswith("'"):#A string, in which a quote is written as two quotes.
+        value = ''
+        i = 1
+        while i < len(rest):
+            if rest[i] == "'":
+                if rest[i+1:i+2] == "'":
+                    value += "'"
+                    i += 2
+                    continue
+                break
+            value += rest[i]
+            i += 1
+        return(keyword,value.rstrip())
+    rest = rest.split('/')[0].strip()
+    if rest == 'T':
+        return(keyword,True)
+    if rest == 'F':
+        return(keyword,False)
+    try:
+        return(keyword,int(rest))
+    except ValueError:
+        pass
+    try:
+        return(keyword,float(rest.replace('D','E')))
+    except ValueError:
+        return(keyword,rest)
+
+
+#The extensions of compressed fits files that are read as they are: unix compress (.Z), gzip (.gz)
+#and fpack (.fz). Their headers are read from the compressed file (see fits_blocks), and they are only
+#decompressed just before a recipe needs them (see decompress_inputs).
+COMPRESSED_SUFFIXES = ['.Z','.gz','.fz']
+
+
+def fits_files(folder,prefix,recursive=False):
+    """This returns the fits files in folder (and its subfolders, if recursive) whose names start with
+    prefix (e.g. ESPRE), whether they are compressed (see COMPRESSED_SUFFIXES) or not. If a frame is
+    there both compressed and decompressed, only the decompressed file is returned."""
+    from pathlib import Path
+    found = dict()
+    for suffix in ['']+COMPRESSED_SUFFIXES:
+        pattern = prefix+'*.fits'+suffix
+        for path in (Path(folder).rglob(pattern) if recursive else Path(folder).glob(pattern)):
+            found.setdefault(str(path)[0:len(str(path))-len(suffix)],str(path))
+    return(list(found.values()))
+
+
+def frame_name(path):
+    """This returns the name of a fits file without its folder, .fits and compression extension, e.g.
+    ESPRE.2019-01-01T00:00:00.000 for /data/ESPRE.2019-01-01T00:00:00.000.fits.Z."""
+    import os
+    name = os.path.basename(str(path))
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith('.fits'+suffix):
+            name = name[0:len(name)-len(suffix)]
+    return(os.path.splitext(name)[0])
+
+
+def lzw_decompress(f,chunk_size=2**16):
+    """This yields the contents of the file object f, which is compressed by unix compress (a .Z file),
+    piece by piece, so that the header of a fits file can be read without decompressing all of it.
+    This follows the decoder of ncompress: the codes are 9 up to maxbits bits wide and are stored in
+    groups of 8 (counted from where the codes last changed width), and the rest of a group is skipped
+    whenever the codes get wider or the table is cleared (code 256, in block mode). Each code stands
+    for a string of bytes, which is kept in table."""
+    header = f.read(3)
+    if len(header) < 3 or header[0:2] != b'\x1f\x9d':
+        raise ValueError('This is not a file made by unix compress.')
+    maxbits = header[2] & 0x1f
+    block_mode = header[2] & 0x80
+    if maxbits > 16:
+        raise ValueError(f'Codes of {maxbits} bits are not supported.')
+    table = [bytes([i]) for i in range(256)]+([b''] if block_mode else [])
+    n_bits = 9
+    maxcode = 2**n_bits-1
+    data = b''#The compressed bytes that have not been used yet, starting at bit base.
+    base = 0
+    position = 0
+    start = 0#Where the codes got their current width.
+    previous = None
+    output = bytearray()
+    end = False
+    while True:
+        if len(table) > maxcode and n_bits < maxbits:#The codes get one bit wider, starting at the next group.
+            position = start-(-(position-start)//(n_bits*8))*(n_bits*8)
+            start = position
+            n_bits += 1
+            maxcode = 2**n_bits-1 if n_bits < maxbits else 2**maxbits
+        while not end and base+len(data)*8 < position+n_bits:
+            new = f.read(chunk_size)
+            end = len(new) == 0
+            used = (position-base)//8
+            data = data[used:]+new
+            base += used*8
+        if base+len(data)*8 < position+n_bits:
+            break
+        offset = position-base
+        code = (int.from_bytes(data[offset//8:offset//8+3],'little') >> (offset%8)) & (2**n_bits-1)
+        position += n_bits
+        if previous == None:
+            previous = code
+            output += table[code]
+            continue
+        if code == 256 and block_mode:#Clear the table, and start again with 9-bit codes at the next group.
+            position = start-(-(position-start)//(n_bits*8))*(n_bits*8)
+            start = position
+            n_bits = 9
+            maxcode = 2**n_bits-1
+            del table[257:]
+            previous = None
+            continue
+        if code < len(table):
+            entry = table[code]
+        elif code == len(table):
+            entry = table[previous]+table[previous][0:1]
+        else:
+            raise ValueError(f'The compressed data are corrupt (code {code}).')
+        output += entry
+        if len(table) < 2**maxbits:
+            table.append(table[previous]+entry[0:1])
+        previous = code
+        if len(output) >= chunk_size:
+            yield(bytes(output))
+            output = bytearray()
+    if len(output) > 0:
+        yield(bytes(output))
+
+
+def fits_blocks(filename):
+    """This yields the 2880-byte blocks of a fits file one by one. Files compressed with gzip (.gz) or
+    unix compress (.Z, see lzw_decompress) are decompressed as they are read, so reading only the
+    header is still quick. fpack (.fz) leaves the primary header as it is, so these are read as they are."""
+    import gzip
+    filename = str(filename)
+    f = gzip.open(filename,'rb') if filename.endswith('.gz') else open(filename,'rb')
+    try:
+        chunks = lzw_decompress(f) if filename.endswith('.Z') else iter(lambda: f.read(2880*16),b'')
+        buffer = b''
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= 2880:
+                yield(buffer[0:2880])
+                buffer = buffer[2880:]
+    finally:
+        f.close()
+
+
+def read_header(filename,keywords):
+    """This reads the values of keywords (without HIERARCH prefix) from the primary header of a fits
+    file, which may be compressed (see fits_blocks). Only the 2880-byte header blocks are read, up to
+    the END card, so the (much larger) data are never touched. Keywords that are not in the header are
+    returned as None."""
+    keywords = set(keywords)
+    values = dict.fromkeys(keywords)
+    for block in fits_blocks(filename):
+        block = block.decode('ascii',errors='replace')
+        for i in range(0,2880,80):
+            card = block[i:i+80]
+            if card.startswith('END') and card[3:].strip() == '':
+                return(values)
+            keyword,value = parse_card(card)
+            if keyword in keywords:
+                values[keyword] = value
+    raise ValueError(f'{filename} ends before the END of its primary header.')
+
+
+def index_headers(filenames,index_file,columns=HEADER_COLUMNS,prune=True):
+    """This returns the header keywords listed in columns for each of the fits files in filenames, as
+    a dictionary of rows (dictionaries) keyed by filename. The values are kept in an SQLite database
+    (index_file), keyed by the path, size and modification time of each file, so that only the headers
+    of new or changed files are read, and these are read in parallel. Files that are not in filenames
+    are removed from the index, unless prune is False (e.g. when looking up a few of the files)."""
+    import os
+    import sqlite3
+    from concurrent.futures import ThreadPoolExecutor
+
+    filenames = [str(i) for i in filenames]
+    db = sqlite3.connect(index_file)
+    existing = [row[1] for row in db.execute('PRAGMA table_info(headers)')]
+    if existing != ['path','size','mtime_ns']+list(columns):#The index was made for other keywords.
+        db.execute('DROP TABLE IF EXISTS headers')
+        db.execute('CREATE TABLE headers (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '+
+            ', '.join(columns)+')')
+        for column in columns:
+            db.execute(f'CREATE INDEX headers_{column} ON headers ({column})')
+    indexed = dict()
+    for row in db.execute('SELECT path, size, mtime_ns FROM headers'):
+        indexed[row[0]] = (row[1],row[2])
+
+    stats = dict()
+    for filename in filenames:
+        stat = os.stat(filename)
+        stats[filename] = (stat.st_size,stat.st_mtime_ns)
+    stale = [filename for filename in filenames if indexed.get(filename) != stats[filename]]
+    if len(stale) > 0:
+        print(f'---Reading the headers of {len(stale)} new or changed files.')
+        with ThreadPoolExecutor() as pool:
+            headers = list(pool.map(lambda f: read_header(f,columns.values()),stale))
+        db.executemany(f'INSERT OR REPLACE INTO headers VALUES ({",".join(["?"]*(len(columns)+3))})',
+            [[f,stats[f][0],stats[f][1]]+[h[k] for k in columns.values()] for f,h in zip(stale,headers)])
+    gone = set(indexed.keys())-set(filenames) if prune else set()
+    db.executemany('DELETE FROM headers WHERE path = ?',[[f] for f in gone])
+    db.commit()
+
+    rows = dict()
+    cursor = db.execute('SELECT * FROM headers')
+    names = [i[0] for i in cursor.description]
+    for row in cursor:
+        rows[row[0]] = dict(zip(names,row))
+    db.close()
+    return({f:rows[f] for f in filenames})
+
+
+#The raw frame types (DPR TYPE) that are used in the cascade, and the tags with which they are listed
+#in the sof files. Only one of the two science types is used, depending on what fiber B is on.
+FRAME_TAGS = {'BIAS':'BIAS','DARK':'DARK','LED':'LED_FF','ORDERDEF,LAMP,OFF':'ORDERDEF_A',
+    'ORDERDEF,OFF,LAMP':'ORDERDEF_B','FLAT,LAMP,OFF':'FLAT_A','FLAT,OFF,LAMP':'FLAT_B','WAVE,FP,FP':'FP_FP',
+    'WAVE,FP,THAR':'FP_THAR','WAVE,THAR,FP':'THAR_FP','CONTAM,OFF,FP':'RAW_CONTAM_FP','EFF,SKY,SKY':'EFF_AB',
+    'FLUX,STD,SKY':'FLUX','OBJECT,SKY':'OBJ_SKY','OBJECT,FP':'OBJ_FP'}
+
+
+def header_table(rows):
+    """This turns a list of header index rows (see index_headers) into a table of columns, i.e. a
+    dictionary of numpy arrays with one element per file. Files without a DPR TYPE are left out."""
+    import numpy as np
+    rows = [row for row in rows if row['dpr_type'] != None]
+    table = dict()
+    for column in ['path']+list(HEADER_COLUMNS):
+        table[column] = np.array([row[column] for row in rows],dtype=object)
+    for column in ['binx','biny']:#Missing binning keywords never match the requested binning.
+        table[column] = np.array([row[column] if row[column] != None else 0 for row in rows],dtype=int)
+    table['dpr_type'] = table['dpr_type'].astype(str)
+    table['path'] = table['path'].astype(str)
+    return(table)
+
+
+def classify_frames(table,binx,biny):
+    """This sorts the frames in a header table by type in one pass. It returns a dictionary that lists,
+    for each DPR TYPE in FRAME_TAGS, the sof lines (path and tag) of the frames of that type that were
+    taken with the requested binning. The number of frames of each type and binning is printed."""
+    import numpy as np
+    binnings = np.char.add(np.char.add(table['binx'].astype(str),' x '),table['biny'].astype(str))
+    keys,counts = np.unique(np.char.add(np.char.add(table['dpr_type'],'  '),binnings),return_counts=True)
+    for key,count in zip(keys,counts):
+        print(f'{key}: {count}')
+
+    selected = (table['binx'] == binx) & (table['biny'] == biny)
+    types = table['dpr_type'][selected]
+    paths = table['path'][selected]
+    order = np.argsort(types,kind='stable')#Keeps the files of each type in their original order.
+    types,starts = np.unique(types[order],return_index=True)
+    groups = np.split(paths[order],starts[1:])
+    frames = {dpr_type:[] for dpr_type in FRAME_TAGS}
+    for dpr_type,group in zip(types,groups):
+        if dpr_type in FRAME_TAGS:
+            frames[dpr_type] = np.char.add(group,'   '+FRAME_TAGS[dpr_type]).tolist()
+    return(frames)
+
+
+#The calibration cascade. For each recipe this declares the banner that is printed when it starts
+#('title'), the esorex recipe and options it calls, the sof file it is called with, the name of its
+#log file, the DPR TYPEs of the raw frames that go into the sof file ('raw', see FRAME_TAGS, of which
+#only the first 'max_raw' are used if that is set), the other lines of the sof file ('inputs') and the
+#products that esorex is expected to make, which are moved to the output folder. Inputs are either the
+#PRO CATG of a static calibration file (as a string) or a pair of (product of an earlier recipe, tag).
+#The order is the order in which the recipes are run if they are run one at a time.
+CASCADE = {
+    'master_bias':{'title':'CREATING MASTER BIAS','recipe':'espdr_mbias','options':[],'sof':'BIAS.txt','log':'esorex_masterbias.log',
+        'raw':['BIAS'],
+        'inputs':['CCD_GEOM','INST_CONFIG'],
+        'outputs':['ESPRESSO_master_bias.fits','ESPRESSO_master_bias_res.fits']},
+    'master_dark':{'title':'CREATING MASTER DARK AND HOT PIXEL MAP','recipe':'espdr_mdark','options':[],'sof':'DARK.txt','log':'esorex_masterdark.log',
+        'raw':['DARK'],#For the DARKS we dont care about the exptime. It is 3600 for all of them....
+        'inputs':['CCD_GEOM','INST_CONFIG',('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES')],
+        'outputs':['ESPRESSO_master_dark.fits','ESPRESSO_hot_pixels.fits']},
+    'bad_pixels':{'title':'CREATING BAD PIXEL MAP','recipe':'espdr_led_ff','options':[],'sof':'LED.txt','log':'esorex_badpixels.log',
+        'raw':['LED'],
+        'inputs':['CCD_GEOM','INST_CONFIG','LED_FF_GAIN_WINDOWS',('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES'),
+            ('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK')],
+        'outputs':['ESPRESSO_bad_pixels.fits']},
+    'orderdef':{'title':'FIND ORDER TRACES','recipe':'espdr_orderdef','options':[],'sof':'ORDERDEF.txt','log':'esorex_orderdef.log',
+        'raw':['ORDERDEF,LAMP,OFF','ORDERDEF,OFF,LAMP'],
+        'inputs':['CCD_GEOM','INST_CONFIG',('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES'),
+            ('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK'),('ESPRESSO_bad_pixels.fits','BAD_PIXEL_MASK')],
+        'outputs':['ESPRESSO_ORDER_TABLE_A.fits','ESPRESSO_ORDER_TABLE_B.fits']},
+    'master_flat':{'title':'CREATE MASTER FLAT','recipe':'espdr_mflat','options':[],'sof':'FLAT.txt','log':'esorex_mflat.log',
+        'raw':['FLAT,LAMP,OFF','FLAT,OFF,LAMP'],
+        'inputs':['CCD_GEOM','INST_CONFIG',('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK'),
+            ('ESPRESSO_bad_pixels.fits','BAD_PIXEL_MASK'),('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES'),
+            ('ESPRESSO_ORDER_TABLE_A.fits','ORDER_TABLE_A'),('ESPRESSO_ORDER_TABLE_B.fits','ORDER_TABLE_B'),
+            'STATIC_WAVE_MATRIX_A','STATIC_WAVE_MATRIX_B'],
+        'outputs':['ESPRESSO_ORDER_PROFILE_A.fits','ESPRESSO_ORDER_PROFILE_B.fits','ESPRESSO_BLAZE_A.fits',
+            'ESPRESSO_BLAZE_B.fits','ESPRESSO_FLAT_A.fits','ESPRESSO_FLAT_B.fits',
+            'ESPRESSO_background_map_A.fits','ESPRESSO_background_map_B.fits',
+            'ESPRESSO_spectrum_extracted_A.fits','ESPRESSO_spectrum_extracted_B.fits']},
+    'wave_FP_FP':{'title':'CREATE WAVE FP_FP','recipe':'espdr_wave_FP','options':[],'sof':'WAVE_FP_FP.txt','log':'esorex_wave_fp_fp.log',
+        'raw':['WAVE,FP,FP'],
+        'inputs':['CCD_GEOM','INST_CONFIG',('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES'),
+            ('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK'),('ESPRESSO_bad_pixels.fits','BAD_PIXEL_MASK'),
+            ('ESPRESSO_ORDER_TABLE_A.fits','ORDER_TABLE_A'),('ESPRESSO_ORDER_TABLE_B.fits','ORDER_TABLE_B'),
+            ('ESPRESSO_BLAZE_A.fits','BLAZE_A'),('ESPRESSO_BLAZE_B.fits','BLAZE_B'),
+            ('ESPRESSO_FLAT_A.fits','FSPECTRUM_A'),('ESPRESSO_FLAT_B.fits','FSPECTRUM_B'),
+            ('ESPRESSO_ORDER_PROFILE_A.fits','ORDER_PROFILE_A'),('ESPRESSO_ORDER_PROFILE_B.fits','ORDER_PROFILE_B')],
+        'outputs':['ESPRESSO_S2D_FP_FP_A.fits','ESPRESSO_S2D_FP_FP_B.fits','ESPRESSO_S2D_BLAZE_FP_FP_A.fits',
+            'ESPRESSO_S2D_BLAZE_FP_FP_B.fits','ESPRESSO_FP_SEARCHED_LINE_TABLE_A.fits',
+            'ESPRESSO_FP_SEARCHED_LINE_TABLE_B.fits']},
+    'wave_FP_TH':{'title':'CREATE WAVE FP_THAR','recipe':'espdr_wave_THAR','options':[],'sof':'WAVE_FP_TH.txt','log':'esorex_wave_fp_thar.log',
+        'raw':['WAVE,FP,THAR'],
+        'inputs':['CCD_GEOM','INST_CONFIG',('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES'),
+            ('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK'),('ESPRESSO_bad_pixels.fits','BAD_PIXEL_MASK'),
+            ('ESPRESSO_ORDER_TABLE_A.fits','ORDER_TABLE_A'),('ESPRESSO_ORDER_TABLE_B.fits','ORDER_TABLE_B'),
+            ('ESPRESSO_BLAZE_A.fits','BLAZE_A'),('ESPRESSO_BLAZE_B.fits','BLAZE_B'),
+            ('ESPRESSO_FLAT_A.fits','FSPECTRUM_A'),('ESPRESSO_FLAT_B.fits','FSPECTRUM_B'),
+            ('ESPRESSO_ORDER_PROFILE_A.fits','ORDER_PROFILE_A'),('ESPRESSO_ORDER_PROFILE_B.fits','ORDER_PROFILE_B'),
+            'REF_LINE_TABLE_A','REF_LINE_TABLE_B',
+            ('ESPRESSO_FP_SEARCHED_LINE_TABLE_A.fits','FP_SEARCHED_LINE_TABLE_FP_FP_A'),
+            ('ESPRESSO_FP_SEARCHED_LINE_TABLE_B.fits','FP_SEARCHED_LINE_TABLE_FP_FP_B'),
+            ('ESPRESSO_S2D_BLAZE_FP_FP_A.fits','S2D_BLAZE_FP_FP_A'),('ESPRESSO_S2D_BLAZE_FP_FP_B.fits','S2D_BLAZE_FP_FP_B'),
+            'STATIC_DLL_MATRIX_A','STATIC_DLL_MATRIX_B','STATIC_WAVE_MATRIX_A','STATIC_WAVE_MATRIX_B'],
+        'outputs':['ESPRESSO_AIR_DLL_MATRIX_B.fits','ESPRESSO_AIR_WAVE_MATRIX_B.fits','ESPRESSO_DLL_MATRIX_B.fits',
+            'ESPRESSO_FP_FITTED_LINE_TABLE_B.fits','ESPRESSO_LINE_TABLE_RAW_B.fits',
+            'ESPRESSO_S2D_BLAZE_FP_THAR_A.fits','ESPRESSO_S2D_BLAZE_FP_THAR_B.fits','ESPRESSO_S2D_FP_THAR_A.fits',
+            'ESPRESSO_S2D_FP_THAR_B.fits','ESPRESSO_WAVE_MATRIX_B.fits','ESPRESSO_WAVE_TABLE_B.fits',
+            'ESPRESSO_THAR_LINE_TABLE_B.fits']},
+    'wave_TH_FP':{'title':'CREATE WAVE THAR_FP','recipe':'espdr_wave_THAR','options':[],'sof':'WAVE_TH_FP.txt','log':'esorex_wave_thar_fp.log',
+        'raw':['WAVE,THAR,FP'],
+        'inputs':['CCD_GEOM','INST_CONFIG',('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES'),
+            ('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK'),('ESPRESSO_bad_pixels.fits','BAD_PIXEL_MASK'),
+            ('ESPRESSO_ORDER_TABLE_A.fits','ORDER_TABLE_A'),('ESPRESSO_ORDER_TABLE_B.fits','ORDER_TABLE_B'),
+            ('ESPRESSO_BLAZE_A.fits','BLAZE_A'),('ESPRESSO_BLAZE_B.fits','BLAZE_B'),
+            ('ESPRESSO_FLAT_A.fits','FSPECTRUM_A'),('ESPRESSO_FLAT_B.fits','FSPECTRUM_B'),
+            ('ESPRESSO_ORDER_PROFILE_A.fits','ORDER_PROFILE_A'),('ESPRESSO_ORDER_PROFILE_B.fits','ORDER_PROFILE_B'),
+            'REF_LINE_TABLE_A','REF_LINE_TABLE_B',
+            ('ESPRESSO_FP_SEARCHED_LINE_TABLE_A.fits','FP_SEARCHED_LINE_TABLE_FP_FP_A'),
+            ('ESPRESSO_FP_SEARCHED_LINE_TABLE_B.fits','FP_SEARCHED_LINE_TABLE_FP_FP_B'),
+            ('ESPRESSO_S2D_BLAZE_FP_FP_A.fits','S2D_BLAZE_FP_FP_A'),('ESPRESSO_S2D_BLAZE_FP_FP_B.fits','S2D_BLAZE_FP_FP_B'),
+            'STATIC_DLL_MATRIX_A','STATIC_DLL_MATRIX_B','STATIC_WAVE_MATRIX_A','STATIC_WAVE_MATRIX_B'],
+        'outputs':['ESPRESSO_AIR_DLL_MATRIX_A.fits','ESPRESSO_AIR_WAVE_MATRIX_A.fits','ESPRESSO_DLL_MATRIX_A.fits',
+            'ESPRESSO_FP_FITTED_LINE_TABLE_A.fits','ESPRESSO_LINE_TABLE_RAW_A.fits',
+            'ESPRESSO_S2D_BLAZE_THAR_FP_A.fits','ESPRESSO_S2D_BLAZE_THAR_FP_B.fits','ESPRESSO_S2D_THAR_FP_A.fits',
+            'ESPRESSO_S2D_THAR_FP_B.fits','ESPRESSO_WAVE_MATRIX_A.fits','ESPRESSO_WAVE_TABLE_A.fits',
+            'ESPRESSO_THAR_LINE_TABLE_A.fits']},
+    'contamination':{'title':'CREATE CROSS-FIBER CONTAMINATION FRAMES','recipe':'espdr_cal_contam','options':[],'sof':'CONTAM.txt','log':'esorex_cal_contam.log',
+        'raw':['CONTAM,OFF,FP'],
+        'inputs':['CCD_GEOM','INST_CONFIG',('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES'),
+            ('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK'),('ESPRESSO_bad_pixels.fits','BAD_PIXEL_MASK'),
+            ('ESPRESSO_ORDER_TABLE_A.fits','ORDER_TABLE_A'),('ESPRESSO_ORDER_TABLE_B.fits','ORDER_TABLE_B'),
+            ('ESPRESSO_ORDER_PROFILE_A.fits','ORDER_PROFILE_A'),('ESPRESSO_ORDER_PROFILE_B.fits','ORDER_PROFILE_B'),
+            ('ESPRESSO_FLAT_A.fits','FSPECTRUM_A'),('ESPRESSO_FLAT_B.fits','FSPECTRUM_B')],
+        'outputs':['ESPRESSO_CONTAM_FP_B.fits','ESPRESSO_CONTAM_S2D_A.fits','ESPRESSO_CONTAM_S2D_B.fits']},
+    'relative_efficiency':{'title':'CREATE RELATIVE FIBER EFFICIENCY FRAMES','recipe':'espdr_cal_eff_ab','options':[],'sof':'EFF_SKY.txt','log':'esorex_cal_eff_ab.log',
+        'raw':['EFF,SKY,SKY'],'max_raw':1,
+        'inputs':['CCD_GEOM','INST_CONFIG',('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK'),
+            ('ESPRESSO_bad_pixels.fits','BAD_PIXEL_MASK'),
+            ('ESPRESSO_ORDER_TABLE_A.fits','ORDER_TABLE_A'),('ESPRESSO_ORDER_TABLE_B.fits','ORDER_TABLE_B'),
+            ('ESPRESSO_ORDER_PROFILE_A.fits','ORDER_PROFILE_A'),('ESPRESSO_ORDER_PROFILE_B.fits','ORDER_PROFILE_B'),
+            ('ESPRESSO_FLAT_A.fits','FSPECTRUM_A'),('ESPRESSO_FLAT_B.fits','FSPECTRUM_B')],
+        'outputs':['ESPRESSO_S2D_BLAZE_EFF_A.fits','ESPRESSO_S2D_BLAZE_EFF_B.fits','ESPRESSO_REL_EFF_B.fits']},
+    'flux_calibration':{'title':'CREATE FLUX CALIBRATION FRAMES','recipe':'espdr_cal_flux','options':[],'sof':'FLUX_STD.txt','log':'esorex_cal_flux.log',
+        'raw':['FLUX,STD,SKY'],'max_raw':1,
+        'inputs':['CCD_GEOM','INST_CONFIG','STD_TABLE','EXT_TABLE',('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES'),
+            ('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK'),('ESPRESSO_bad_pixels.fits','BAD_PIXEL_MASK'),
+            ('ESPRESSO_ORDER_TABLE_A.fits','ORDER_TABLE_A'),('ESPRESSO_ORDER_TABLE_B.fits','ORDER_TABLE_B'),
+            ('ESPRESSO_ORDER_PROFILE_A.fits','ORDER_PROFILE_A'),('ESPRESSO_ORDER_PROFILE_B.fits','ORDER_PROFILE_B'),
+            ('ESPRESSO_FLAT_A.fits','FSPECTRUM_A'),('ESPRESSO_FLAT_B.fits','FSPECTRUM_B'),
+            ('ESPRESSO_BLAZE_A.fits','BLAZE_A'),('ESPRESSO_BLAZE_B.fits','BLAZE_B'),
+            ('ESPRESSO_WAVE_MATRIX_A.fits','WAVE_MATRIX_FP_THAR_B'),('ESPRESSO_WAVE_MATRIX_B.fits','WAVE_MATRIX_THAR_FP_A')],
+        'outputs':['ESPRESSO_S2D_STD_A.fits','ESPRESSO_S1D_STD_A.fits','ESPRESSO_S1D_ENERGY_STD_A.fits',
+            'ESPRESSO_S2D_BLAZE_STD_A.fits','ESPRESSO_AVG_FLUX_STD_A.fits','ESPRESSO_ABS_EFF_RAW_A.fits',
+            'ESPRESSO_ABS_EFF_A.fits']},
+    }
+
+
+#The science recipe, in the same format as the CASCADE. Its sof file (SCI_OBJ_part2.txt) holds the
+#calibrations, to which the science frame is added for each exposure (see reduce_exposure). The raw
+#science frames are listed in SCI_OBJ_part1.txt. The products are renamed after the exposure they belong
+#to and moved to SCIENCE_PRODUCTS in 'folder' (relative to the output folder). The 'sky_outputs' dont exist
+#if spectra were taken with the FP on fiber B. The exposures are recorded in the manifest under 'section'.
+SCIENCE_RECIPE = {'title':'PRODUCE REDUCED SCIENCE SPECTRA','recipe':'espdr_sci_red','options':['--background_sw=off'],
+    'sof':'SCI_OBJ_part2.txt','folder':'','section':'exposures',
+    'outputs':['CCF_A','CCF_RESIDUALS_A','S1D_A','S1D_B','S1D_FLUXCAL_A','S2D_A','S2D_B','S2D_BLAZE_A','S2D_BLAZE_B',
+        'S1D_FINAL_A','S1D_FINAL_B'],
+    'sky_outputs':['CCF_B','CCF_SKYSUB_A','S2D_SKYSUB_A','S1D_SKYSUB_A','S1D_SKYSUB_FLUXCAL_A'],
+    'inputs':['CCD_GEOM','INST_CONFIG','EXT_TABLE','MASK_LUT','MASK_TABLE','STD_TABLE',
+        ('ESPRESSO_master_bias_res.fits','MASTER_BIAS_RES'),
+        ('ESPRESSO_hot_pixels.fits','HOT_PIXEL_MASK'),('ESPRESSO_bad_pixels.fits','BAD_PIXEL_MASK'),
+        ('ESPRESSO_ORDER_TABLE_A.fits','ORDER_TABLE_A'),('ESPRESSO_ORDER_TABLE_B.fits','ORDER_TABLE_B'),
+        ('ESPRESSO_ORDER_PROFILE_A.fits','ORDER_PROFILE_A'),('ESPRESSO_ORDER_PROFILE_B.fits','ORDER_PROFILE_B'),
+        ('ESPRESSO_FLAT_A.fits','FSPECTRUM_A'),('ESPRESSO_FLAT_B.fits','FSPECTRUM_B'),
+        ('ESPRESSO_BLAZE_A.fits','BLAZE_A'),('ESPRESSO_BLAZE_B.fits','BLAZE_B'),
+        ('ESPRESSO_S2D_BLAZE_THAR_FP_A.fits','S2D_BLAZE_THAR_FP_A'),('ESPRESSO_S2D_BLAZE_THAR_FP_B.fits','S2D_BLAZE_THAR_FP_B'),
+        ('ESPRESSO_WAVE_MATRIX_A.fits','WAVE_MATRIX_FP_THAR_B'),('ESPRESSO_WAVE_MATRIX_B.fits','WAVE_MATRIX_THAR_FP_A'),
+        ('ESPRESSO_DLL_MATRIX_B.fits','DLL_MATRIX_FP_THAR_B'),('ESPRESSO_DLL_MATRIX_A.fits','DLL_MATRIX_THAR_FP_A'),
+        'FLUX_TEMPLATE',('ESPRESSO_CONTAM_FP_B.fits','CONTAM_FP'),('ESPRESSO_REL_EFF_B.fits','REL_EFF_B'),
+        ('ESPRESSO_ABS_EFF_A.fits','ABS_EFF_A')]}
+
+#The quick-look reduction of the science frames (see --quicklook), to decide what to do while the night
+#is still going on. It uses the same calibrations as the full reduction, and only the S2D spectrum and
+#the CCF of fiber A are kept, in QUICKLOOK/ so that they can not be mistaken for those of the full
+#reduction. By default it runs with the same options as the full reduction, because the parameters that
+#switch off the more expensive steps of espdr_sci_red are named differently in different versions of the
+#DRS. They can be given with --quicklook_options, and are checked against esorex --params espdr_sci_red
+#before anything is run (see check_recipe_options).
+QUICKLOOK_RECIPE = dict(SCIENCE_RECIPE,title='PRODUCE QUICK-LOOK SCIENCE SPECTRA',options=list(SCIENCE_RECIPE['options']),
+    folder='QUICKLOOK',section='quicklook',outputs=['S2D_BLAZE_A','CCF_A'],sky_outputs=[])
+
+
+def create_sof(inpath,outpath,binning,sky=True,index_file=None,file_list=None,static_list=None,require_science=True,static_store=None,
+        prune=True):
     """This script creates the file association lists (sof files) that are the main inputs
     to the pipeline recipes when called with esorex. The user provides the path of the raw data files
     (inpath) as downloaded from the ESO archive. These must be sorted by instrument mode
@@ -146,185 +577,97 @@ def create_sof(inpath,outpath,binning,sky=True):
 
     This recipe assumes that the object is taken with fiber B on sky. If fiber B is FB, change the sky keyword to False.
 
+    The headers of the input files are read once and kept in an index file (index_file, by default
+    header_index.sqlite in outpath), so that running the script again only reads new or changed files.
+    Files that are not used are removed from the index, unless prune is False (when the index is shared).
+    Instead of all the files in inpath, the raw frames and static calibration files to use can also be
+    passed as lists of paths (file_list and static_list), which is what the batch mode does. Of the
+    static calibration files, the ones that fit the instrument mode, binning and date of the raw frames
+    are used (see select_statics).
+    If require_science is False, it is not an error if there are no science frames (yet), which is
+    the case when the watch mode is started before the first science frame has been taken.
+    If a static_store folder is given, the static calibration files are added to it (see store_statics)
+    and taken from it (see resolve_statics), so they do not need to be in inpath.
     """
     import os
-    import numpy as np
-    import astropy.io.fits as fitsio
-    import pdb
     import sys
-    from pathlib import Path
-    import glob
 
 
 
     #The rest works automatically.
-    file_list = os.listdir(inpath)
-    file_list = [str(i) for i in Path(inpath).glob('ESPRE*.fits')]
-    static_list = [str(i) for i in Path(inpath).glob('M.ESPRESSO*.fits')]
-    mask_list =[]
-    fits_list=[]
-    type_list=[]
-    dits_list=[]
-    binx_list=[]
-    biny_list=[]
-    static_type_list=[]
+    if file_list == None:
+        file_list = fits_files(inpath,'ESPRE')
+    if static_list == None:
+        static_list = fits_files(inpath,'M.ESPRESSO')
+    file_list = [str(i) for i in file_list]
+    static_list = [str(i) for i in static_list]
     binstring = binning.split('x')
     binx = int(binstring[0])
     biny = int(binstring[1])
 
 
-    for file in static_list:
-        with fitsio.open(file) as fu:
-            static_type_list.append(fu[0].header['ESO PRO CATG'])
-
-
-    static_dict = dict()#We save the statics in a dictionary so that they can be parsed easily later.
-    for i,s in enumerate(static_type_list):
-        if s == 'MASK_TABLE':
-            mask_list.append(static_list[i])
-        else:
-            static_dict[s]=static_list[i]
-
-    #for i in static_dict:
-    #    print(i)
-    #for i in mask_list:
-    #    print(i)
-    #sys.exit()
-    for file in file_list:
-        fits_list=np.append(fits_list,file)
-        with fitsio.open(file) as fu:
-            type_list=np.append(type_list,fu[0].header['HIERARCH ESO DPR TYPE'])
-            dits_list=np.append(dits_list,fu[0].header['EXPTIME'])
-            binx_list=np.append(binx_list,fu[0].header['HIERARCH ESO DET BINX'])
-            biny_list=np.append(biny_list,fu[0].header['HIERARCH ESO DET BINY'])
-
-    for i in range(len(type_list)):
-        print(type_list[i]+'  %s x %s' % (int(binx_list[i]),int(biny_list[i])))
-    binning2 = 'VOID' #This will cause it to crash when trying to find calib 11 or 21 files down the road, unless binning is set properly to 1x1 or 2x1.
-
-
-    #The following is to switch between different sky modes.
+    if index_file == None:
+        index_file = outpath/'header_index.sqlite'
+    if static_store != None:
+        store_statics(static_list,static_store)
+        headers = index_headers(file_list,index_file,prune=prune)
+    else:
+        headers = index_headers(file_list+static_list,index_file,prune=prune)
+    raw = [headers[file] for file in file_list if (headers[file]['binx'],headers[file]['biny']) == (binx,biny)]
+    modes = [h['ins_mode'] for h in raw if h['ins_mode'] != None]
+    mode = max(set(modes),key=modes.count) if len(modes) > 0 else None
+    dates = [h['mjd_obs'] for h in raw if h['mjd_obs'] != None]
+    date = mjd_to_iso(min(dates)) if len(dates) > 0 else '9999'
+    tags = [t for recipe in list(CASCADE.values())+[SCIENCE_RECIPE] for t in recipe['inputs'] if isinstance(t,str)]
+    if static_store != None:
+        static_dict = resolve_statics(tags,static_store,mode,binx,biny,date)
+    else:#The same static file may have been downloaded with several datasets, so each is used once.
+        folders = set([os.path.dirname(file) for file in file_list])
+        unique = dict()
+        for file in sorted(static_list,key=lambda file: os.path.dirname(file) not in folders):
+            unique.setdefault(os.path.basename(file),file)
+        rows = [(file,headers[file]['pro_catg'],headers[file]['ins_mode'],headers[file]['binx'],headers[file]['biny'],
+            static_valid_from(file,'')) for file in unique.values()]
+        static_dict = select_statics(rows,tags,mode,binx,biny,date,inpath,folders=folders)
+
+
+    #The following is to switch between different sky modes. Science frames of the other mode are ignored.
     if sky == True:
         object_keyword='OBJECT,SKY'
-        object_tag='OBJ_SKY'
     else:
         object_keyword='OBJECT,FP'
-        object_tag='OBJ_FP'
-
-
-    #Define the lists in which the frame types will be sorted.
-    bias_list=[]
-    dark_list=[]
-    LED_list=[]
-    orderdefA_list=[]
-    orderdefB_list=[]
-    flatA_list=[]
-    flatB_list=[]
-    contam_list=[]
-    eff_list=[]
-    std_list=[]
-    sci_list=[]
-    FP_FP_list=[]
-    FP_TH_list=[]
-    TH_FP_list=[]
-
-
-
-    #The following goes through the list of user-supplied files and sorts them along type.
-    for i in range(len(fits_list)):
-        if type_list[i] == 'BIAS' and binx_list[i] == binx and biny_list[i] == biny:
-            bias_list = np.append(bias_list,fits_list[i]+'   '+type_list[i])
-        if type_list[i] == 'DARK' and binx_list[i] == binx and biny_list[i] == biny:
-            dark_list = np.append(dark_list,fits_list[i]+'   '+type_list[i])#+'   %s' % dits_list[i])
-            #For the DARKS we dont care about the exptime. It is 3600 for all of them....
-        if type_list[i] == 'LED' and binx_list[i] == binx and biny_list[i] == biny:
-            LED_list = np.append(LED_list,fits_list[i]+'   '+type_list[i]+'_FF')
-        if type_list[i] == 'ORDERDEF,LAMP,OFF' and binx_list[i] == binx and biny_list[i] == biny:
-            orderdefA_list = np.append(orderdefA_list,fits_list[i]+'   '+'ORDERDEF_A')
-        if type_list[i] == 'ORDERDEF,OFF,LAMP' and binx_list[i] == binx and biny_list[i] == biny:
-            orderdefB_list = np.append(orderdefB_list,fits_list[i]+'   '+'ORDERDEF_B')
-        if type_list[i] == 'FLAT,LAMP,OFF' and binx_list[i] == binx and biny_list[i] == biny:
-            flatA_list = np.append(flatA_list,fits_list[i]+'   '+'FLAT_A')
-        if type_list[i] == 'FLAT,OFF,LAMP' and binx_list[i] == binx and biny_list[i] == biny:
-            flatB_list = np.append(flatB_list,fits_list[i]+'   '+'FLAT_B')
-        if type_list[i] == 'WAVE,FP,FP' and binx_list[i] == binx and biny_list[i] == biny:
-            FP_FP_list = np.append(FP_FP_list,fits_list[i]+'   '+'FP_FP')
-        if type_list[i] == 'WAVE,FP,THAR' and binx_list[i] == binx and biny_list[i] == biny:
-            FP_TH_list = np.append(FP_TH_list,fits_list[i]+'   '+'FP_THAR')
-        if type_list[i] == 'WAVE,THAR,FP' and binx_list[i] == binx and biny_list[i] == biny:
-            TH_FP_list = np.append(TH_FP_list,fits_list[i]+'   '+'THAR_FP')
-        if type_list[i] == 'CONTAM,OFF,FP' and binx_list[i] == binx and biny_list[i] == biny:
-            contam_list = np.append(contam_list,fits_list[i]+'   '+'RAW_CONTAM_FP')
-        if type_list[i] == 'EFF,SKY,SKY' and binx_list[i] == binx and biny_list[i] == biny:
-            eff_list = np.append(eff_list,fits_list[i]+'   '+'EFF_AB')
-        if type_list[i] == 'FLUX,STD,SKY' and binx_list[i] == binx and biny_list[i] == biny:
-            std_list = np.append(std_list,fits_list[i]+'   '+'FLUX')
-        if type_list[i] == object_keyword  and binx_list[i] == binx and biny_list[i] == biny:
-            sci_list = np.append(sci_list,fits_list[i]+'   '+object_tag)
-
-
-    #The following checks that all these types are populated.
-    if len(bias_list) == 0:
-        print('ERROR: No BIAS frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(dark_list) == 0:
-        print('ERROR: No DARK frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(LED_list) == 0:
-        print('ERROR: No LED frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(orderdefA_list) == 0:
-        print('ERROR: No ORDERDEF,LAMP,OFF frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(orderdefB_list) == 0:
-        print('ERROR: No ORDERDEF,OFF,LAMP frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(flatA_list) == 0:
-        print('ERROR: No FLAT,LAMP,OFF frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(flatB_list) == 0:
-        print('ERROR: No FLAT,OFF,LAMP frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(FP_FP_list) == 0:
-        print('ERROR: No WAVE,FP,FP frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(FP_TH_list) == 0:
-        print('ERROR: No WAVE,FP,THAR frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(TH_FP_list) == 0:
-        print('ERROR: No WAVE,THAR,FP frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(contam_list) == 0:
-        print('ERROR: No CONTAM,OFF,FP frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(contam_list) > 1:
+    required = []
+    for recipe in CASCADE.values():
+        required += [t for t in recipe.get('raw',[]) if t not in required]
+    if require_science:
+        required.append(object_keyword)
+
+
+    #The following sorts the user-supplied files by type and checks that all these types are populated.
+    for file in file_list:
+        if headers[file]['dpr_type'] == None:
+            print(f'WARNING: {file} has no DPR TYPE keyword and is ignored.')
+    frames = classify_frames(header_table([headers[file] for file in file_list]),binx,biny)
+    for dpr_type in required:
+        if len(frames[dpr_type]) == 0:
+            print(f'ERROR: No {dpr_type} frames detected. Check that you downloaded them properly.')
+            sys.exit()
+    if len(frames['CONTAM,OFF,FP']) > 1:
         print('ERROR: More than one CONTAM,OFF,FP frames detected. Please remove so you have only one left. The files dected are:')
-        print(contam_list)
-        sys.exit()
-    if len(eff_list) == 0:
-        print('ERROR: No EFF,SKY,SKY frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(std_list) == 0:
-        print('ERROR: No FLUX,STD,SKY frames detected. Check that you downloaded them properly.')
-        sys.exit()
-    if len(sci_list) == 0:
-        print(f'ERROR: No {object_keyword} frames detected. Check that you downloaded them properly.')
+        print(frames['CONTAM,OFF,FP'])
         sys.exit()
-    if len(std_list) >= 2:
+    if len(frames['FLUX,STD,SKY']) >= 2:
         print("WARNING: There is more than 1 FLUX,STD,SKY frame. Only using the first one.")
-    if 'CCD_GEOM' not in static_dict.keys():
-        print("ERROR: CCD_GEOM is missing. Was it downloaded correctly by the calselector?")
-        sys.exit()
-    if 'INST_CONFIG' not in static_dict.keys():
-        print("ERROR: CCD_GEOM is missing. Was it downloaded correctly by the calselector?")
-        sys.exit()
-
-
+    for recipe in list(CASCADE.values())+[SCIENCE_RECIPE]:
+        for tag in recipe['inputs']:
+            if isinstance(tag,str) and tag not in static_dict:
+                print(f"ERROR: {tag} is missing (needed by {recipe['recipe']}). Was it downloaded correctly by the calselector?")
+                sys.exit()
 
 
     #==============================================================================================#
-    #The following blocks write out the SOF files for the different frame types.
-    #Big wall of text with a lot of repetition but the functionality should be clear.
+    #The sof files are written from the CASCADE table further down, which lists for each recipe the
+    #raw frames, static calibration files and products of earlier recipes that go into its sof file.
     #All of this comes from the ESPRESSO Pipeline manual v1.2.2, modulo the typos
     #that exist in there (some files are named differently in reality versus what's
     #written in the manual. Sorting this out once and for all is the purpose of this script.
@@ -332,391 +675,146 @@ def create_sof(inpath,outpath,binning,sky=True):
     #as written in the SOF files are actually present.
     #==============================================================================================#
 
-    outF = open(outpath/"BIAS.txt", "w")
-    for line in bias_list:
-        outF.write(line)
-        outF.write("\n")
-    # import pdb
-    # pdb.set_trace()
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.close()
-
-    outF = open(outpath/"DARK.txt", "w")
-    for line in dark_list:
-        outF.write(line)
-        outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.close()
-
-    outF = open(outpath/"LED.txt", "w")
-    for line in LED_list:
-        outF.write(line)
-        outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(static_dict['LED_FF_GAIN_WINDOWS']+'   LED_FF_GAIN_WINDOWS')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.close()
-
-    outF = open(outpath/"ORDERDEF.txt", "w")
-    for line in orderdefA_list:
-        outF.write(line)
-        outF.write("\n")
-    for line in orderdefB_list:
-        outF.write(line)
-        outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_bad_pixels.fits')+' BAD_PIXEL_MASK')
-    outF.close()
-
-
-    outF = open(outpath/"FLAT.txt", "w")
-    for line in flatA_list:
-        outF.write(line)
-        outF.write("\n")
-    for line in flatB_list:
-        outF.write(line)
-        outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_bad_pixels.fits')+' BAD_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_A.fits')+' ORDER_TABLE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_B.fits')+' ORDER_TABLE_B')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_WAVE_MATRIX_A']+'   STATIC_WAVE_MATRIX_A')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_WAVE_MATRIX_B']+'   STATIC_WAVE_MATRIX_B')
-    outF.close()
-
-    outF = open(outpath/"WAVE_FP_FP.txt", "w")
-    for line in FP_FP_list:
-        outF.write(line)
-        outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_bad_pixels.fits')+' BAD_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_A.fits')+' ORDER_TABLE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_B.fits')+' ORDER_TABLE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_A.fits')+' BLAZE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_B.fits')+' BLAZE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_A.fits')+' FSPECTRUM_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_B.fits')+' FSPECTRUM_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_A.fits')+' ORDER_PROFILE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_B.fits')+' ORDER_PROFILE_B')
-    outF.close()
-
-
-    outF = open(outpath/"WAVE_FP_TH.txt", "w")
-    for line in FP_TH_list:
-        outF.write(line)
-        outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_bad_pixels.fits')+' BAD_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_A.fits')+' ORDER_TABLE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_B.fits')+' ORDER_TABLE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_A.fits')+' BLAZE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_B.fits')+' BLAZE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_A.fits')+' FSPECTRUM_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_B.fits')+' FSPECTRUM_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_A.fits')+' ORDER_PROFILE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_B.fits')+' ORDER_PROFILE_B')
-    outF.write("\n")
-    outF.write(static_dict['REF_LINE_TABLE_A']+'   REF_LINE_TABLE_A')
-    outF.write("\n")
-    outF.write(static_dict['REF_LINE_TABLE_B']+'   REF_LINE_TABLE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FP_SEARCHED_LINE_TABLE_A.fits')+' FP_SEARCHED_LINE_TABLE_FP_FP_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FP_SEARCHED_LINE_TABLE_B.fits')+' FP_SEARCHED_LINE_TABLE_FP_FP_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_S2D_BLAZE_FP_FP_A.fits')+' S2D_BLAZE_FP_FP_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_S2D_BLAZE_FP_FP_B.fits')+' S2D_BLAZE_FP_FP_B')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_DLL_MATRIX_A']+'   STATIC_DLL_MATRIX_A')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_DLL_MATRIX_B']+'   STATIC_DLL_MATRIX_B')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_WAVE_MATRIX_A']+'   STATIC_WAVE_MATRIX_A')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_WAVE_MATRIX_B']+'   STATIC_WAVE_MATRIX_B')
-    outF.close()
-
-
-    outF = open(outpath/"WAVE_TH_FP.txt", "w")
-    for line in TH_FP_list:
-        outF.write(line)
-        outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_bad_pixels.fits')+' BAD_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_A.fits')+' ORDER_TABLE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_B.fits')+' ORDER_TABLE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_A.fits')+' BLAZE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_B.fits')+' BLAZE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_A.fits')+' FSPECTRUM_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_B.fits')+' FSPECTRUM_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_A.fits')+' ORDER_PROFILE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_B.fits')+' ORDER_PROFILE_B')
-    outF.write("\n")
-    outF.write(static_dict['REF_LINE_TABLE_A']+'   REF_LINE_TABLE_A')
-    outF.write("\n")
-    outF.write(static_dict['REF_LINE_TABLE_B']+'   REF_LINE_TABLE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FP_SEARCHED_LINE_TABLE_A.fits')+' FP_SEARCHED_LINE_TABLE_FP_FP_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FP_SEARCHED_LINE_TABLE_B.fits')+' FP_SEARCHED_LINE_TABLE_FP_FP_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_S2D_BLAZE_FP_FP_A.fits')+' S2D_BLAZE_FP_FP_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_S2D_BLAZE_FP_FP_B.fits')+' S2D_BLAZE_FP_FP_B')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_DLL_MATRIX_A']+'   STATIC_DLL_MATRIX_A')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_DLL_MATRIX_B']+'   STATIC_DLL_MATRIX_B')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_WAVE_MATRIX_A']+'   STATIC_WAVE_MATRIX_A')
-    outF.write("\n")
-    outF.write(static_dict['STATIC_WAVE_MATRIX_B']+'   STATIC_WAVE_MATRIX_B')
-    outF.close()
-
-
-    outF = open(outpath/"CONTAM.txt", "w")
-    for line in contam_list:
-        outF.write(line)
-        outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_bad_pixels.fits')+' BAD_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_A.fits')+' ORDER_TABLE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_B.fits')+' ORDER_TABLE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_A.fits')+' ORDER_PROFILE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_B.fits')+' ORDER_PROFILE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_A.fits')+' FSPECTRUM_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_B.fits')+' FSPECTRUM_B')
-    outF.close()
-
-    outF = open(outpath/"EFF_SKY.txt", "w")
-    #for line in eff_list:
-        #outF.write(line)
-        #outF.write("\n")
-    outF.write(eff_list[0])
-    outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_bad_pixels.fits')+' BAD_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_A.fits')+' ORDER_TABLE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_B.fits')+' ORDER_TABLE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_A.fits')+' ORDER_PROFILE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_B.fits')+' ORDER_PROFILE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_A.fits')+' FSPECTRUM_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_B.fits')+' FSPECTRUM_B')
-    outF.close()
-
-
-    outF = open(outpath/"FLUX_STD.txt", "w")
-    if len(std_list) >= 1:
-        outF.write(std_list[0])
-        outF.write("\n")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(static_dict['STD_TABLE']+'   STD_TABLE')
-    outF.write("\n")
-    outF.write(static_dict['EXT_TABLE']+'   EXT_TABLE')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_bad_pixels.fits')+' BAD_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_A.fits')+' ORDER_TABLE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_B.fits')+' ORDER_TABLE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_A.fits')+' ORDER_PROFILE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_B.fits')+' ORDER_PROFILE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_A.fits')+' FSPECTRUM_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_B.fits')+' FSPECTRUM_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_A.fits')+' BLAZE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_B.fits')+' BLAZE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_WAVE_MATRIX_A.fits')+' WAVE_MATRIX_FP_THAR_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_WAVE_MATRIX_B.fits')+' WAVE_MATRIX_THAR_FP_A')
-    outF.close()
-
-
-
-
-    #Almost there...
-    outF = open(outpath/"SCI_OBJ_part1.txt", "w")
-    outF.write('EMPTY LINE')
-    for line in sci_list:
-        outF.write(line)
-        outF.write("\n")
-    outF.close()
-
-    outF = open(outpath/"SCI_OBJ_part2.txt", "w")
-    outF.write(static_dict['CCD_GEOM']+'   CCD_GEOM')
-    outF.write("\n")
-    outF.write(static_dict['INST_CONFIG']+'   INST_CONFIG')
-    outF.write("\n")
-    outF.write(static_dict['EXT_TABLE']+'   EXT_TABLE')
-    outF.write("\n")
-    outF.write(static_dict['MASK_LUT']+'   MASK_LUT')
-    outF.write("\n")
-    for line in mask_list:
-        outF.write(line+'   MASK_TABLE')
-        outF.write("\n")
-    outF.write(static_dict['STD_TABLE']+'   STD_TABLE')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_master_bias_res.fits')+' MASTER_BIAS_RES')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_hot_pixels.fits')+' HOT_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_bad_pixels.fits')+' BAD_PIXEL_MASK')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_A.fits')+' ORDER_TABLE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_TABLE_B.fits')+' ORDER_TABLE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_A.fits')+' ORDER_PROFILE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ORDER_PROFILE_B.fits')+' ORDER_PROFILE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_A.fits')+' FSPECTRUM_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_FLAT_B.fits')+' FSPECTRUM_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_A.fits')+' BLAZE_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_BLAZE_B.fits')+' BLAZE_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_S2D_BLAZE_THAR_FP_A.fits')+' S2D_BLAZE_THAR_FP_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_S2D_BLAZE_THAR_FP_B.fits')+' S2D_BLAZE_THAR_FP_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_WAVE_MATRIX_A.fits')+' WAVE_MATRIX_FP_THAR_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_WAVE_MATRIX_B.fits')+' WAVE_MATRIX_THAR_FP_A')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_DLL_MATRIX_B.fits')+' DLL_MATRIX_FP_THAR_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_DLL_MATRIX_A.fits')+' DLL_MATRIX_THAR_FP_A')
-    outF.write("\n")
-    outF.write(static_dict['FLUX_TEMPLATE']+'   FLUX_TEMPLATE')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_CONTAM_FP_B.fits')+' CONTAM_FP')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_REL_EFF_B.fits')+' REL_EFF_B')
-    outF.write("\n")
-    outF.write(str(outpath/'ESPRESSO_ABS_EFF_A.fits')+' ABS_EFF_A')
-    outF.close()
+    for recipe in CASCADE.values():
+        write_sof(outpath/recipe['sof'],sof_lines(recipe,outpath,frames,static_dict))
+
+    #Almost there... The science frames are reduced one by one, each with its own copy of part2.
+    write_sof(outpath/"SCI_OBJ_part1.txt",frames[object_keyword])
+    write_sof(outpath/"SCI_OBJ_part2.txt",sof_lines(SCIENCE_RECIPE,outpath,frames,static_dict))
+
+
+#The header keywords of the static calibration files by which they are looked up in the static
+#calibration store (see store_statics).
+STATIC_COLUMNS = {'pro_catg':'ESO PRO CATG','ins_mode':'ESO INS MODE','binx':'ESO DET BINX','biny':'ESO DET BINY','date':'DATE'}
+
+
+def mjd_to_iso(mjd):
+    """This converts a modified julian date to an ISO date string like 2019-01-01T00:00:00."""
+    import datetime
+    return((datetime.datetime(1858,11,17)+datetime.timedelta(days=mjd)).isoformat(timespec='seconds'))
+
+
+def static_valid_from(filename,date):
+    """This returns the date (an ISO date string) from which a static calibration file is valid: the
+    date in its file name (e.g. M.ESPRESSO.2019-01-01T00:00:00.000.fits), or else date (its DATE
+    keyword), or an empty string if neither is known, which counts as always valid."""
+    import os
+    import re
+    valid_from = re.search(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}',os.path.basename(filename))
+    return(valid_from.group(0) if valid_from != None else str(date or '')[0:19])
+
+
+def store_statics(static_list,store):
+    """This adds the static calibration files (M.ESPRESSO*.fits) in static_list to the static
+    calibration store, a folder that is kept between runs and shared by all datasets, so that the
+    statics need to be downloaded and indexed only once. Each file is linked into store/files (or
+    copied, if the store is on another disk), and its PRO.CATG, instrument mode, binning and the date
+    from which it is valid (from its file name, or else its DATE keyword) are recorded in
+    store/statics.sqlite. Files that are in the store already (with the same name and size) are
+    skipped without being opened."""
+    import os
+    import shutil
+    import sqlite3
+    os.makedirs(store/'files',exist_ok=True)
+    db = sqlite3.connect(store/'statics.sqlite')
+    db.execute('CREATE TABLE IF NOT EXISTS statics (name TEXT PRIMARY KEY, size INTEGER, pro_catg TEXT, '
+        'ins_mode TEXT, binx INTEGER, biny INTEGER, valid_from TEXT)')
+    known = dict(db.execute('SELECT name, size FROM statics').fetchall())
+    added = 0
+    for filename in static_list:
+        name = os.path.basename(filename)
+        size = os.path.getsize(filename)
+        if known.get(name) == size:
+            continue
+        header = read_header(filename,STATIC_COLUMNS.values())
+        if header['ESO PRO CATG'] == None:
+            print(f'WARNING: {filename} has no PRO CATG keyword and is not added to the static calibration store.')
+            continue
+        target = store/'files'/name
+        try:
+            os.link(filename,str(target)+'.tmp')
+        except OSError:#E.g. on another disk.
+            shutil.copyfile(filename,str(target)+'.tmp')
+        os.replace(str(target)+'.tmp',target)
+        valid_from = static_valid_from(name,header['DATE'])
+        db.execute('INSERT OR REPLACE INTO statics VALUES (?,?,?,?,?,?,?)',[name,size]+
+            [header[STATIC_COLUMNS[k]] for k in ['pro_catg','ins_mode','binx','biny']]+[valid_from])
+        known[name] = size
+        added += 1
+    db.commit()
+    db.close()
+    if added > 0:
+        print(f'---Added {added} static calibration files to {store}.')
+
+
+def resolve_statics(tags,store,mode,binx,biny,date):
+    """This looks up the static calibration files with the PRO.CATG values in tags (e.g. CCD_GEOM) in
+    the static calibration store (see store_statics), for data taken in instrument mode mode (ESO INS
+    MODE) with binning binx x biny on date (an ISO date string). Only files made for that mode and
+    binning are used, or for any, if their header does not say. Of these, the one that became valid
+    last before date is taken, or the earliest one if none was valid yet. For MASK_TABLE, all the masks
+    (one file per CCF mask) that qualify are taken. Returns a dictionary like static_dict in
+    create_sof, without the tags that are not in the store, so only the statics that are needed are
+    looked up."""
+    import sqlite3
+    db = sqlite3.connect(store/'statics.sqlite')
+    rows = db.execute('SELECT name, pro_catg, ins_mode, binx, biny, valid_from FROM statics').fetchall()
+    db.close()
+    return(select_statics([(str(store/'files'/row[0]),)+tuple(row[1:]) for row in rows],tags,mode,binx,biny,date,store))
+
+
+def select_statics(rows,tags,mode,binx,biny,date,source,folders=[]):
+    """This does the selection of resolve_statics among rows of (path, PRO.CATG, instrument mode,
+    binx, biny, valid from) of the static calibration files that are found in source (a folder, for
+    the warnings). Of the files that fit, those in folders (e.g. next to the raw frames) are preferred,
+    so that statics that were downloaded with other datasets are only used if there are none there."""
+    import os
+    static_dict = {'MASK_TABLE':[]}
+    for tag in set(tags):
+        selected = [row for row in rows if row[1] == tag and row[2] in [None,mode] and row[3] in [None,binx] and row[4] in [None,biny]]
+        local = [row for row in selected if os.path.dirname(row[0]) in folders]
+        selected = local if len(local) > 0 else selected
+        valid = [row for row in selected if row[5] <= date]
+        if tag == 'MASK_TABLE':
+            static_dict[tag] = sorted([row[0] for row in (valid if len(valid) > 0 else selected)],key=os.path.basename)
+        elif len(valid) > 0:#The latest one, and the one that is most specific to the mode and binning.
+            static_dict[tag] = max(valid,key=lambda row: (row[5],-[row[2],row[3],row[4]].count(None)))[0]
+        elif len(selected) > 0:
+            print(f'WARNING: There is no {tag} in {source} that was valid on {date}. Using the earliest one.')
+            static_dict[tag] = min(selected,key=lambda row: row[5])[0]
+    return(static_dict)
+
+
+def sof_lines(recipe,outpath,frames,static_dict):
+    """This returns the lines of the sof file of a recipe in the CASCADE table (or SCIENCE_RECIPE):
+    first its raw frames (of the types listed under 'raw', taken from frames as returned by
+    classify_frames, and at most 'max_raw' of them), followed by its 'inputs' in the order in which
+    they are listed. Inputs given as a tag are static calibration files, taken from static_dict,
+    and inputs given as (file name, tag) are products of earlier recipes in outpath."""
+    lines = []
+    for dpr_type in recipe.get('raw',[]):
+        lines += frames[dpr_type]
+    lines = lines[0:recipe.get('max_raw',len(lines))]
+    for entry in recipe['inputs']:
+        if isinstance(entry,str):
+            static = static_dict[entry]
+            for filename in (static if isinstance(static,list) else [static]):
+                lines.append(filename+'   '+entry)
+        else:
+            lines.append(str(outpath/entry[0])+' '+entry[1])
+    return(lines)
+
+
+def write_sof(filename,lines):
+    """This writes the lines of a sof file."""
+    with open(filename,'w') as outF:
+        outF.write('\n'.join(lines))
 
 
     #==============================================================================================#
     #==============================================================================================#
-    #This is the end of the create_sof script. What follows are three small utility functions, after
-    #which there is a set of wrappers for the esorex recipes.
+    #This is the end of the create_sof script. What follows are the functions that run the esorex
+    #recipes listed in the CASCADE table.
     #==============================================================================================#
     #==============================================================================================#
 
@@ -725,40 +823,452 @@ def create_sof(inpath,outpath,binning,sky=True):
 
 
 
-def move_to(filename,outpath,newname=None):
+def move_to(filename,outpath,newname=None,workdir=None):
     import pdb
     """This short script moves a file at location filename to the folder outpath.
     If the newname keyword is set to a string, the file will also be renamed in the process.
-    This moving overwrites existing files."""
+    If workdir is set, the file is taken from that folder instead of from the current working
+    directory. This moving overwrites existing files (see transfer_file)."""
     #I was lazy to type shutil.move all the time...
-    import shutil
     from pathlib import Path
     outpath=Path(outpath)
+    if workdir == None:
+        source = filename
+    else:
+        source = Path(workdir)/filename
     if newname == None:
-        shutil.move(filename,outpath/filename)
+        transfer_file(source,outpath/filename)
     else:
-        shutil.move(filename,outpath/newname)
+        transfer_file(source,outpath/newname)
 
 
-def clean_trash():
-    """This program deletes left-over files at the end of a recipe."""
+def transfer_file(source,destination,sync=True):
+    """This moves the file source to destination (both full paths), overwriting what is there.
+    If both are on the same filesystem, the file is simply renamed, which does not copy any data
+    and is atomic. Otherwise (e.g. when the scratch folder is on a local disk and the output folder
+    on a network drive), the file is streamed to a temporary file next to the destination in chunks,
+    while computing a checksum. That copy is flushed to disk and read back, and only if the checksums
+    agree is it renamed into place and the source deleted. If sync is False, the folder of the
+    destination is not flushed to disk, which collect_products does once for all products instead."""
+    import os
+    import zlib
+    destination = os.fspath(destination)
+    if os.stat(source).st_dev == os.stat(os.path.dirname(destination) or '.').st_dev:
+        os.replace(source,destination)
+        return
+    temporary = destination+'.part'
+    checksum = 0
+    with open(source,'rb') as f, open(temporary,'wb') as g:
+        while True:
+            chunk = f.read(TRANSFER_CHUNK)
+            if len(chunk) == 0:
+                break
+            checksum = zlib.crc32(chunk,checksum)
+            g.write(chunk)
+        g.flush()
+        os.fsync(g.fileno())
+        if hasattr(os,'posix_fadvise'):#So that the copy is read back from the disk rather than from memory.
+            os.posix_fadvise(g.fileno(),0,0,os.POSIX_FADV_DONTNEED)
+    if file_checksum(temporary) != checksum:
+        os.remove(temporary)
+        raise OSError(f'The copy of {source} to {destination} is corrupted. The original is left in place.')
+    os.replace(temporary,destination)
+    if sync:
+        sync_folder(os.path.dirname(destination))
+    os.remove(source)
+
+
+#The size of the pieces (in bytes) in which files are copied between filesystems by transfer_file.
+TRANSFER_CHUNK = 16*1024*1024
+
+
+def file_checksum(filename):
+    """This returns the CRC-32 checksum of a file, which is read in chunks of TRANSFER_CHUNK bytes.
+    CRC-32 is not a cryptographic hash, but it is fast and good enough to catch a broken copy."""
+    import zlib
+    checksum = 0
+    with open(filename,'rb') as f:
+        while True:
+            chunk = f.read(TRANSFER_CHUNK)
+            if len(chunk) == 0:
+                return(checksum)
+            checksum = zlib.crc32(chunk,checksum)
+
+
+def sync_folder(folder):
+    """This flushes the list of files in a folder to disk, so that files that were just renamed into
+    it survive a crash. This does nothing on systems that cannot open folders (i.e. Windows)."""
+    import os
+    try:
+        fd = os.open(folder or '.',os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+#The background thread that collects the products of science exposures (see background_transfer),
+#and the transfers that it has been given.
+TRANSFERS = {'pool':None,'futures':[]}
+TRANSFER_LOCK = threading.Lock()
+
+
+def background_transfer(function):
+    """This calls function (which collects the products of a recipe) in a background thread, so that
+    the next recipe can already start while the products of the previous one are being copied to the
+    output folder. The transfers are done one by one, in the order in which they are given. Returns a
+    Future, see concurrent.futures. finish_transfers waits for all of them."""
+    from concurrent.futures import ThreadPoolExecutor
+    with TRANSFER_LOCK:
+        if TRANSFERS['pool'] == None:
+            TRANSFERS['pool'] = ThreadPoolExecutor(max_workers=1,thread_name_prefix='transfer')
+        future = TRANSFERS['pool'].submit(function)
+        TRANSFERS['futures'].append(future)
+    return(future)
+
+
+def finish_transfers():
+    """This waits until all the transfers given to background_transfer are done, and re-raises the
+    first thing that went wrong in any of them."""
+    from concurrent.futures import wait
+    with TRANSFER_LOCK:
+        futures = TRANSFERS['futures']
+        TRANSFERS['futures'] = []
+    wait(futures)
+    for future in futures:
+        future.result()
+
+
+#The folder in which the scratch folders of the recipes are made. The current working directory is
+#used if this is not set (see the --scratch option).
+SCRATCH_ROOT = {'path':None}
+
+
+def scratch_dir(name):
+    """This creates a new, empty scratch folder in which a recipe can be run, and returns its path.
+    Each call gets its own folder, so that recipes that run at the same time do not overwrite each
+    other's products and log files. The folders are made in SCRATCH_ROOT, or in the current working
+    directory if that is not set."""
+    import os
+    import tempfile
+    from pathlib import Path
+    root = SCRATCH_ROOT['path']
+    if root == None:
+        root = os.getcwd()
+    os.makedirs(root,exist_ok=True)
+    return(Path(tempfile.mkdtemp(prefix=name+'_',dir=root)).resolve())
+
+
+#How esorex is run (see run_esorex): the maximum run time of a single recipe call in seconds (None
+#for no limit), how many times a failed call is tried again, and whether the output of esorex is
+#printed while it runs (see the --timeout, --retries and --quiet options).
+ESOREX = {'timeout':None,'retries':0,'stream':True}
+
+
+async def run_esorex(recipe,sof_file,workdir,options=[],label=None,command=None,host=None):
+    """This calls esorex to execute a recipe on the given sof file, from within the scratch folder
+    workdir, to which esorex is also told to write its products and log file. Options (e.g.
+    ['--background_sw=off']) are passed to the recipe. This is a coroutine, so that many recipes can
+    run at the same time from a single thread (see run_jobs). The output of esorex is printed while
+    it runs, preceded by label (by default the name of the sof file). If esorex fails or takes longer
+    than ESOREX['timeout'] seconds, it is tried again up to ESOREX['retries'] times (the log file of
+    the failed attempt is kept in workdir), after which a RuntimeError is raised that includes the
+    last lines of its output. See esorex_process for the profiling of each attempt. If command is
+    given, it is run instead of esorex itself, e.g. to run the recipe on host (see EXECUTORS)."""
+    import os
+    if label == None:
+        label = os.path.basename(sof_file)
+    for attempt in range(ESOREX['retries']+1):
+        if attempt > 0:
+            print(f'---Trying {recipe} on {label} again ({attempt} of {ESOREX["retries"]}), because it {error}.')
+            if os.path.isfile(workdir/'esorex.log'):
+                os.replace(workdir/'esorex.log',workdir/f'esorex_attempt{attempt}.log')
+        returncode,output = await esorex_process(recipe,sof_file,workdir,options,label,command=command,host=host)
+        if returncode == 0:
+            return
+        error = f'timed out after {ESOREX["timeout"]:.0f} s' if returncode == None else f'exited with code {returncode}'
+    tail = '\n'.join(['    '+line for line in output])
+    raise RuntimeError(f'{recipe} on {label} {error}. Its log file is in {workdir}. The last lines of its output were:\n{tail}')
+
+
+def esorex_arguments(recipe,sof_file,workdir,options):
+    """This returns the command line that runs recipe on sof_file, writing to workdir."""
+    return(['esorex','--output-dir='+str(workdir),'--log-dir='+str(workdir),recipe]+list(options)+[str(sof_file)])
+
+
+async def esorex_process(recipe,sof_file,workdir,options,label,command=None,host=None):
+    """This runs esorex once (see run_esorex) and returns its exit code (None if it was stopped because
+    it took longer than ESOREX['timeout']) and the last lines of its output. The wall time, CPU time,
+    peak memory use and I/O of the esorex process are recorded in the profiling report under label
+    (see record_profile), and the peak memory use is also added to the memory profile (see
+    record_memory). If the coroutine is cancelled (e.g. by Ctrl-C, or by a timeout), esorex is stopped.
+    If esorex runs on another host (through command, e.g. ssh), only its wall time is recorded, as
+    the resources used here are those of ssh or srun rather than those of the recipe."""
+    import asyncio
+    import collections
+    import datetime
+    import os
+    import signal
+    import subprocess
+    import sys
+    import time
+    start = time.time()
+    #esorex gets its own process group, so that it is stopped by this script rather than by Ctrl-C directly.
+    if command == None:
+        command = esorex_arguments(recipe,sof_file,workdir,options)
+    process = subprocess.Popen(command,cwd=workdir,stdin=subprocess.DEVNULL,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,
+        start_new_session=True)
+    output = collections.deque(maxlen=20)
+    reader = asyncio.StreamReader(limit=2**20)
+    loop = asyncio.get_running_loop()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),process.stdout)
+
+    async def pump():
+        async for line in reader:
+            line = line.decode(errors='replace').rstrip()
+            output.append(line)
+            if ESOREX['stream']:
+                print(f'[{label}] {line}')
+
+    printer = asyncio.ensure_future(pump())
+    timed_out = False
+    try:
+        try:
+            status,usage,io = await asyncio.wait_for(wait_child(process.pid),ESOREX['timeout'])
+        except asyncio.TimeoutError:
+            timed_out = True
+            os.killpg(process.pid,signal.SIGTERM)
+            try:
+                status,usage,io = await asyncio.wait_for(wait_child(process.pid),10)
+            except asyncio.TimeoutError:
+                os.killpg(process.pid,signal.SIGKILL)
+                status,usage,io = await wait_child(process.pid)
+    except asyncio.CancelledError:
+        os.killpg(process.pid,signal.SIGKILL)
+        os.waitpid(process.pid,0)
+        process.returncode = -signal.SIGKILL
+        printer.cancel()
+        raise
+    await printer
+    process.stdout.close()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    record = {'label':label,'recipe':recipe,'start':datetime.datetime.fromtimestamp(start).isoformat(timespec='seconds'),
+        'wall':time.time()-start,'user':None,'system':None,'max_rss':None,'read_bytes':None,'write_bytes':None,
+        'rchar':None,'wchar':None,'returncode':process.returncode,'host':host}
+    if host == None:
+        if sys.platform == 'darwin':#ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+            max_rss = usage.ru_maxrss
+        else:
+            max_rss = usage.ru_maxrss*1024
+        record_memory(recipe,max_rss)
+        record.update({'user':usage.ru_utime,'system':usage.ru_stime,'max_rss':max_rss,'read_bytes':io.get('read_bytes'),
+            'write_bytes':io.get('write_bytes'),'rchar':io.get('rchar'),'wchar':io.get('wchar')})
+    record_profile(record)
+    return(None if timed_out else process.returncode,list(output))
+
+
+async def wait_child(pid):
+    """This waits for the child process pid to exit, without blocking the event loop, and returns its
+    exit status, its resource usage (see os.wait4) and its I/O counters (see read_proc_io). On Linux,
+    the kernel signals the exit through a pidfd, and the I/O counters are read before the process is
+    reaped, while they still exist. Elsewhere, the process is checked twice per second."""
+    import asyncio
+    import os
+    io = dict()
+    if hasattr(os,'pidfd_open') and hasattr(os,'waitid'):
+        exited = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:#E.g. on kernels older than 5.3.
+            pidfd = None
+        if pidfd != None:
+            loop.add_reader(pidfd,exited.set)
+            try:
+                await exited.wait()
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+        else:
+            while os.waitid(os.P_PID,pid,os.WEXITED|os.WNOHANG|os.WNOWAIT) == None:
+                await asyncio.sleep(0.5)
+        io = read_proc_io(pid)
+        pid,status,usage = os.wait4(pid,0)
+        return(status,usage,io)
+    while True:
+        done,status,usage = os.wait4(pid,os.WNOHANG)
+        if done != 0:
+            return(status,usage,io)
+        await asyncio.sleep(0.5)
+
+
+async def decompress_inputs(sof_file,workdir):
+    """This decompresses the compressed files (see COMPRESSED_SUFFIXES) listed in sof_file into
+    workdir/inputs, all at the same time (up to one per core), and writes a copy of sof_file in
+    workdir that points at the decompressed files. Returns the sof file to run esorex on: the copy,
+    or sof_file itself if nothing is compressed. Only the frames that the recipe needs are
+    decompressed, and they should be removed as soon as it is done (see remove_inputs), so that the
+    extra disk space is only needed for the recipes that are running."""
+    import asyncio
+    import os
+    entries = read_sof(sof_file)
+    compressed = [path for path,tag in entries if path.endswith(tuple(COMPRESSED_SUFFIXES))]
+    if len(compressed) == 0:
+        return(sof_file)
+    os.makedirs(workdir/'inputs',exist_ok=True)
+    targets = {path:workdir/'inputs'/(frame_name(path)+'.fits') for path in compressed}
+    slots = asyncio.Semaphore(os.cpu_count() or 1)
+
+    async def decompress(path):
+        async with slots:
+            await decompress_file(path,targets[path])
+
+    print(f'---Decompressing {len(compressed)} files for {os.path.basename(sof_file)}.')
+    await asyncio.gather(*[decompress(path) for path in compressed])
+    write_sof(workdir/os.path.basename(sof_file),[str(targets.get(path,path))+' '+tag for path,tag in entries])
+    return(workdir/os.path.basename(sof_file))
+
+
+async def decompress_file(path,target):
+    """This decompresses the file at path to target. Files made by gzip or unix compress are decompressed
+    by gzip (in a process of its own, so that many can run in parallel), or by fits_blocks if gzip is
+    not installed. fpack files are decompressed by funpack, or with astropy if that is not installed.
+    The decompressed file gets the modification time of path."""
+    import asyncio
     import os
-    os.system('rm -rf *fits *.log *.dump')
+    import shutil
+    if path.endswith('.fz') and shutil.which('funpack') != None:
+        command = ['funpack','-S',path]
+    elif path.endswith(('.gz','.Z')) and shutil.which('gzip') != None:
+        command = ['gzip','-dc',path]
+    else:
+        command = None
+    if command != None:
+        with open(str(target)+'.tmp','wb') as f:
+            if not await run_pipeline([command],output=f):
+                raise RuntimeError(f'Could not decompress {path}.')
+    elif path.endswith('.fz'):
+        await asyncio.to_thread(funpack_astropy,path,str(target)+'.tmp')
+    else:
+        def copy():
+            with open(str(target)+'.tmp','wb') as f:
+                for block in fits_blocks(path):
+                    f.write(block)
+        await asyncio.to_thread(copy)
+    stat = os.stat(path)
+    os.utime(str(target)+'.tmp',ns=(stat.st_atime_ns,stat.st_mtime_ns))
+    os.replace(str(target)+'.tmp',target)
+
+
+def funpack_astropy(path,target):
+    """This decompresses an fpack file (path) to target with astropy, for when funpack is not installed."""
+    try:
+        from astropy.io import fits
+    except ImportError:
+        raise RuntimeError(f'Decompressing {path} needs funpack (from CFITSIO) or astropy.')
+    with fits.open(path) as hdul:
+        hdus = [fits.PrimaryHDU(data=hdul[0].data,header=hdul[0].header)]
+        for hdu in hdul[1:]:
+            if isinstance(hdu,fits.CompImageHDU):
+                hdu = fits.ImageHDU(data=hdu.data,header=hdu.header)
+            hdus.append(hdu)
+        fits.HDUList(hdus).writeto(target,output_verify='silentfix')
+
+
+def remove_inputs(workdir):
+    """This removes the files that decompress_inputs decompressed into workdir."""
+    import shutil
+    shutil.rmtree(workdir/'inputs',ignore_errors=True)
+
+
+def read_proc_io(pid):
+    """This reads the I/O counters of a process (including its children that it has waited for) from
+    /proc/pid/io, e.g. read_bytes and write_bytes, which count what was actually fetched from and sent
+    to storage, and rchar and wchar, which count all bytes passed through read and write calls.
+    Returns an empty dictionary if they are not available (e.g. not on Linux)."""
+    io = dict()
+    try:
+        with open(f'/proc/{pid}/io','r') as f:
+            for line in f:
+                key,value = line.split(':')
+                io[key] = int(value)
+    except (OSError,ValueError):
+        pass
+    return(io)
+
+
+def collect_products(workdir,products):
+    """This moves the products of a recipe out of its scratch folder. products is a list of pairs of
+    (file name written by esorex, destination path). All products are checked before any of them is
+    moved, so that a recipe that failed does not leave half of its products behind. They are moved
+    with transfer_file, and the destination folders are flushed to disk once, after the last one."""
+    import os
+    missing = [name for name,destination in products if not os.path.isfile(os.path.join(workdir,name))]
+    if len(missing) > 0:
+        raise FileNotFoundError(f"The recipe in {workdir} did not produce {', '.join(missing)}. "
+            "Its log file and any other output are left there for inspection.")
+    for name,destination in products:
+        transfer_file(os.path.join(workdir,name),destination,sync=False)
+    for folder in set([destination.parent for name,destination in products]):
+        sync_folder(folder)
+
+
+def clean_trash(workdir):
+    """This program deletes the scratch folder of a recipe, including any left-over files, after the
+    products have been moved out of it. The folder is first renamed, which is atomic, so that it
+    disappears in one go even if the deletion itself is interrupted."""
+    import os
+    import shutil
+    trash = workdir.parent/('.trash_'+workdir.name)
+    os.rename(workdir,trash)
+    shutil.rmtree(trash)
+
+
+async def execute_recipe(outpath,name,cascade=CASCADE):
+    """This executes the recipe called name in the calibration cascade: it checks the files in its sof
+    file, runs esorex in a new scratch folder, collects the products that the cascade declares for it
+    (and its log file) into outpath, and then removes the scratch folder. Each recipe runs in its own
+    scratch folder, so recipes that do not depend on each other can run at the same time. The products
+    are moved in a separate thread, as copying them to another disk can take a while. Compressed
+    input files are decompressed into the scratch folder first, and removed when esorex is done
+    (see decompress_inputs)."""
+    import asyncio
+    recipe = cascade[name]
+    print(f"==========>>>>> {recipe['title']} <<<<<==========")
+    check_files_exist(outpath/recipe['sof'])
+    workdir=scratch_dir(recipe['recipe'])
+    try:
+        sof_file = await decompress_inputs(outpath/recipe['sof'],workdir)
+        await run_esorex(recipe['recipe'],sof_file,workdir,options=recipe['options'],label=name)
+    finally:
+        remove_inputs(workdir)
+    await asyncio.to_thread(collect_products,workdir,[(i,outpath/i) for i in recipe['outputs']]+[('esorex.log',outpath/recipe['log'])])
+    clean_trash(workdir)
+
+
+def read_sof(sof_file):
+    """This reads a sof file and returns a list of (filename,tag) pairs, one for each line."""
+    entries=[]
+    for line in open(sof_file,'r').read().splitlines():
+        if len(line.split()) == 0:
+            continue
+        if len(line.split()) > 2:#If there are spaces in the main path (DONT DO THIS) then we split on the .fits extension instead.
+            filename = line.split('.fits')[0]+'.fits'
+        else:
+            filename=line.split()[0]
+        entries.append((filename,line.split()[-1]))
+    return(entries)
 
 
 def check_files_exist(sof_file):
     "This program reads the sof file prior to execution of the recipe, to make sure that all the dependent files actually exist. This is to prevent the recipe running for 3 hours and then crashing due to a missing file or a wrongly spelled filename somewhere. If the tag is spelled wrongly, well then hopefully the recipe itself will crash at the start."""
-    import csv
     import os
     import sys
 
 
-    f=open(sof_file,'r').read().splitlines()
-    for line in f:
-        if len(line.split()) > 2:#If there are spaces in the main path (DONT DO THIS) then we split on the .fits extension instead.
-            filename = line.split('.fits')[0]+'.fits'
-        else:
-            filename=line.split()[0]
+    for filename,tag in read_sof(sof_file):
         exists=os.path.isfile(filename)
         if exists != True:
             print(f"ERROR IN RECIPE PATH FILE: {filename} is required for {str(sof_file)} but it doesn't exist. Check:")
@@ -773,223 +1283,1825 @@ def check_files_exist(sof_file):
 
 
     #==============================================================================================#
+    #The following functions implement a cache of calibration products that can be shared between
+    #runs and output folders. A recipe is identified by a hash of its sof file (see cache_key), and
+    #if the cache already holds the products of an identical recipe call, these are copied (or hard-
+    #linked) into the output folder instead of running esorex again.
     #==============================================================================================#
-    #What follows are the wrappers for the esorex recipes. These are executed one by one when
-    #calling this script, all the way at the end of this file.
+
+
+def file_sha256(filename):
+    """This returns the sha256 hash of the contents of filename."""
+    import hashlib
+    digest = hashlib.sha256()
+    with open(filename,'rb') as f:
+        for chunk in iter(lambda: f.read(2**24),b''):
+            digest.update(chunk)
+    return(digest.hexdigest())
+
+
+def cache_key(recipe,sof_file,options=[],checksum=False,extra=[],retired={}):
+    """This computes the key under which the products of a recipe are cached. It is a hash of the
+    esorex recipe name, its options and, for every file in the sof file (plus the (filename,tag)
+    pairs in extra), its tag, file name, size and modification time. If checksum is True, the contents of the files are hashed instead of their
+    modification times, which is slower but robust against files that were copied or touched.
+    Only the file name (not the folder) enters the hash, so that runs in different output folders
+    can share products: products restored from the cache keep the modification time they had when
+    they were first made. Files that were removed by retire_product are hashed from what it recorded
+    about them in the manifest (retired), so that the key does not change when they are gone."""
+    import hashlib
+    import os
+    key = hashlib.sha256()
+    key.update(recipe.encode())
+    key.update(' '.join(options).encode())
+    for filename,tag in sorted(read_sof(sof_file)+list(extra)):
+        if filename in retired:
+            size,mtime_ns,digest = [retired[filename].get(i) for i in ['size','mtime_ns','sha256']]
+        else:
+            stat = os.stat(filename)
+            size,mtime_ns = stat.st_size,stat.st_mtime_ns
+            digest = file_sha256(filename) if checksum else None
+        key.update(f'\n{tag} {os.path.basename(filename)} {size} '.encode())
+        key.update(str(digest if checksum else mtime_ns).encode())
+    return(key.hexdigest())
+
+
+def link_or_copy(source,destination):
+    """This places a copy of source at destination, replacing destination if it already exists.
+    A hard link is used where possible, and a real copy otherwise (e.g. across file systems)."""
+    import os
+    import shutil
+    tmp = str(destination)+'.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source,tmp)
+    except OSError:
+        shutil.copy2(source,tmp)
+    os.replace(tmp,destination)
+
+
+def cache_fetch(cache_dir,key,outpath):
+    """This copies the products stored under key in the cache to outpath. Returns False if the cache
+    holds no (complete) entry for this key, and True otherwise."""
+    import json
+    import os
+    from pathlib import Path
+    entry = Path(cache_dir)/key
+    if not os.path.isfile(entry/'entry.json'):
+        return(False)
+    with open(entry/'entry.json','r') as f:
+        files = json.load(f)['files']
+    for filename in files:
+        if not os.path.isfile(entry/filename):
+            return(False)
+    for filename in files:
+        link_or_copy(entry/filename,Path(outpath)/filename)
+    os.utime(entry/'entry.json')#Marks the entry as recently used.
+    return(True)
+
+
+def cache_store(cache_dir,key,recipe,files,max_size):
+    """This stores files (paths of products of a recipe call) in the cache under key, and then
+    evicts the least recently used entries until the cache is smaller than max_size bytes.
+    The entry is assembled in a temporary folder and renamed into place, so that other processes that
+    share the cache never see a half-written entry."""
+    import json
+    import os
+    import shutil
+    import tempfile
+    from pathlib import Path
+    cache_dir = Path(cache_dir)
+    os.makedirs(cache_dir,exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix='.incoming_',dir=cache_dir))
+    size = 0
+    for filename in files:
+        link_or_copy(filename,tmp/os.path.basename(filename))
+        size += os.path.getsize(filename)
+    with open(tmp/'entry.json','w') as f:
+        json.dump({'recipe':recipe,'files':[os.path.basename(i) for i in files],'size':size},f,indent=1)
+    try:
+        os.rename(tmp,cache_dir/key)
+    except OSError:#Another run stored the same products in the mean time.
+        shutil.rmtree(tmp)
+    cache_evict(cache_dir,max_size)
+
+
+def cache_evict(cache_dir,max_size):
+    """This deletes the least recently used entries from the cache until the total size of the
+    entries is below max_size bytes."""
+    import json
+    import os
+    import shutil
+    from pathlib import Path
+    entries = []
+    for entry in Path(cache_dir).iterdir():
+        try:
+            with open(entry/'entry.json','r') as f:
+                size = json.load(f)['size']
+            entries.append((os.path.getmtime(entry/'entry.json'),size,entry))
+        except (OSError,ValueError,KeyError):#Entries that are still being written.
+            continue
+    total = sum([e[1] for e in entries])
+    for last_used,size,entry in sorted(entries):
+        if total <= max_size:
+            break
+        print(f'---Removing {entry.name} ({size/1024**3:.1f} GB) from the calibration cache.')
+        shutil.rmtree(entry,ignore_errors=True)
+        total -= size
+
+
     #==============================================================================================#
+    #The following functions keep track of the progress of a run in a manifest file in the output
+    #folder, which records for each recipe and each science exposure whether it finished, how long
+    #it took, a hash of its inputs (see cache_key) and the files it produced. When resuming a run,
+    #steps that finished with the same inputs and whose products are still there are skipped.
     #==============================================================================================#
 
 
+MANIFEST_LOCK = threading.Lock()#Recipes and exposures that run in parallel update the same manifest.
 
 
+def manifest_load(outpath):
+    """This reads the manifest of the run in outpath, or returns an empty one if there is none."""
+    import json
+    import os
+    if not os.path.isfile(outpath/'manifest.json'):
+        return({'recipes':{},'exposures':{},'retired':{}})
+    with open(outpath/'manifest.json','r') as f:
+        return(json.load(f))
 
 
-def master_bias(outpath):
-    """This is a wrapper for the mbias recipe."""
+def manifest_update(outpath,section,name,**fields):
+    """This sets fields (e.g. status='done') of the entry called name in a section ('recipes',
+    'exposures' or 'retired') of the manifest. The manifest is replaced in one go, so a crash can not leave a
+    half-written file behind."""
+    import json
     import os
-    print('==========>>>>> CREATING MASTER BIAS<<<<<==========')
-    check_files_exist(outpath/"BIAS.txt")
-    os.system("esorex espdr_mbias "+str(outpath/"BIAS.txt"))
-    move_to('ESPRESSO_master_bias.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_masterbias.log')
-    move_to('ESPRESSO_master_bias_res.fits',outpath)
-
+    with MANIFEST_LOCK:
+        manifest = manifest_load(outpath)
+        entry = manifest.setdefault(section,{}).setdefault(name,{})
+        entry.update(fields)
+        with open(outpath/'manifest.json.tmp','w') as f:
+            json.dump(manifest,f,indent=1)
+        os.replace(outpath/'manifest.json.tmp',outpath/'manifest.json')
+
+
+def manifest_forget(outpath,section,names):
+    """This removes the entries called names from a section of the manifest."""
+    import json
+    import os
+    with MANIFEST_LOCK:
+        manifest = manifest_load(outpath)
+        if not any([name in manifest.get(section,{}) for name in names]):
+            return
+        for name in names:
+            manifest[section].pop(name,None)
+        with open(outpath/'manifest.json.tmp','w') as f:
+            json.dump(manifest,f,indent=1)
+        os.replace(outpath/'manifest.json.tmp',outpath/'manifest.json')
+
+
+def manifest_done(outpath,section,name,input_hash):
+    """This checks whether the step called name has finished in a previous run with the same inputs,
+    and whether all the files it produced still exist with the same size, or were removed on purpose
+    because nothing needed them anymore (see retire_product)."""
+    import os
+    with MANIFEST_LOCK:
+        manifest = manifest_load(outpath)
+    entry = manifest.get(section,{}).get(name)
+    if entry == None or entry.get('status') != 'done' or entry.get('input_hash') != input_hash:
+        return(False)
+    for filename,size in entry['outputs'].items():
+        if filename in manifest.get('retired',{}):
+            continue
+        if not os.path.isfile(filename) or os.path.getsize(filename) != size:
+            print(f'---{filename} produced by {name} is missing or has changed. Running it again.')
+            return(False)
+    return(True)
+
+
+async def run_step(outpath,section,name,input_hash,function,outputs,resume=False):
+    """This awaits function (a coroutine function that runs a recipe or reduces an exposure) and records its progress in
+    the manifest, including the sizes of the files listed in outputs, which function produces. If
+    function returns a Future (see background_transfer), the step is only marked as done once that
+    has finished. If resume is True and the step already finished with the same inputs, it is skipped."""
+    import datetime
+    import os
+    import time
+    from concurrent.futures import Future
+    if resume and manifest_done(outpath,section,name,input_hash):
+        print(f'---Skipping {name}, which was completed in a previous run.')
+        return
+    start = time.time()
+    manifest_update(outpath,section,name,status='running',input_hash=input_hash,outputs={},
+        start=datetime.datetime.now().isoformat(timespec='seconds'))
+    def finish(result):
+        if result.exception() != None:
+            manifest_update(outpath,section,name,status='failed',duration=time.time()-start)
+            return
+        manifest_update(outpath,section,name,status='done',duration=time.time()-start,
+            end=datetime.datetime.now().isoformat(timespec='seconds'),
+            outputs={str(i):os.path.getsize(i) for i in outputs})
+        manifest_forget(outpath,'retired',[str(i) for i in outputs])#Made again, so they are there now.
+    try:
+        result = await function()
+    except BaseException:
+        manifest_update(outpath,section,name,status='failed',duration=time.time()-start)
+        raise
+    if isinstance(result,Future):#The products are still being collected, see background_transfer.
+        result.add_done_callback(finish)
+        return
+    done = Future()
+    done.set_result(result)
+    finish(done)
+
+
+async def run_recipe(name,outpath,cascade,cache=None,resume=False):
+    """This runs the recipe called name from the cascade, unless the cache (a dictionary with the
+    cache folder 'path', its maximum size in bytes 'max_size' and the 'checksum' switch of cache_key)
+    already holds its products. Freshly made products are added to the cache. Progress is recorded
+    in the manifest, and if resume is True, recipes that were completed before are skipped. Hashing
+    and copying files is done in separate threads, so that other recipes keep running meanwhile."""
+    import asyncio
+    from pathlib import Path
+    recipe = cascade[name]
+    outputs = [Path(outpath)/i for i in recipe['outputs']+[recipe['log']]]
+    checksum = cache != None and cache['checksum']
+    if resume:#Inputs are only removed once all the recipes that need them are done (see retire_product).
+        with MANIFEST_LOCK:
+            manifest = manifest_load(outpath)
+        retired = manifest.get('retired',{})
+        removed = [path for path,tag in read_sof(outpath/recipe['sof']) if path in retired]
+        if len(removed) > 0:
+            key = await asyncio.to_thread(cache_key,recipe['recipe'],outpath/recipe['sof'],options=recipe['options'],
+                checksum=checksum,retired=retired)
+            entry = manifest['recipes'].get(name,{})
+            if entry.get('status') == 'done' and entry.get('input_hash') == key:
+                print(f'---Skipping {name}, which was completed in a previous run (some of its inputs have been removed since).')
+                return
+            missing = await asyncio.to_thread(restore_products,outpath,removed)
+            if len(missing) > 0:
+                print(f'ERROR: {name} has to be run again, but {len(missing)} of its inputs were deleted by --gc. They '
+                    'will be made again when the script is run again with --resume:')
+                print(missing)
+                raise RuntimeError(f'The inputs of {name} were deleted.')
+    check_files_exist(outpath/recipe['sof'])
+    key = await asyncio.to_thread(cache_key,recipe['recipe'],outpath/recipe['sof'],options=recipe['options'],checksum=checksum)
+
+    async def execute():
+        if cache != None and await asyncio.to_thread(cache_fetch,cache['path'],key,outpath):
+            print(f'==========>>>>> RESTORED {name} FROM THE CALIBRATION CACHE ({key[0:12]}) <<<<<==========')
+            return
+        await execute_recipe(outpath,name,cascade)
+        if cache != None:
+            await asyncio.to_thread(cache_store,cache['path'],key,recipe['recipe'],outputs,cache['max_size'])
+
+    await run_step(outpath,'recipes',name,key,execute,outputs,resume=resume)
+
+
+def recipe_dependencies(cascade):
+    """This works out which recipes each recipe in the cascade needs to wait for, by matching the
+    products it consumes to the recipes that produce them. Returns a dictionary of sets."""
+    producers = dict()
+    for name in cascade:
+        for product in cascade[name]['outputs']:
+            if product in producers:
+                raise ValueError(f"{product} is produced by both {producers[product]} and {name}.")
+            producers[product] = name
+    dependencies = dict()
+    for name in cascade:
+        products = [i[0] for i in cascade[name]['inputs'] if not isinstance(i,str)]
+        dependencies[name] = set([producers[p] for p in products if p in producers])
+    return(dependencies)
+
+
+#What happens to the intermediate products of the cascade once all the recipes that read them are done
+#('off', 'delete' or 'compress'), and the filename patterns of products that are always kept (see the
+#--gc and --keep options). The products that the science recipe needs are never removed.
+RETENTION = {'mode':'off','keep':[]}
+
+#No new jobs are started while less than min_free bytes are free on any of the folders in paths (see the
+#--min_free option). If nothing is running, the disk is checked again every interval seconds.
+DISK_BUDGET = {'min_free':None,'paths':[],'interval':30}
+
+
+def low_disk_space():
+    """This returns the first folder of DISK_BUDGET that has less than its min_free bytes of free space,
+    together with the number of bytes that are free on it, or None if there is enough space everywhere."""
+    import os
+    import shutil
+    if DISK_BUDGET['min_free'] == None:
+        return(None)
+    for path in DISK_BUDGET['paths']:
+        if os.path.isdir(path):
+            free = shutil.disk_usage(path).free
+            if free < DISK_BUDGET['min_free']:
+                return((path,free))
+    return(None)
+
+
+def restore_products(outpath,filenames):
+    """This brings back the products in filenames that were compressed by retire_product, because a
+    recipe that reads them has to be run again (see run_recipe). They are all removed from the retired
+    products in the manifest, so that the recipes that made the ones that were deleted are run again
+    when resuming. Returns the ones that were deleted."""
+    import gzip
+    import os
+    import shutil
+    missing = []
+    for filename in filenames:
+        if os.path.isfile(str(filename)+'.gz'):
+            with gzip.open(str(filename)+'.gz','rb') as f_in, open(str(filename)+'.tmp','wb') as f_out:
+                shutil.copyfileobj(f_in,f_out)
+            shutil.copystat(str(filename)+'.gz',str(filename)+'.tmp')
+            os.replace(str(filename)+'.tmp',filename)
+            os.remove(str(filename)+'.gz')
+            print(f'---Decompressed {os.path.basename(filename)}, which is needed again.')
+        elif not os.path.isfile(filename):
+            missing.append(filename)
+    manifest_forget(outpath,'retired',[str(i) for i in filenames])
+    return(missing)
+
+
+async def retire_product(filename):
+    """This deletes or compresses (with gzip, to filename.gz) an intermediate product of the cascade
+    once nothing needs it anymore, depending on RETENTION. This is recorded in the manifest of its folder,
+    so that the recipe that made it is not run again to bring it back when resuming (see manifest_done)."""
+    import asyncio
+    import gzip
+    import os
+    import shutil
+    from pathlib import Path
+    filename = Path(filename)
+    if not os.path.isfile(filename):
+        return
+    stat = os.stat(filename)
+    digest = await asyncio.to_thread(file_sha256,filename)#For cache_key, once the file is gone.
+    if RETENTION['mode'] == 'delete':
+        os.remove(filename)
+    elif shutil.which('gzip') == None or not await run_pipeline([['gzip','-f',str(filename)]]):
+        def compress():
+            with open(filename,'rb') as f_in, gzip.open(str(filename)+'.gz','wb') as f_out:
+                shutil.copyfileobj(f_in,f_out)
+            shutil.copystat(filename,str(filename)+'.gz')
+            os.remove(filename)
+        await asyncio.to_thread(compress)
+    manifest_update(filename.parent,'retired',str(filename),mode=RETENTION['mode'],size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,sha256=digest)
+    print(f'---{"Deleted" if RETENTION["mode"] == "delete" else "Compressed"} {filename.name}, which is not needed anymore.')
+
+
+def run_jobs(jobs,max_workers=1,memory_budget=None):
+    """This runs a set of jobs that depend on each other. jobs is a dictionary that gives, for each
+    job name, the coroutine function to call ('function', without arguments), the set of names of the
+    jobs that need to finish first ('after') and the esorex recipe that it runs ('recipe'). A job is started
+    as soon as all of these have finished, with at most max_workers jobs running at the same time, in
+    the order in which they are listed. If a memory_budget (in bytes) is given, a job is only started
+    if its expected memory use ('memory' if given, otherwise see expected_memory) fits in what the running jobs leave of the
+    budget, so that parallel recipes do not drive the machine into swap. A job is always started if
+    nothing else is running, even if it is expected to need more than the budget. Likewise, no new
+    jobs are started while the free disk space is below DISK_BUDGET['min_free']. Products that are
+    listed as 'intermediates' of a job are removed or compressed (see RETENTION) as soon as the jobs
+    that read them (in their sof file, or 'extra') have finished. If a job fails, no
+    new jobs are started, and the error is raised once the jobs that are still running have finished.
+    Before returning, this waits for the products of the jobs that are still being collected (see
+    background_transfer)."""
+    import asyncio
+    asyncio.run(schedule_jobs(jobs,max_workers=max_workers,memory_budget=memory_budget))
+    finish_transfers()
+
+
+async def schedule_jobs(jobs,max_workers=1,memory_budget=None):
+    """This is the event loop of run_jobs. All jobs run as tasks in a single thread, as they spend
+    nearly all their time waiting for their esorex processes (see run_esorex). If this is cancelled
+    (e.g. by Ctrl-C), the running jobs are cancelled too, which stops their esorex processes."""
+    import asyncio
+    import sys
 
-def master_dark(outpath):
-    """This is a wrapper for the mdark recipe."""
+    pending = list(jobs.keys())
+    running = dict()
+    reserved = dict()
+    done = set()
+    failed = None
+    producer = {str(path):name for name in jobs for path in jobs[name].get('intermediates',[])}
+    readers = {path:set() for path in producer}#The jobs that still need to read each intermediate product.
+    inputs = {name:[] for name in jobs}
+    for name in jobs:
+        if len(producer) > 0 and 'sof' in jobs[name]:
+            inputs[name] = [str(path) for path,tag in read_sof(jobs[name]['sof'])+jobs[name].get('extra',[])]
+    for name in jobs:
+        for path in inputs[name]:
+            if path in readers:
+                readers[path].add(name)
+    retiring = []
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            low = low_disk_space()
+            if low != None and len(running) == 0 and failed == None:
+                print(f'WARNING: Only {low[1]/1024**3:.1f} GB is free on {low[0]}. Waiting for disk space before starting {pending[0]}.')
+                await asyncio.sleep(DISK_BUDGET['interval'])
+                continue
+            for name in list(pending):
+                if failed != None or low != None or not (jobs[name]['after'] <= done and len(running) < max_workers):
+                    continue
+                memory = jobs[name].get('memory',expected_memory(jobs[name].get('recipe')))
+                if memory_budget != None and len(running) > 0 and sum(reserved.values())+memory > memory_budget:
+                    continue
+                pending.remove(name)
+                running[asyncio.ensure_future(jobs[name]['function']())] = name
+                reserved[name] = memory
+            if len(running) == 0:
+                if failed != None:
+                    break
+                print(f'ERROR: The jobs {pending} depend on each other and can never be started.')
+                sys.exit()
+            finished,not_finished = await asyncio.wait(running,return_when=asyncio.FIRST_COMPLETED)
+            for job in finished:
+                name = running.pop(job)
+                del reserved[name]
+                if job.exception() != None:
+                    if failed == None:
+                        print(f'ERROR: {name} failed. Not starting any new jobs, and waiting for the {len(running)} that are still running.')
+                        failed = job.exception()
+                    else:
+                        print(f'ERROR: {name} failed as well: {job.exception()}')
+                    continue
+                done.add(name)
+                for path in inputs[name]+[str(i) for i in jobs[name].get('intermediates',[])]:
+                    if path in readers:
+                        readers[path].discard(name)
+                        if len(readers[path]) == 0 and producer[path] in done:
+                            del readers[path]
+                            retiring.append(asyncio.ensure_future(retire_product(path)))
+    finally:
+        for job in running:
+            job.cancel()
+        if len(running) > 0:
+            await asyncio.wait(running)
+        if len(retiring) > 0:
+            await asyncio.wait(retiring)
+    if failed != None:
+        raise failed
+
+
+def cascade_jobs(outpath,cascade=CASCADE,cache=None,resume=False,prefix=''):
+    """This turns the recipes of the calibration cascade into jobs for run_jobs, each of which waits
+    for the recipes whose products it needs. The job names are the recipe names, preceded by prefix.
+    Each job also lists its sof file and its products, which are used by plan_jobs, and the products
+    that may be removed once the recipes that need them are done (see RETENTION)."""
+    import fnmatch
+    import functools
+    jobs = dict()
+    science = [i[0] for i in SCIENCE_RECIPE['inputs'] if not isinstance(i,str)]
+    for name,after in recipe_dependencies(cascade).items():
+        jobs[prefix+name] = {'function':functools.partial(run_recipe,name,outpath,cascade,cache,resume),
+            'after':set([prefix+i for i in after]),'recipe':cascade[name]['recipe'],
+            'sof':outpath/cascade[name]['sof'],'products':[outpath/i for i in cascade[name]['outputs']]}
+        if RETENTION['mode'] != 'off':
+            jobs[prefix+name]['intermediates'] = [outpath/i for i in cascade[name]['outputs'] if i not in science and
+                not any([fnmatch.fnmatch(i,pattern) for pattern in RETENTION['keep']])]
+    return(jobs)
+
+
+def run_cascade(outpath,cascade=CASCADE,max_workers=1,cache=None,resume=False,memory_budget=None):
+    """This runs the recipes of the calibration cascade. A recipe is started as soon as all the
+    recipes that it depends on have finished, with at most max_workers recipes running at the same
+    time. With max_workers=1 the recipes are run one by one, in the order of the cascade. If a cache
+    is given (see run_recipe), recipes whose products are in the cache are not run again, and if resume
+    is True, recipes that were completed in a previous run are skipped. See run_jobs for the
+    memory_budget."""
     import os
-    print('==========>>>>> CREATING MASTER DARK AND HOT PIXEL MAP<<<<<==========')
-    check_files_exist(outpath/"DARK.txt")
-    os.system("esorex espdr_mdark "+str(outpath/"DARK.txt"))
-    move_to('ESPRESSO_master_dark.fits',outpath)
-    move_to('ESPRESSO_hot_pixels.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_masterdark.log')
-    clean_trash()
+    if cache != None and os.path.isdir(cache['path']):#In case the size limit was lowered since the last run.
+        cache_evict(cache['path'],cache['max_size'])
+    run_jobs(cascade_jobs(outpath,cascade=cascade,cache=cache,resume=resume),max_workers=max_workers,memory_budget=memory_budget)
+
+
+def job_order(jobs):
+    """This returns the names of the jobs in the order in which run_jobs starts them if it runs them
+    one by one. Exits if some of the jobs depend on each other in a circle."""
+    import sys
+    pending = list(jobs.keys())
+    order = []
+    while len(pending) > 0:
+        ready = [name for name in pending if jobs[name]['after'] <= set(order)]
+        if len(ready) == 0:
+            print(f'ERROR: The jobs {pending} depend on each other and can never be started.')
+            sys.exit()
+        order.append(ready[0])
+        pending.remove(ready[0])
+    return(order)
+
+
+#The wall time (in seconds) that each recipe is assumed to take before it has been run on this machine,
+#for --plan. These are rough numbers for a typical night of 2x1 data on a laptop.
+RUNTIME_DEFAULTS = {'espdr_mbias':120.0,'espdr_mdark':180.0,'espdr_led_ff':300.0,'espdr_orderdef':120.0,'espdr_mflat':900.0,
+    'espdr_wave_FP':300.0,'espdr_wave_THAR':600.0,'espdr_cal_contam':120.0,'espdr_cal_eff_ab':150.0,'espdr_cal_flux':150.0,
+    'espdr_sci_red':600.0}
 
 
-def bad_pixels(outpath):
-    """This is a wrapper for the led_ff recipe."""
+def load_runtimes(report_file):
+    """This reads the profiling report of earlier runs (see write_profile_report) and returns the median
+    wall time (in seconds) of the successful runs of each recipe, to estimate how long jobs will take.
+    Returns an empty dictionary if there is no report yet."""
+    import json
     import os
-    print('==========>>>>> CREATING BAD PIXEL MAP<<<<<==========')
-    check_files_exist(outpath/"LED.txt")
-    os.system("esorex espdr_led_ff "+str(outpath/"LED.txt"))
-    move_to('ESPRESSO_bad_pixels.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_badpixels.log')
-    clean_trash()
+    import numpy as np
+    if not os.path.isfile(report_file):
+        return(dict())
+    with open(report_file,'r') as f:
+        records = [r for r in json.load(f)['records'] if r.get('returncode') == 0]
+    recipes = set([r['recipe'] for r in records])
+    return({recipe:float(np.median([r['wall'] for r in records if r['recipe'] == recipe])) for recipe in recipes})
+
+
+def plan_jobs(jobs,runtimes=dict()):
+    """This is the dry run of run_jobs. It prints the jobs in the order in which they would be started,
+    with their expected run times (runtimes gives the typical wall time of each recipe, see load_runtimes,
+    and RUNTIME_DEFAULTS for the recipes that are not in there, which are marked with ~),
+    and checks that every file in the sof file of each job (and its 'extra' sof lines) either exists
+    already or is one of the 'products' of a job that finishes before it starts. Nothing is run.
+    Returns a list of the problems that were found, which are also printed."""
+    import os
+    order = job_order(jobs)
+    producers = dict()
+    for name in order:
+        for product in jobs[name].get('products',[]):
+            producers[str(product)] = name
+    upstream = dict()#All the jobs that finish before each job starts.
+    finish = dict()#The earliest time at which each job can be done, if there are enough workers.
+    problems = []
+    print('==========>>>>> EXECUTION PLAN <<<<<==========')
+    print(f'{"":>4}  {"job":<44}{"recipe":<18}{"expected [s]":>13}')
+    for i,name in enumerate(order):
+        job = jobs[name]
+        upstream[name] = set(job['after'])
+        for before in job['after']:
+            upstream[name] |= upstream[before]
+        runtime = runtimes.get(job.get('recipe'),RUNTIME_DEFAULTS.get(job.get('recipe')))
+        finish[name] = (runtime or 0.0)+max([finish[before] for before in job['after']],default=0.0)
+        estimate = '?' if runtime == None else f'{runtime:.0f}' if job.get('recipe') in runtimes else f'~{runtime:.0f}'
+        print(f'{i+1:>4}  {name:<44}{str(job.get("recipe")):<18}{estimate:>13}')
+        if not 'sof' in job:
+            continue
+        if not os.path.isfile(job['sof']):
+            problems.append(f'{name}: The sof file {job["sof"]} does not exist.')
+            continue
+        for filename,tag in read_sof(job['sof'])+job.get('extra',[]):
+            if str(filename) in producers and producers[str(filename)] in upstream[name]:
+                continue
+            if str(filename) in producers:
+                problems.append(f'{name}: {filename} ({tag}) is made by {producers[str(filename)]}, which does not finish before {name} starts.')
+            elif not os.path.isfile(filename):
+                problems.append(f'{name}: {filename} ({tag}) does not exist, and none of the recipes makes it.')
+    recipes = [jobs[name].get('recipe') for name in order]
+    unknown = sorted(set([str(recipe) for recipe in recipes if recipe not in runtimes]))
+    total = sum([runtimes.get(recipe,RUNTIME_DEFAULTS.get(recipe)) or 0.0 for recipe in recipes])
+    print(f'Expected run time: {total:.0f} s one by one, and at least {max(finish.values(),default=0.0):.0f} s with unlimited parallel jobs.')
+    if len(unknown) > 0:
+        print(f'No earlier runs of {", ".join(unknown)} in the profiling report, so rough defaults are used for these (marked ~).')
+    if len(problems) == 0:
+        print(f'All the files needed by the {len(order)} jobs exist or are made before they are needed.')
+    else:
+        print(f'ERROR: Found {len(problems)} problems:')
+        for problem in problems:
+            print('  '+problem)
+    return(problems)
 
 
-def orderdef(outpath):
-    """This is a wrapper for the orderdef recipe."""
+def available_memory():
+    """This returns the amount of memory (in bytes) that is available for starting new processes,
+    as reported by the MemAvailable field in /proc/meminfo. On systems without /proc (i.e. not Linux)
+    this falls back to the total amount of physical memory."""
     import os
-    print('==========>>>>> FIND ORDER TRACES<<<<<==========')
-    check_files_exist(outpath/"ORDERDEF.txt")
-    os.system("esorex espdr_orderdef "+str(outpath/"ORDERDEF.txt"))
-    move_to('ESPRESSO_ORDER_TABLE_A.fits',outpath)
-    move_to('ESPRESSO_ORDER_TABLE_B.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_orderdef.log')
-    clean_trash()
-
-def master_flat(outpath):
-    """This is a wrapper for the mflat recipe."""
+    try:
+        with open('/proc/meminfo','r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return(int(line.split()[1])*1024)
+    except OSError:
+        pass
+    return(os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES'))
+
+
+def auto_nproc(ram_per_job):
+    """This chooses how many science exposures can be reduced at the same time, given the number
+    of cores that this process is allowed to use and the amount of RAM (in GB) that a single call
+    to espdr_sci_red is expected to need (ram_per_job). At least one exposure is always run."""
     import os
-    print('==========>>>>> CREATE MASTER FLAT<<<<<==========')
-    check_files_exist(outpath/"FLAT.txt")
-    os.system("esorex espdr_mflat "+str(outpath/"FLAT.txt"))
-    move_to('ESPRESSO_ORDER_PROFILE_A.fits',outpath)
-    move_to('ESPRESSO_ORDER_PROFILE_B.fits',outpath)
-    move_to('ESPRESSO_BLAZE_A.fits',outpath)
-    move_to('ESPRESSO_BLAZE_B.fits',outpath)
-    move_to('ESPRESSO_FLAT_A.fits',outpath)
-    move_to('ESPRESSO_FLAT_B.fits',outpath)
-    move_to('ESPRESSO_background_map_A.fits',outpath)
-    move_to('ESPRESSO_background_map_B.fits',outpath)
-    move_to('ESPRESSO_spectrum_extracted_A.fits',outpath)
-    move_to('ESPRESSO_spectrum_extracted_B.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_mflat.log')
-    clean_trash()
-
-
-def wave_FP_FP(outpath):
-    """This is a wrapper for the wave_FP_FP recipe."""
+    if hasattr(os,'sched_getaffinity'):
+        n_cpu = len(os.sched_getaffinity(0))
+    else:
+        n_cpu = os.cpu_count()
+    n_ram = int(available_memory()/(ram_per_job*1024**3))
+    return(max(1,min(n_cpu,n_ram)))
+
+
+#The peak memory use (in GB) that each recipe is assumed to have before it has been measured on this
+#machine. espdr_mflat and espdr_sci_red are the heavy ones. These are deliberately on the high side.
+MEMORY_DEFAULTS = {'espdr_mbias':4.0,'espdr_mdark':4.0,'espdr_led_ff':4.0,'espdr_orderdef':4.0,'espdr_mflat':14.0,
+    'espdr_wave_FP':6.0,'espdr_wave_THAR':6.0,'espdr_cal_contam':6.0,'espdr_cal_eff_ab':6.0,'espdr_cal_flux':6.0,
+    'espdr_sci_red':10.0}
+#The measured peak memory use (in bytes) of the last few runs of each recipe, and the file they are kept in.
+MEMORY_PROFILE = {'file':None,'peaks':{}}
+MEMORY_LOCK = threading.Lock()
+
+
+def load_memory_profile(filename):
+    """This loads the measured peak memory use of previous recipe runs from filename (a json file), and
+    makes sure that new measurements are saved there as well."""
+    import json
     import os
-    print('==========>>>>> CREATE WAVE FP_FP <<<<<==========')
-    check_files_exist(outpath/'WAVE_FP_FP.txt')
-    os.system("esorex espdr_wave_FP "+str(outpath/"WAVE_FP_FP.txt"))
-    move_to('ESPRESSO_S2D_FP_FP_A.fits',outpath)
-    move_to('ESPRESSO_S2D_FP_FP_B.fits',outpath)
-    move_to('ESPRESSO_S2D_BLAZE_FP_FP_A.fits',outpath)
-    move_to('ESPRESSO_S2D_BLAZE_FP_FP_B.fits',outpath)
-    move_to('ESPRESSO_FP_SEARCHED_LINE_TABLE_A.fits',outpath)
-    move_to('ESPRESSO_FP_SEARCHED_LINE_TABLE_B.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_wave_fp_fp.log')
-    clean_trash
-
-
-def wave_FP_TH(outpath):
-    """This is a wrapper for the wave_FP_THAR recipe."""
+    with MEMORY_LOCK:
+        MEMORY_PROFILE['file'] = filename
+        if os.path.isfile(filename):
+            with open(filename,'r') as f:
+                MEMORY_PROFILE['peaks'] = json.load(f)
+
+
+def record_memory(recipe,peak,keep=10):
+    """This adds the measured peak memory use (peak, in bytes) of a recipe run to the memory profile,
+    remembering the last keep measurements of each recipe, and saves the profile."""
+    import json
     import os
-    print('==========>>>>> CREATE WAVE FP_THAR<<<<<==========')
-    check_files_exist(outpath/'WAVE_FP_TH.txt')
-    os.system("esorex espdr_wave_THAR "+str(outpath/"WAVE_FP_TH.txt"))
-    move_to('ESPRESSO_AIR_DLL_MATRIX_B.fits',outpath)
-    move_to('ESPRESSO_AIR_WAVE_MATRIX_B.fits',outpath)
-    move_to('ESPRESSO_DLL_MATRIX_B.fits',outpath)
-    move_to('ESPRESSO_FP_FITTED_LINE_TABLE_B.fits',outpath)
-    move_to('ESPRESSO_LINE_TABLE_RAW_B.fits',outpath)
-    move_to('ESPRESSO_S2D_BLAZE_FP_THAR_A.fits',outpath)
-    move_to('ESPRESSO_S2D_BLAZE_FP_THAR_B.fits',outpath)
-    move_to('ESPRESSO_S2D_FP_THAR_A.fits',outpath)
-    move_to('ESPRESSO_S2D_FP_THAR_B.fits',outpath)
-    move_to('ESPRESSO_WAVE_MATRIX_B.fits',outpath)
-    move_to('ESPRESSO_WAVE_TABLE_B.fits',outpath)
-    move_to('ESPRESSO_THAR_LINE_TABLE_B.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_wave_fp_thar.log')
-    clean_trash
-
-def wave_TH_FP(outpath):
-    """This is a wrapper for the wave_THAR_FP recipe."""
+    with MEMORY_LOCK:
+        peaks = MEMORY_PROFILE['peaks'].setdefault(recipe,[])
+        peaks.append(int(peak))
+        del peaks[0:-keep]
+        if MEMORY_PROFILE['file'] != None:
+            with open(str(MEMORY_PROFILE['file'])+'.tmp','w') as f:
+                json.dump(MEMORY_PROFILE['peaks'],f,indent=1)
+            os.replace(str(MEMORY_PROFILE['file'])+'.tmp',MEMORY_PROFILE['file'])
+
+
+def expected_memory(recipe,margin=1.2):
+    """This returns the amount of memory (in bytes) that a run of recipe is expected to need: the
+    largest recently measured peak plus a safety margin, or the default from MEMORY_DEFAULTS if the
+    recipe has not been measured yet. Recipes that are not known at all are assumed to need nothing."""
+    with MEMORY_LOCK:
+        peaks = MEMORY_PROFILE['peaks'].get(recipe,[])
+    if len(peaks) > 0:
+        return(int(max(peaks)*margin))
+    return(int(MEMORY_DEFAULTS.get(recipe,0.0)*1024**3))
+
+
+#The resource usage of every esorex run of this session (see run_esorex), for the profiling report.
+PROFILE_RECORDS = []
+PROFILE_LOCK = threading.Lock()
+PROFILE_COLUMNS = ['run','label','recipe','start','wall','user','system','max_rss','read_bytes','write_bytes',
+    'rchar','wchar','returncode','host']
+
+
+def record_profile(record):
+    """This adds the resource usage of an esorex run to the profiling report of this session."""
+    with PROFILE_LOCK:
+        PROFILE_RECORDS.append(record)
+
+
+def esorex_version():
+    """This returns the version string printed by esorex, or None if it can not be determined."""
+    import subprocess
+    try:
+        output = subprocess.run(['esorex','--version'],capture_output=True,text=True,timeout=60).stdout
+    except (OSError,subprocess.SubprocessError):
+        return(None)
+    for line in output.splitlines():
+        if 'version' in line.lower():
+            return(line.strip())
+    return(None)
+
+
+def recipe_parameters(recipe):
+    """This returns the parameters of an esorex recipe, as listed by esorex --params, as a dictionary
+    of the allowed values of each parameter (e.g. ['on','off'], from the <on | off> in its description)
+    or None if any value is allowed. Returns None if esorex can not list them (e.g. if it is not
+    installed here, or the recipe is not known)."""
+    import re
+    import subprocess
+    try:
+        output = subprocess.run(['esorex','--params',recipe],capture_output=True,text=True,timeout=60).stdout
+    except (OSError,subprocess.SubprocessError):
+        return(None)
+    descriptions = dict()
+    name = None
+    for line in output.splitlines():
+        match = re.match(r'\s*--([\w.\-]+)\s*:(.*)',line)
+        if match != None:
+            name = match.group(1)
+            descriptions[name] = match.group(2)
+        elif name != None and line.strip() != '':#A description that runs over several lines.
+            descriptions[name] += ' '+line.strip()
+        else:
+            name = None
+    if len(descriptions) == 0:
+        return(None)
+    parameters = dict()
+    for name,description in descriptions.items():
+        values = re.findall(r'<([^<>]*\|[^<>]*)>',description)
+        parameters[name] = [i.strip() for i in values[-1].split('|')] if len(values) > 0 else None
+    return(parameters)
+
+
+def check_recipe_options(recipe):
+    """This checks the options of a recipe in the format of SCIENCE_RECIPE (e.g. those given with
+    --quicklook_options) against the parameters that esorex lists for it (see recipe_parameters), so
+    that a misspelled parameter or value stops the script before anything is run, rather than making
+    every exposure fail. Returns the list of problems that were found, or None if esorex could not
+    list the parameters of the recipe."""
+    parameters = recipe_parameters(recipe['recipe'])
+    if parameters == None:
+        return(None)
+    problems = []
+    for option in recipe['options']:
+        name,equals,value = option.lstrip('-').partition('=')
+        if name not in parameters:
+            problems.append(f"{recipe['recipe']} has no parameter --{name}.")
+        elif parameters[name] != None and value not in parameters[name]:
+            problems.append(f"--{name} of {recipe['recipe']} should be one of {', '.join(parameters[name])}, not {value}.")
+    return(problems)
+
+
+def write_profile_report(outpath,run):
+    """This adds the esorex runs of this session (labelled with run, e.g. the start time) to the
+    profiling report in outpath, which is kept both as json (profile_report.json) and as csv
+    (profile_report.csv), so that runs of different pipeline versions can be compared. It then prints
+    a summary of where the time went in this session, per recipe."""
+    import csv
+    import json
     import os
-    print('==========>>>>> CREATE WAVE THAR_FP<<<<<==========')
-    check_files_exist(outpath/'WAVE_TH_FP.txt')
-    os.system("esorex espdr_wave_THAR "+str(outpath/"WAVE_TH_FP.txt"))
-    move_to('ESPRESSO_AIR_DLL_MATRIX_A.fits',outpath)
-    move_to('ESPRESSO_AIR_WAVE_MATRIX_A.fits',outpath)
-    move_to('ESPRESSO_DLL_MATRIX_A.fits',outpath)
-    move_to('ESPRESSO_FP_FITTED_LINE_TABLE_A.fits',outpath)
-    move_to('ESPRESSO_LINE_TABLE_RAW_A.fits',outpath)
-    move_to('ESPRESSO_S2D_BLAZE_THAR_FP_A.fits',outpath)
-    move_to('ESPRESSO_S2D_BLAZE_THAR_FP_B.fits',outpath)
-    move_to('ESPRESSO_S2D_THAR_FP_A.fits',outpath)
-    move_to('ESPRESSO_S2D_THAR_FP_B.fits',outpath)
-    move_to('ESPRESSO_WAVE_MATRIX_A.fits',outpath)
-    move_to('ESPRESSO_WAVE_TABLE_A.fits',outpath)
-    move_to('ESPRESSO_THAR_LINE_TABLE_A.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_wave_fp_thar.log')
-    clean_trash()
-
-def contamination(outpath):
-    """This is a wrapper for the contam recipe."""
+
+    with PROFILE_LOCK:
+        records = [dict(r,run=run) for r in PROFILE_RECORDS]
+    report = {'runs':{},'records':[]}
+    if os.path.isfile(outpath/'profile_report.json'):
+        with open(outpath/'profile_report.json','r') as f:
+            report = json.load(f)
+    report['runs'][run] = {'esorex_version':esorex_version()}
+    report['records'] += records
+    with open(outpath/'profile_report.json.tmp','w') as f:
+        json.dump(report,f,indent=1)
+    os.replace(outpath/'profile_report.json.tmp',outpath/'profile_report.json')
+    with open(outpath/'profile_report.csv','w',newline='') as f:
+        writer = csv.DictWriter(f,fieldnames=PROFILE_COLUMNS,extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(report['records'])
+
+    if len(records) == 0:
+        return
+    print('==========>>>>> RESOURCE USAGE PER RECIPE <<<<<==========')
+    print(f'{"recipe":<18}{"runs":>5}{"wall [s]":>11}{"user [s]":>11}{"sys [s]":>10}{"peak RSS [GB]":>15}{"read [GB]":>11}{"written [GB]":>14}')
+    for recipe in sorted(set([r['recipe'] for r in records])):
+        subset = [r for r in records if r['recipe'] == recipe]
+        total = lambda key: sum([r[key] for r in subset if r[key] != None])
+        print(f'{recipe:<18}{len(subset):>5}{total("wall"):>11.1f}{total("user"):>11.1f}{total("system"):>10.1f}'
+            f'{max([r["max_rss"] or 0 for r in subset])/1024**3:>15.2f}{total("read_bytes")/1024**3:>11.2f}{total("write_bytes")/1024**3:>14.2f}')
+    print(f'Total wall time spent in esorex: {sum([r["wall"] for r in records]):.1f} s (summed over parallel runs).')
+
+
+def science_outputs(outpath,filename,sky=True):
+    """This returns the paths of the products of the exposure called filename (without extension) in
+    the SCIENCE_PRODUCTS folder (see SCIENCE_RECIPE), as pairs of (name written by esorex, renamed path),
+    followed by its log file."""
+    folder = outpath/SCIENCE_RECIPE['folder']
+    suffixes = SCIENCE_RECIPE['outputs']+SCIENCE_RECIPE['sky_outputs'] if sky else SCIENCE_RECIPE['outputs']
+    return([('ESPRESSO_'+i+'.fits',folder/'SCIENCE_PRODUCTS'/(filename+'_'+i+'.fits')) for i in suffixes]+
+        [('esorex.log',folder/('esorex_sci_red_'+filename+'.log'))])
+
+
+async def reduce_exposure(outpath,path,tag,sky=True,background=False):
+    """This reduces a single science exposure (path, with SOF tag tag) with espdr_sci_red.
+    The recipe is run in its own scratch folder (see scratch_dir), with its own
+    copy of SCI_OBJ_combined.txt, so that several exposures can be reduced at the same time without
+    overwriting each other's ESPRESSO_S2D_A.fits and esorex.log. The recipe is run by the executor
+    chosen in EXECUTOR (on this machine by default, see EXECUTORS), after decompressing its inputs if
+    needed (see decompress_inputs). The products are renamed after the
+    exposure and moved to the SCIENCE_PRODUCTS folder, after which the scratch folder is removed
+    and the products are added to the cubes (see append_exposure). If background is True, this is done by background_transfer, whose Future is returned, so that the
+    next exposure can already be started. If anything goes wrong, the scratch folder is left in place
+    for inspection."""
+    import asyncio
     import os
-    print('==========>>>>> CREATE CROSS-FIBER CONTAMINATION FRAMES <<<<<==========')
-    check_files_exist(outpath/'CONTAM.txt')
-    os.system('esorex espdr_cal_contam '+str(outpath/'CONTAM.txt'))
-    move_to('ESPRESSO_CONTAM_FP_B.fits',outpath)
-    move_to('ESPRESSO_CONTAM_S2D_A.fits',outpath)
-    move_to('ESPRESSO_CONTAM_S2D_B.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_cal_contam.log')
-    clean_trash()
-
-def relative_efficiency(outpath):
-    """This is a wrapper for the eff_ab recipe."""
+    import shutil
+
+    filename=frame_name(path)
+    workdir=scratch_dir('sci_red_'+filename)
+    shutil.copy(outpath/'SCI_OBJ_part2.txt',workdir/'SCI_OBJ_combined.txt')
+    with open(workdir/'SCI_OBJ_combined.txt','a') as SOF:
+        SOF.write('\n')
+        SOF.write(path+' '+tag)
+    print('>>>> RUNNING FILE '+path)
+    try:
+        sof_file = await decompress_inputs(workdir/'SCI_OBJ_combined.txt',workdir)
+        await EXECUTORS[EXECUTOR['name']](SCIENCE_RECIPE['recipe'],sof_file,workdir,options=SCIENCE_RECIPE['options'],label=filename)
+    finally:
+        remove_inputs(workdir)
+    def collect():
+        collect_products(workdir,science_outputs(outpath,filename,sky=sky))
+        clean_trash(workdir)
+        append_exposure(outpath,filename)
+    if background:
+        return(background_transfer(collect))
+    await asyncio.to_thread(collect)
+
+
+async def run_exposure(outpath,path,tag,sky=True,resume=False):
+    """This reduces a single science exposure with reduce_exposure and records it in the manifest.
+    If resume is True, exposures that were reduced before with the same calibrations are skipped."""
     import os
-    print('==========>>>>> CREATE RELATIVE FIBER EFFICIENCY FRAMES <<<<<==========')
-    check_files_exist(outpath/"EFF_SKY.txt")
-    os.system('esorex espdr_cal_eff_ab '+str(outpath/"EFF_SKY.txt"))
-    move_to('ESPRESSO_S2D_BLAZE_EFF_A.fits',outpath)
-    move_to('ESPRESSO_S2D_BLAZE_EFF_B.fits',outpath)
-    move_to('ESPRESSO_REL_EFF_B.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_cal_eff_ab.log')
-    clean_trash()
-
-def flux_calibration(outpath):
-    """This is a wrapper for the  recipe."""
+    check_files_exist(outpath/'SCI_OBJ_part2.txt')
+    filename=frame_name(path)
+    key = cache_key(SCIENCE_RECIPE['recipe'],outpath/'SCI_OBJ_part2.txt',options=SCIENCE_RECIPE['options'],extra=[(path,tag)])
+    outputs = [i[1] for i in science_outputs(outpath,filename,sky=sky)]
+    await run_step(outpath,SCIENCE_RECIPE['section'],filename,key,lambda: reduce_exposure(outpath,path,tag,sky=sky,background=True),outputs,resume=resume)
+
+
+def science_jobs(outpath,sky=True,resume=False,after=set(),prefix='',split=None,index_file=None,plan=False,frames=None):
+    """This turns each science exposure listed in SCI_OBJ_part1.txt (or frames, a list of (path,tag))
+    into a job for run_jobs, which waits for the jobs named in after (i.e. the calibration recipes).
+    The job names are the file names of the exposures, preceded by prefix. If split is set (see
+    SPLIT_COLUMNS), the exposures are first divided over a folder per target or programme (see
+    target_folders), and the job names also contain the name of that folder. Exposures that are
+    reduced on other machines (see EXECUTORS) do not count against the memory budget of run_jobs.
+    If plan is True, the jobs are only made for plan_jobs, and no folders or files are written."""
+    import functools
     import os
-    print('==========>>>>> CREATE FLUX CALIBRATION FRAMES <<<<<==========')
-    check_files_exist(outpath/"FLUX_STD.txt")
-    os.system('esorex espdr_cal_flux '+str(outpath/"FLUX_STD.txt"))
-    move_to('ESPRESSO_S2D_STD_A.fits',outpath)
-    move_to('ESPRESSO_S1D_STD_A.fits',outpath)
-    move_to('ESPRESSO_S1D_ENERGY_STD_A.fits',outpath)
-    move_to('ESPRESSO_S2D_BLAZE_STD_A.fits',outpath)
-    move_to('ESPRESSO_AVG_FLUX_STD_A.fits',outpath)
-    move_to('ESPRESSO_ABS_EFF_RAW_A.fits',outpath)
-    move_to('ESPRESSO_ABS_EFF_A.fits',outpath)
-    move_to('esorex.log',outpath,newname='esorex_cal_flux.log')
-    clean_trash()
-
-def reduce_science(outpath):
+
+    if split != None:
+        jobs = dict()
+        for folder,frames in target_folders(outpath,split,index_file=index_file,plan=plan).items():
+            jobs.update(science_jobs(folder,sky=sky,resume=resume,after=after,prefix=prefix+folder.name+'/',plan=plan,frames=frames))
+        if plan:#The sof files of the targets are not written, but they would be copies of this one.
+            for job in jobs.values():
+                job['sof'] = outpath/SCIENCE_RECIPE['sof']
+        return(jobs)
+    if not plan:
+        os.makedirs(outpath/SCIENCE_RECIPE['folder']/'SCIENCE_PRODUCTS',exist_ok=True)
+    if frames == None:
+        frames = read_sof(outpath/'SCI_OBJ_part1.txt')
+    jobs = dict()
+    for path,tag in frames:
+        filename=frame_name(path)
+        jobs[prefix+filename] = {'function':functools.partial(run_exposure,outpath,path,tag,sky,resume),
+            'after':set(after),'recipe':SCIENCE_RECIPE['recipe'],'sof':outpath/SCIENCE_RECIPE['sof'],
+            'extra':[(path,tag)],'products':[p[1] for p in science_outputs(outpath,filename,sky=sky)[:-1]]}
+        if EXECUTOR['name'] != 'local':#Runs on other machines, so it takes no memory here.
+            jobs[prefix+filename]['memory'] = 0
+    return(jobs)
+
+
+#The header index columns by which the science frames can be divided over targets (see target_folders).
+SPLIT_COLUMNS = {'object':'object','programme':'prog_id'}
+
+
+def target_folders(outpath,split,index_file=None,plan=False):
+    """This divides the science frames listed in SCI_OBJ_part1.txt in outpath over one folder per
+    target ('object', by the OBJECT keyword) or per observing programme ('programme', by ESO OBS PROG ID),
+    so that several targets observed on the same night can be reduced against the same calibrations.
+    Each folder (TARGETS/name in outpath) gets its own SCI_OBJ_part1.txt with the frames of that target
+    and a copy of SCI_OBJ_part2.txt, which points at the calibrations in outpath, so that the science
+    products, log files and manifest of each target end up in its own folder. The headers are taken
+    from the header index (index_file, by default header_index.sqlite in outpath). Returns the frames
+    (as (path,tag)) of each folder, by folder. If plan is True, the folders are not made."""
     import os
-    import astropy.io.ascii as ascii
-    import pdb
+    import re
     import shutil
-
-    print('==========>>>>> PRODUCE REDUCED SCIENCE SPECTRA <<<<<==========')
+    if index_file == None:
+        index_file = outpath/'header_index.sqlite'
+    frames = read_sof(outpath/'SCI_OBJ_part1.txt')
+    headers = index_headers([path for path,tag in frames],index_file,prune=False)
+    groups = dict()
+    for path,tag in frames:
+        name = headers[path][SPLIT_COLUMNS[split]]
+        name = re.sub(r'[^A-Za-z0-9_.+-]','_',str(name).strip()) if name != None else 'UNKNOWN'
+        groups.setdefault(name,[]).append((path,tag))
+    folders = dict()
+    for name,group in groups.items():
+        folder = outpath/'TARGETS'/name
+        if not plan:
+            os.makedirs(folder,exist_ok=True)
+            shutil.copy(outpath/SCIENCE_RECIPE['sof'],folder/SCIENCE_RECIPE['sof'])
+            write_sof(folder/'SCI_OBJ_part1.txt',[path+'   '+tag for path,tag in group])
+        print(f'>>>> {name}: {len(group)} exposures, reduced into {folder}')
+        folders[folder] = group
+    return(folders)
+
+
+def reduce_science(outpath,nproc=1,sky=True,resume=False,memory_budget=None,split=None):
+    """This reduces all science exposures listed in SCI_OBJ_part1.txt. Each exposure is an independent
+    call to espdr_sci_red, so up to nproc of them are run at the same time (see reduce_exposure), as
+    far as the memory_budget allows (see run_jobs). If resume is True, exposures that were completed
+    in a previous run are skipped. If split is set, the exposures of each target are reduced into
+    their own folder (see target_folders), all in the same queue."""
+    print(f"==========>>>>> {SCIENCE_RECIPE['title']} <<<<<==========")
 #    check_files_exist(outpath+'SCI_OBJ_part1.txt')
     check_files_exist(outpath/'SCI_OBJ_part2.txt')
+    jobs = science_jobs(outpath,sky=sky,resume=resume,split=split)
+    print(f'>>>> Reducing {len(jobs)} exposures, {nproc} at a time.')
+    run_jobs(jobs,max_workers=nproc,memory_budget=memory_budget)
+
+
+    #==============================================================================================#
+    #What follows are the executors, which run the science exposures on this machine, on other
+    #machines over ssh, or as jobs on a Slurm cluster (see --executor).
+    #==============================================================================================#
+
+
+#How the science exposures are run (see reduce_exposure): the name of the executor in EXECUTORS, the
+#hosts with the number of exposures that each of them may run at the same time (ssh), the folder in
+#which the hosts work (ssh), extra options for srun (slurm), and for each host the number of exposures
+#that are running on it and the calibration files that it has already (see send_files).
+EXECUTOR = {'name':'local','hosts':dict(),'remote_scratch':'/tmp/espresso_pipeline','slurm_options':[],
+    'busy':dict(),'stored':dict()}
+
+
+def parse_hosts(text):
+    """This turns a list of hosts like 'node1:4,node2:4,user@node3' into a dictionary with the number
+    of exposures that may run on each host at the same time (1 if it is not given)."""
+    hosts = dict()
+    for entry in text.split(','):
+        name,separator,slots = entry.strip().partition(':')
+        if len(name) > 0:
+            hosts[name] = int(slots) if len(slots) > 0 else 1
+    return(hosts)
+
+
+def host_command(host,command,tty=False):
+    """This returns the command line that runs the shell command on host, through ssh. Hosts called
+    local (or local-something) are this machine itself, on which the command is run with sh, so that
+    several nodes can be simulated on one machine (e.g. for testing). With tty, ssh asks for a
+    terminal on the host, so that the command is stopped there when ssh is stopped here."""
+    if host == 'local' or host.startswith('local-'):
+        return(['sh','-c',command])
+    return(['ssh','-o','BatchMode=yes']+(['-tt'] if tty else [])+[host,command])
+
+
+def host_folder(host):
+    """This returns the folder on host in which it keeps the calibrations and reduces exposures.
+    Each host gets its own subfolder of EXECUTOR['remote_scratch'], in case that is on a shared disk."""
+    import re
+    return(EXECUTOR['remote_scratch'].rstrip('/')+'/'+re.sub(r'[^A-Za-z0-9_.-]','_',host))
+
+
+async def run_pipeline(commands,output=None):
+    """This runs commands (lists of arguments) connected by pipes, like a | b in a shell, without
+    blocking the event loop. The output of the last command is written to the file output, or printed
+    if that is None. Returns True if all of them succeeded. If this is cancelled, they are stopped."""
+    import asyncio
+    import os
+    import signal
+    import subprocess
+    processes = []
+    for i,command in enumerate(commands):
+        stdin = processes[-1].stdout if i > 0 else subprocess.DEVNULL
+        stdout = subprocess.PIPE if i < len(commands)-1 else output
+        processes.append(subprocess.Popen(command,stdin=stdin,stdout=stdout,start_new_session=True))
+        if i > 0:
+            processes[-2].stdout.close()#So that the previous command notices when this one stops reading.
+    try:
+        for process in processes:
+            status,usage,io = await wait_child(process.pid)
+            process.returncode = os.waitstatus_to_exitcode(status)
+    except asyncio.CancelledError:
+        for process in processes:
+            if process.returncode == None:
+                os.killpg(process.pid,signal.SIGKILL)
+                os.waitpid(process.pid,0)
+                process.returncode = -signal.SIGKILL
+        raise
+    return(all([process.returncode == 0 for process in processes]))
+
+
+async def send_files(host,sof_file,workdir,folder,label):
+    """This sends the files listed in sof_file to folder on host, together with a copy of sof_file
+    that points at where they are on the host. The last file in sof_file (the science frame, see
+    reduce_exposure) is put in folder itself. The others (the calibrations) are put in the calib
+    folder of the host (see host_folder), under a name that is unique to their name, size and
+    modification time (which decompressed files get from the compressed file, see decompress_file),
+    so that each of them is sent to each host only once, and is used by all the
+    exposures (and later runs) that need it. The files are sent in a single tar stream, from
+    symbolic links in workdir/send that tar follows. They are unpacked in folder and only then moved
+    to the calib folder, so that an exposure on the same host never reads a file that is half-sent."""
+    import asyncio
+    import hashlib
+    import os
+    import shlex
+    import tempfile
+
+    root = host_folder(host)
+    if host not in EXECUTOR['stored']:
+        EXECUTOR['stored'][host] = dict()
+        with tempfile.TemporaryFile() as listing:
+            if not await run_pipeline([host_command(host,f'mkdir -p {shlex.quote(root)}/calib && ls {shlex.quote(root)}/calib')],output=listing):
+                raise RuntimeError(f'Could not reach {host} or make {root} there.')
+            listing.seek(0)
+            for name in listing.read().decode(errors='replace').split():
+                EXECUTOR['stored'][host].setdefault(name,'stored')
+    stored = EXECUTOR['stored'][host]#The name of each file, and whether it is on the host or being sent by which job.
+
+    frames = read_sof(sof_file)
+    send = workdir/'send'
+    os.makedirs(send/'calib',exist_ok=True)
+    lines = []
+    sending = []
+    waiting = []
+    for i,(path,tag) in enumerate(frames):
+        if i == len(frames)-1:
+            os.symlink(path,send/os.path.basename(path))
+            lines.append(folder+'/'+os.path.basename(path)+' '+tag)
+            continue
+        stat = os.stat(path)
+        name = hashlib.sha1(f'{os.path.basename(path)} {stat.st_size} {stat.st_mtime_ns}'.encode()).hexdigest()[:16]+'_'+os.path.basename(path)
+        lines.append(root+'/calib/'+name+' '+tag)
+        if stored.get(name) == None:
+            stored[name] = label
+            sending.append(name)
+            os.symlink(path,send/'calib'/name)
+        elif stored[name] != 'stored':
+            waiting.append(name)
+    write_sof(send/os.path.basename(sof_file),lines)
+
+    unpack = (f'mkdir -p {shlex.quote(folder)} && tar -xf - -C {shlex.quote(folder)} && '
+        f'find {shlex.quote(folder)}/calib -type f -exec mv -f {{}} {shlex.quote(root)}/calib/ \\; && rmdir {shlex.quote(folder)}/calib')
+    sent = False
+    try:
+        sent = await run_pipeline([['tar','-chf','-','-C',str(send),'.'],host_command(host,unpack)])
+    finally:
+        for name in sending:
+            if sent:
+                stored[name] = 'stored'
+            else:
+                del stored[name]
+    if not sent:
+        raise RuntimeError(f'Could not send the files of {label} to {folder} on {host}.')
+    while any([stored.get(name) not in [None,'stored'] for name in waiting]):#Being sent by another exposure.
+        await asyncio.sleep(0.2)
+    if any([stored.get(name) == None for name in waiting]):
+        raise RuntimeError(f'Sending the calibrations of {label} to {host} failed.')
+
+
+async def fetch_products(host,sof_file,workdir,folder):
+    """This fetches the files that esorex made in folder on host into workdir (leaving out the files
+    that were sent, see send_files), and then removes folder."""
+    import os
+    import shlex
+    frames = read_sof(sof_file)
+    sent = ' '.join([shlex.quote(os.path.basename(str(sof_file))),shlex.quote(os.path.basename(frames[-1][0]))])
+    if not await run_pipeline([host_command(host,f'cd {shlex.quote(folder)} && rm -f {sent} && tar -cf - .'),
+            ['tar','-xf','-','-C',str(workdir)]]):
+        raise RuntimeError(f'Could not fetch the products in {folder} from {host}.')
+    await run_pipeline([host_command(host,f'rm -rf {shlex.quote(folder)}')])
+
+
+async def ssh_esorex(recipe,sof_file,workdir,options=[],label=None):
+    """This is run_esorex for a recipe that is run on one of the hosts in EXECUTOR['hosts'], over
+    ssh. It waits until one of the hosts runs fewer exposures than it may (taking the least busy
+    one), sends it the files in sof_file (see send_files), runs esorex there in a folder of its own,
+    and fetches the products back into workdir (see fetch_products), so that they can be collected
+    as if esorex had run here. If esorex fails, its folder is left on the host for inspection."""
+    import asyncio
+    import os
+    import shlex
+    if label == None:
+        label = os.path.basename(sof_file)
+    while True:
+        free = [host for host,slots in EXECUTOR['hosts'].items() if EXECUTOR['busy'].get(host,0) < slots]
+        if len(free) > 0:
+            break
+        await asyncio.sleep(0.2)
+    host = min(free,key=lambda host: EXECUTOR['busy'].get(host,0)/EXECUTOR['hosts'][host])
+    EXECUTOR['busy'][host] = EXECUTOR['busy'].get(host,0)+1
+    folder = host_folder(host)+'/'+workdir.name
+    try:
+        print(f'---Reducing {label} on {host}.')
+        await send_files(host,sof_file,workdir,folder,label)
+        arguments = ' '.join([shlex.quote(i) for i in esorex_arguments(recipe,os.path.basename(sof_file),'.',options)])
+        command = host_command(host,f'cd {shlex.quote(folder)} && exec {arguments}',tty=True)
+        try:
+            await run_esorex(recipe,sof_file,workdir,options=options,label=label,command=command,host=host)
+        except RuntimeError:
+            print(f'---The files of {label} are left in {folder} on {host}.')
+            raise
+        await fetch_products(host,sof_file,workdir,folder)
+    finally:
+        EXECUTOR['busy'][host] -= 1
+
+
+async def slurm_esorex(recipe,sof_file,workdir,options=[],label=None):
+    """This is run_esorex for a recipe that is run as a job on a Slurm cluster. The job is started
+    with srun (with the options in EXECUTOR['slurm_options'], e.g. the partition, memory and time
+    limit), which waits for it to finish and passes on its output. Nothing is sent: the input and
+    output folders and the scratch folder (see --scratch) need to be on a disk that the compute nodes
+    share with this machine."""
+    import os
+    if label == None:
+        label = os.path.basename(sof_file)
+    command = ['srun','--job-name='+label,'--ntasks=1','--chdir='+str(workdir)]+EXECUTOR['slurm_options']+esorex_arguments(recipe,sof_file,workdir,options)
+    await run_esorex(recipe,sof_file,workdir,options=options,label=label,command=command,host='slurm')
+
+
+#The executors that can run the science exposures (see reduce_exposure). Each is called like run_esorex,
+#and leaves the products of the recipe in workdir.
+EXECUTORS = {'local':run_esorex,'ssh':ssh_esorex,'slurm':slurm_esorex}
+
+
+    #==============================================================================================#
+    #What follows is the watch mode, which reduces science frames as soon as they arrive in the input
+    #folder (e.g. while they are being downloaded during the night), after the calibrations are done.
+    #==============================================================================================#
+
+
+#inotify event masks (see man inotify): a file was created, finished writing, or moved into the folder.
+IN_CREATE = 0x100
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+
+
+def open_inotify(folder):
+    """This asks the Linux kernel to report files that are created in or moved into folder, via inotify
+    (called through ctypes, so no extra packages are needed). Returns the file descriptor from which
+    the events are read (see read_inotify), or None if inotify is not available (e.g. on macOS, or
+    on network drives that do not support it), in which case the folder should be polled instead."""
+    import ctypes
+    import ctypes.util
+    import os
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK|os.O_CLOEXEC)
+    except (OSError,AttributeError):
+        return(None)
+    if fd < 0:
+        return(None)
+    if libc.inotify_add_watch(fd,os.fsencode(folder),IN_CREATE|IN_CLOSE_WRITE|IN_MOVED_TO) < 0:
+        os.close(fd)
+        return(None)
+    return(fd)
+
+
+async def wait_readable(fd,timeout):
+    """This waits at most timeout seconds until there is something to read from fd, without blocking
+    the event loop."""
+    import asyncio
+    readable = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_reader(fd,readable.set)
+    try:
+        await asyncio.wait_for(readable.wait(),timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(fd)
+
+
+def read_inotify(fd,timeout):
+    """This waits at most timeout seconds for inotify events on fd (see open_inotify) and returns the
+    names of the files that they are about. Each event is a struct inotify_event: the watch descriptor,
+    mask, cookie and length of the name (four 32-bit integers), followed by the name itself."""
+    import os
+    import select
+    import struct
+    names = []
+    if len(select.select([fd],[],[],timeout)[0]) == 0:
+        return(names)
+    try:
+        buffer = os.read(fd,65536)
+    except BlockingIOError:
+        return(names)
+    i = 0
+    while i+16 <= len(buffer):
+        wd,mask,cookie,length = struct.unpack_from('iIII',buffer,i)
+        names.append(buffer[i+16:i+16+length].rstrip(b'\0').decode(errors='replace'))
+        i += 16+length
+    return(names)
+
+
+def watch_science(inpath,outpath,binning,nproc=1,sky=True,resume=False,memory_budget=None,idle=0,settle=3.0,interval=1.0):
+    """This reduces the science exposures in SCI_OBJ_part1.txt and then keeps watching inpath for new
+    ESPRE*.fits files, which are reduced as soon as they are complete, so that each exposure is ready
+    minutes after it was taken rather than the next morning. A new file is considered complete once
+    its size is a whole number of fits blocks and has not changed for settle seconds. Only science
+    frames (OBJECT,SKY or OBJECT,FP, depending on sky) with the requested binning are reduced. The folder
+    is watched with inotify where possible (see open_inotify), and polled every interval seconds
+    otherwise. Up to nproc exposures are reduced at the same time, fewer if the memory_budget (in bytes)
+    does not allow that many (see expected_memory). Watching stops after idle seconds without new
+    frames (never if idle is 0), or when the user presses Ctrl-C, after which the exposures that are
+    still running are finished (press Ctrl-C twice to stop these as well). The calibrations need to
+    exist already (see run_cascade)."""
+    import asyncio
+    asyncio.run(watch_frames(inpath,outpath,binning,nproc=nproc,sky=sky,resume=resume,memory_budget=memory_budget,
+        idle=idle,settle=settle,interval=interval))
+    finish_transfers()
+
+
+async def watch_frames(inpath,outpath,binning,nproc=1,sky=True,resume=False,memory_budget=None,idle=0,settle=3.0,interval=1.0):
+    """This is the event loop of watch_science. The exposures are reduced in tasks, at most nproc
+    at the same time, while this keeps watching for new files."""
+    import asyncio
+    import fnmatch
+    import os
+    import time
+    from pathlib import Path
+
+    print(f"==========>>>>> {SCIENCE_RECIPE['title']} (WATCHING {inpath}) <<<<<==========")
+    check_files_exist(outpath/'SCI_OBJ_part2.txt')
+    os.makedirs(outpath/SCIENCE_RECIPE['folder']/'SCIENCE_PRODUCTS',exist_ok=True)
+    object_keyword = 'OBJECT,SKY' if sky else 'OBJECT,FP'
+    binx,biny = [int(i) for i in binning.split('x')]
+    if memory_budget != None and EXECUTOR['name'] == 'local':
+        nproc = max(1,min(nproc,memory_budget//max(expected_memory(SCIENCE_RECIPE['recipe']),1)))
+    seen = set(fits_files(inpath,'ESPRE'))
+    candidates = dict()#The new files that may still be growing, with their size and when that was last seen to change.
+    running = dict()
+    slots = asyncio.Semaphore(nproc)
+    fd = open_inotify(inpath)
+    if fd == None:
+        print(f'---inotify is not available for {inpath}, checking for new files every {interval} s instead.')
+
+    async def reduce(path,tag):
+        async with slots:
+            low = low_disk_space()
+            if low != None:
+                print(f'WARNING: Only {low[1]/1024**3:.1f} GB is free on {low[0]}. Waiting for disk space before reducing {path}.')
+            while low != None:
+                await asyncio.sleep(DISK_BUDGET['interval'])
+                low = low_disk_space()
+            await run_exposure(outpath,path,tag,sky,resume)
+
+    def submit(path,tag):
+        print(f'>>>> QUEUEING FILE {path}')
+        running[asyncio.ensure_future(reduce(path,tag))] = path
+
+    def report():
+        for job in [job for job in running if job.done()]:
+            path = running.pop(job)
+            if not job.cancelled() and job.exception() != None:
+                print(f'ERROR: Reducing {path} failed ({job.exception()}). Watching for new files continues.')
+
+    last = time.time()
+    for path,tag in read_sof(outpath/'SCI_OBJ_part1.txt'):
+        submit(path,tag)
+    print(f'>>>> Waiting for new frames in {inpath}, reducing up to {nproc} at a time. Press Ctrl-C to stop.')
+    try:
+        while idle <= 0 or time.time()-last < idle or len(candidates) > 0:
+            if fd != None:
+                await wait_readable(fd,interval)
+                names = [os.path.join(inpath,name) for name in read_inotify(fd,0)]
+            else:
+                await asyncio.sleep(interval)
+                names = fits_files(inpath,'ESPRE')
+            now = time.time()
+            for name in names:
+                if any([fnmatch.fnmatch(os.path.basename(name),'ESPRE*.fits'+suffix) for suffix in ['']+COMPRESSED_SUFFIXES]) and name not in seen and name not in candidates:
+                    candidates[name] = (-1,now)
+            for name,(size,since) in list(candidates.items()):
+                try:
+                    current = os.path.getsize(name)
+                except OSError:#Removed again, e.g. a temporary file of the download.
+                    del candidates[name]
+                    continue
+                if current != size:
+                    candidates[name] = (current,now)
+                    continue
+                if current == 0 or (current%2880 != 0 and name.endswith(('.fits','.fz'))) or now-since < settle:
+                    continue
+                del candidates[name]
+                seen.add(name)
+                last = now
+                try:
+                    header = read_header(name,HEADER_COLUMNS.values())
+                except (ValueError,EOFError,OSError) as error:
+                    print(f'WARNING: Could not read the header of {name} ({error}), so it is ignored.')
+                    continue
+                if header[HEADER_COLUMNS['dpr_type']] != object_keyword:
+                    print(f"---Ignoring {os.path.basename(name)} ({header[HEADER_COLUMNS['dpr_type']]}), which is not a science frame.")
+                elif (header[HEADER_COLUMNS['binx']],header[HEADER_COLUMNS['biny']]) != (binx,biny):
+                    print(f'---Ignoring {os.path.basename(name)}, which was not taken with {binning} binning.')
+                else:
+                    submit(name,FRAME_TAGS[object_keyword])
+            report()
+        print(f'>>>> No new frames for {idle} s. Stopping.')
+    except asyncio.CancelledError:#Ctrl-C.
+        if hasattr(asyncio.current_task(),'uncancel'):
+            asyncio.current_task().uncancel()
+        print('>>>> Stopped watching. Finishing the exposures that are still running (press Ctrl-C again to stop these too).')
+    finally:
+        if fd != None:
+            os.close(fd)
+    if len(running) > 0:
+        await asyncio.wait(running)
+    report()
+
+
+    #==============================================================================================#
+    #What follows is the batch mode, which reduces the data of many nights and instrument modes in
+    #one go, by splitting the frames into datasets that each need a single calibration cascade.
+    #==============================================================================================#
 
-    F=ascii.read(outpath/'SCI_OBJ_part1.txt',names=['paths','tags'])
-    N=len(F['paths'])
-    if not os.path.exists(outpath/'SCIENCE_PRODUCTS'):
-        os.mkdir(outpath/'SCIENCE_PRODUCTS')
 
-    for i in range(N):
-        shutil.copy(outpath/'SCI_OBJ_part2.txt',outpath/'SCI_OBJ_combined.txt')
-        filename=os.path.splitext(os.path.basename(F['paths'][i]))[0]
-        with open(outpath/'SCI_OBJ_combined.txt','a') as SOF:
-            SOF.write('\n')
-            SOF.write(F['paths'][i]+' '+F['tags'][i])
-        #pdb.set_trace()
-        print('>>>> RUNNING FILE '+F['paths'][i])
-        os.system('esorex espdr_sci_red --background_sw=off '+str(outpath/'SCI_OBJ_combined.txt'))
-        move_to('ESPRESSO_CCF_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_CCF_A.fits')
-        move_to('ESPRESSO_CCF_RESIDUALS_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_CCF_RESIDUALS_A.fits')
-        move_to('ESPRESSO_S1D_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S1D_A.fits')
-        move_to('ESPRESSO_S1D_B.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S1D_B.fits')
-        move_to('ESPRESSO_S1D_FLUXCAL_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S1D_FLUXCAL_A.fits')
-        move_to('ESPRESSO_S2D_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S2D_A.fits')
-        move_to('ESPRESSO_S2D_B.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S2D_B.fits')
-        move_to('ESPRESSO_S2D_BLAZE_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S2D_BLAZE_A.fits')
-        move_to('ESPRESSO_S2D_BLAZE_B.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S2D_BLAZE_B.fits')
-        move_to('ESPRESSO_S1D_FINAL_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S1D_FINAL_A.fits')
-        move_to('ESPRESSO_S1D_FINAL_B.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S1D_FINAL_B.fits')
+def night_of(mjd):
+    """This returns the night (as YYYY-MM-DD) during which an exposure started at mjd was taken. As in
+    the ESO archive, nights are labelled by the date on which they start, and the date changes at noon
+    in Chile (taken to be 16:00 UT), so that the calibrations taken in the morning after a night
+    belong to that night."""
+    import datetime
+    import math
+    return((datetime.date(1858,11,17)+datetime.timedelta(days=math.floor(mjd-16/24))).isoformat())
 
-        if sky:#The following files dont exist if spectra were taken with the FP on fiber B:
-            move_to('ESPRESSO_CCF_B.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_CCF_B.fits')
-            move_to('ESPRESSO_CCF_SKYSUB_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_CCF_SKYSUB_A.fits')
-            move_to('ESPRESSO_S2D_SKYSUB_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S2D_SKYSUB_A.fits')
-            move_to('ESPRESSO_S1D_SKYSUB_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S1D_SKYSUB_A.fits')
-            move_to('ESPRESSO_S1D_SKYSUB_FLUXCAL_A.fits',outpath/'SCIENCE_PRODUCTS/',newname=filename+'_S1D_SKYSUB_FLUXCAL_A.fits')
 
+def batch_inputs(inpath):
+    """This lists the raw frames and static calibration files to be reduced in batch mode. inpath is
+    either a root folder, which is searched recursively, or a text file that lists folders (searched
+    recursively) or individual fits files, one per line."""
+    import os
+    from pathlib import Path
+    if os.path.isdir(inpath):
+        sources = [Path(inpath)]
+    else:
+        sources = [Path(l.strip()) for l in open(inpath,'r').read().splitlines() if len(l.strip()) > 0 and not l.strip().startswith('#')]
+    file_list = []
+    static_list = []
+    for source in sources:
+        if os.path.isdir(source):
+            file_list += fits_files(source,'ESPRE',recursive=True)
+            static_list += fits_files(source,'M.ESPRESSO',recursive=True)
+        elif source.name.startswith('M.ESPRESSO'):
+            static_list.append(str(source))
+        else:
+            file_list.append(str(source))
+    return(sorted(set(file_list)),sorted(set(static_list)))
+
+
+def partition_datasets(table):
+    """This splits a header table of raw frames (see header_table) from many nights and instrument
+    modes into datasets that can each be reduced with one calibration cascade: one for each night,
+    binning and fiber B mode of the science frames. Each dataset gets the science frames of its night
+    and mode and, for each type of calibration frame, the frames with the same binning from the same
+    night, or from the nearest night on which that type was taken if there are none. Only one CONTAM
+    frame is used per dataset. Returns a list of dictionaries with the name, binning, fiber B mode (sky)
+    and the paths of the frames (files) of each dataset."""
+    import math
+    import numpy as np
+
+    dated = np.array([mjd != None for mjd in table['mjd_obs']],dtype=bool)
+    for path in table['path'][~dated]:
+        print(f'WARNING: {path} has no MJD-OBS keyword and is ignored.')
+    days = np.array([math.floor(mjd-16/24) if mjd != None else 0 for mjd in table['mjd_obs']])
+    nights = np.array([night_of(mjd) if mjd != None else '' for mjd in table['mjd_obs']])
+    binnings = np.char.add(np.char.add(table['binx'].astype(str),'x'),table['biny'].astype(str))
+    science = dated & np.isin(table['dpr_type'],['OBJECT,SKY','OBJECT,FP'])
+
+    datasets = []
+    for night,binning,dpr_type in sorted(set(zip(nights[science],binnings[science],table['dpr_type'][science]))):
+        selected = science & (nights == night) & (binnings == binning) & (table['dpr_type'] == dpr_type)
+        day = days[selected][0]
+        files = table['path'][selected].tolist()
+        for calib_type in FRAME_TAGS:
+            if calib_type.startswith('OBJECT'):
+                continue
+            calibs = dated & (table['dpr_type'] == calib_type) & (binnings == binning)
+            if not np.any(calibs):
+                continue#create_sof reports which types are missing.
+            distance = np.abs(days[calibs]-day)
+            nearest = table['path'][calibs][distance == distance.min()].tolist()
+            if calib_type == 'CONTAM,OFF,FP':
+                nearest = nearest[0:1]
+            files += nearest
+        mode = 'sky' if dpr_type == 'OBJECT,SKY' else 'FP'
+        datasets.append({'name':f'{night}_{binning}_{mode}','binning':binning,'sky':mode == 'sky','files':files})
+    return(datasets)
+
+
+def run_batch(inpath,outpath,nproc=1,cache=None,resume=False,scired_only=False,memory_budget=None,plan=False,split=None,
+        static_store=None):
+    """This reduces all the data in inpath (see batch_inputs) in one go. The frames are split into
+    datasets by night, binning and fiber B mode (see partition_datasets), each of which is reduced
+    into its own subfolder of outpath. The calibration recipes and science exposures of all datasets
+    are put in a single queue, so that at most nproc of them run at the same time in total, and they
+    share one memory_budget (see run_jobs). Datasets
+    that are missing frames are reported and skipped. If plan is True, the sof files are made but the
+    jobs are only checked and listed (see plan_jobs), and the problems that were found are returned.
+    If split is set, the science frames of each dataset are divided over targets (see target_folders).
+    If a static_store is given, each dataset gets the statics that fit its mode and date from there
+    (see resolve_statics), and otherwise from the statics in inpath, in the same way (see create_sof).
+    All datasets share one header index, which is only pruned here."""
+    import os
+
+    file_list,static_list = batch_inputs(inpath)
+    index_file = outpath/'header_index.sqlite'
+    if static_store != None:
+        store_statics(static_list,static_store)
+        static_list = []
+    headers = index_headers(file_list+static_list,index_file)
+    datasets = partition_datasets(header_table([headers[file] for file in file_list]))
+    print(f'==========>>>>> FOUND {len(datasets)} DATASETS <<<<<==========')
+    jobs = dict()
+    for dataset in datasets:
+        print(f'==========>>>>> PREPARING DATASET {dataset["name"]} <<<<<==========')
+        dataset_path = outpath/dataset['name']
+        os.makedirs(dataset_path,exist_ok=True)
+        if not dataset['binning'] in ['1x1','2x1','4x2']:
+            print(f'WARNING: Binning {dataset["binning"]} is not supported. Skipping dataset {dataset["name"]}.')
+            continue
+        try:
+            create_sof(inpath,dataset_path,dataset['binning'],sky=dataset['sky'],index_file=index_file,
+                file_list=dataset['files'],static_list=static_list,static_store=static_store,prune=False)
+        except SystemExit:#create_sof has already printed what is missing.
+            print(f'WARNING: Skipping dataset {dataset["name"]}.')
+            continue
+        prefix = dataset['name']+'/'
+        calibration = dict()
+        if not scired_only:
+            calibration = cascade_jobs(dataset_path,cache=cache,resume=resume,prefix=prefix)
+        jobs.update(calibration)
+        jobs.update(science_jobs(dataset_path,sky=dataset['sky'],resume=resume,after=set(calibration),prefix=prefix,plan=plan,
+            split=split,index_file=index_file))
+    if plan:
+        return(plan_jobs(jobs,runtimes=load_runtimes(outpath/'profile_report.json')))
+    if cache != None and os.path.isdir(cache['path']):
+        cache_evict(cache['path'],cache['max_size'])
+    print(f'==========>>>>> RUNNING {len(jobs)} JOBS, {nproc} AT A TIME <<<<<==========')
+    run_jobs(jobs,max_workers=nproc,memory_budget=memory_budget)
+
+
+    #==============================================================================================#
+    #What follows combines the science products of all exposures into time-series cubes, which can
+    #be read per exposure or per order without opening hundreds of FITS files (see --cubes).
+    #==============================================================================================#
+
+
+#The header keywords that are kept for each exposure in the index of a cube. The airmass is the mean of
+#the airmass at the start and end of the exposure, of the telescope(s) that were used (see spectrum_metadata).
+CUBE_KEYWORDS = {'date_obs':'DATE-OBS','mjd':'MJD-OBS','bjd':'ESO QC BJD','berv':'ESO QC BERV','exptime':'EXPTIME',
+    'object':'OBJECT'}
+
+#The arrays of a cube, each stored in its own file in the cube folder, with the data type used there.
+CUBE_ARRAYS = {'flux':'<f8','error':'<f8','quality':'<i4','wave':'<f8'}
+
+
+def read_spectrum(filename):
+    """This reads a science product into 2D arrays (order x pixel) of flux, error, quality flags and
+    wavelength (in vacuum and in the barycentric frame, if the file has those), and returns these with
+    the primary header. S2D products are images with one extension per array; S1D products are a table,
+    which is returned as a single order."""
+    import numpy as np
+    try:
+        from astropy.io import fits
+    except ImportError:
+        raise RuntimeError(f'Reading {filename} into a cube needs astropy.')
+    with fits.open(filename) as hdul:
+        header = hdul[0].header
+        names = [hdu.name for hdu in hdul]
+        if 'SCIDATA' in names:
+            wave = [i for i in ['WAVEDATA_VAC_BARY','WAVEDATA_AIR_BARY','WAVEDATA_VAC','WAVEDATA_AIR'] if i in names][0]
+            arrays = {'flux':hdul['SCIDATA'].data,'error':hdul['ERRDATA'].data,'quality':hdul['QUALDATA'].data,
+                'wave':hdul[wave].data}
+        else:
+            table = hdul[1].data
+            arrays = {'flux':table['flux'],'error':table['error'],'quality':table['quality'],'wave':table['wavelength']}
+        arrays = {key:np.atleast_2d(np.asarray(value,dtype=CUBE_ARRAYS[key])) for key,value in arrays.items()}
+    return(arrays,header)
+
+
+def spectrum_metadata(filename,header):
+    """This returns the entry of an exposure in the index of a cube: the name of its product, and the
+    keywords of CUBE_KEYWORDS (None if they are missing)."""
+    import fnmatch
+    import numpy as np
+    from pathlib import Path
+    entry = {'file':Path(filename).name}
+    for key,keyword in CUBE_KEYWORDS.items():
+        entry[key] = header.get(keyword)
+    airmass = [header[i] for i in header.keys() if fnmatch.fnmatch(i,'ESO TEL? AIRM START') or fnmatch.fnmatch(i,'ESO TEL? AIRM END')]
+    entry['airmass'] = float(np.mean(airmass)) if len(airmass) > 0 else None
+    return(entry)
+
+
+#Products are added to the cubes one at a time, by the thread that collects the products of the science
+#exposures as well as by build_cubes.
+CUBE_LOCK = threading.Lock()
+
+#The types of science products (e.g. S2D_BLAZE_A) that are added to the cubes as soon as an exposure is
+#reduced (see --cubes and append_exposure).
+CUBES = {'products':[]}
+
+
+def write_cube_index(folder,index):
+    """This writes the index of a cube (index.json) in one go, so that it never appears half-written."""
+    import json
+    import os
+    with open(folder/'index.json.tmp','w') as f:
+        json.dump(index,f,indent=1)
+    os.replace(folder/'index.json.tmp',folder/'index.json')
+
+
+def load_cube_index(folder,product):
+    """This returns the index of the cube in folder, or that of a new, empty cube if there is none."""
+    import json
+    import os
+    if not os.path.isfile(folder/'index.json'):
+        return({'product':product,'shape':None,'dtypes':CUBE_ARRAYS,'count':0,'exposures':[]})
+    with open(folder/'index.json','r') as f:
+        return(json.load(f))
+
+
+def append_cube(folder,product,filename):
+    """This adds the science product filename to the end of the cube in folder (see build_cube), unless
+    it is in there already. The arrays are written behind the last complete exposure (cutting off
+    anything that an interrupted append left there) and flushed to disk before the index is replaced
+    by one that counts the new exposure. Readers that take the number of exposures from index.json
+    therefore always see complete exposures, also while the cube is growing. Products that can not be
+    read, or of which the orders or pixels do not match those of the cube, are left out.
+    Returns True if the product was added."""
+    import os
+    import numpy as np
+    from pathlib import Path
+    filename = Path(filename)
+    with CUBE_LOCK:
+        os.makedirs(folder,exist_ok=True)
+        index = load_cube_index(folder,product)
+        if filename.name in [entry['file'] for entry in index['exposures']]:
+            return(False)
+        try:
+            arrays,header = read_spectrum(filename)
+        except (OSError,ValueError,KeyError,IndexError) as e:
+            print(f'WARNING: {filename.name} could not be read ({e}). Leaving it out of the cube.')
+            return(False)
+        if index['shape'] == None:
+            index['shape'] = list(arrays['flux'].shape)
+        if [list(array.shape) for array in arrays.values()] != [index['shape']]*len(arrays):
+            print(f'WARNING: {filename.name} has {arrays["flux"].shape} orders x pixels instead of {tuple(index["shape"])}. Leaving it out of the cube.')
+            return(False)
+        for key,array in arrays.items():
+            offset = index['count']*int(np.prod(index['shape']))*np.dtype(index['dtypes'][key]).itemsize
+            with open(folder/(key+'.dat'),'r+b' if os.path.isfile(folder/(key+'.dat')) else 'wb') as f:
+                f.truncate(offset)
+                f.seek(offset)
+                f.write(array.astype(index['dtypes'][key]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        entry = spectrum_metadata(filename,header)
+        entry.update({'size':os.path.getsize(filename),'mtime':os.path.getmtime(filename)})
+        index['exposures'].append(entry)
+        index['count'] += 1
+        write_cube_index(folder,index)
+    return(True)
+
+
+def product_files(products,product):
+    """This returns the science products of one type (e.g. S2D_BLAZE_A) in the products folder, in the
+    order in which the exposures were taken (by MJD-OBS)."""
+    from pathlib import Path
+    files = sorted(Path(products).glob('*_'+product+'.fits'))
+    mjd = dict()
+    for filename in files:
+        try:
+            mjd[filename] = read_header(filename,['MJD-OBS'])['MJD-OBS']
+        except (OSError,ValueError):#Reported by append_cube.
+            mjd[filename] = None
+    return(sorted(files,key=lambda filename:(mjd[filename] == None,mjd[filename] or 0,filename.name)))
+
+
+def build_cube(products,folder,product):
+    """This combines the science products of one type (e.g. S2D_BLAZE_A) that are in the products
+    folder into a cube in folder. Each array of CUBE_ARRAYS is written to its own raw file
+    (e.g. flux.dat), as one block of orders x pixels per exposure, in the order in which the exposures
+    were taken (see append_cube). These can be opened with numpy.memmap, using the data types, shape
+    and number of exposures given in index.json, which also lists the products and their metadata (see
+    spectrum_metadata) in the same order. The cube is made in a new folder, which then replaces the old
+    one."""
+    import os
+    import shutil
+    from pathlib import Path
+    files = product_files(products,product)
+    print(f'>>>> Combining {len(files)} {product} products into {folder}')
+    temp = Path(str(folder)+'.tmp')
+    shutil.rmtree(temp,ignore_errors=True)
+    for filename in files:
+        append_cube(temp,product,filename)
+    with CUBE_LOCK:
+        shutil.rmtree(str(folder)+'.old',ignore_errors=True)#Left behind if an earlier rebuild was interrupted.
+        if os.path.isdir(folder):
+            os.replace(folder,str(folder)+'.old')
+        os.replace(temp,folder)
+        shutil.rmtree(str(folder)+'.old',ignore_errors=True)
+
+
+def update_cube(products,folder,product):
+    """This brings the cube in folder up to date with the science products of one type that are in the
+    products folder. The exposures that are missing from the cube (e.g. because they were reduced in an
+    earlier run) are appended (see append_cube), but if any of the products in the cube were changed
+    (e.g. reduced again) or removed since, the cube is built again from scratch (see build_cube)."""
+    import os
+    files = product_files(products,product)
+    if len(files) == 0:
+        print(f'---No {product} products in {products}, not making a cube.')
+        return
+    index = load_cube_index(folder,product)
+    for entry in index['exposures']:
+        filename = products/entry['file']
+        if not os.path.isfile(filename) or os.path.getsize(filename) != entry['size'] or os.path.getmtime(filename) != entry['mtime']:
+            print(f'---{entry["file"]} has changed since it was added to {folder}.')
+            build_cube(products,folder,product)
+            return
+    added = [filename for filename in files if append_cube(folder,product,filename)]
+    print(f'---{folder} is up to date ({len(index["exposures"])+len(added)} exposures, {len(added)} added).')
+
+
+def build_cubes(outpath,products):
+    """This brings a cube (see build_cube) of each type of science product in products up to date (see
+    update_cube), for every SCIENCE_PRODUCTS folder in outpath (i.e. also those of the targets and
+    datasets of --split_science and --batch). The cubes are put in a CUBES folder next to it, e.g.
+    CUBES/S2D_BLAZE_A."""
+    from pathlib import Path
+    if len(products) == 0:
+        return
+    print('==========>>>>> COMBINING SCIENCE PRODUCTS INTO CUBES <<<<<==========')
+    for folder in sorted(Path(outpath).glob('**/SCIENCE_PRODUCTS')):
+        for product in products:
+            update_cube(folder,folder.parent/'CUBES'/product,product)
+
+
+def append_exposure(outpath,filename):
+    """This adds the products of the exposure called filename (without extension) that are listed in
+    CUBES to the cubes in outpath, as soon as they have been moved to its SCIENCE_PRODUCTS folder (see
+    reduce_exposure). The exposures are added in the order in which they finish, which is not
+    necessarily the order in which they were taken (see the MJD-OBS and BJD in index.json). If the
+    CCF tables are made, these are updated as well (see extract_ccfs)."""
+    import os
+    folder = outpath/SCIENCE_RECIPE['folder']
+    for product in CUBES['products']:
+        path = folder/'SCIENCE_PRODUCTS'/(filename+'_'+product+'.fits')
+        if os.path.isfile(path):
+            append_cube(folder/'CUBES'/product,product,path)
+    if CCF_TABLES['extract']:
+        for product in CCF_TABLES['products']:
+            extract_ccfs(folder/'SCIENCE_PRODUCTS',folder/'CCF',product)
+
+
+#The header keywords of the CCF products that are collected into the CCF tables (see extract_ccfs), with
+#the name of their column. The velocities and widths are in km/s.
+CCF_KEYWORDS = {'mjd':'MJD-OBS','bjd':'ESO QC BJD','berv':'ESO QC BERV','rv':'ESO QC CCF RV','rv_error':'ESO QC CCF RV ERROR',
+    'fwhm':'ESO QC CCF FWHM','fwhm_error':'ESO QC CCF FWHM ERROR','contrast':'ESO QC CCF CONTRAST',
+    'contrast_error':'ESO QC CCF CONTRAST ERROR','bis_span':'ESO QC CCF BIS SPAN','rv_start':'ESO RV START',
+    'rv_step':'ESO RV STEP'}
+
+#The CCF products that are collected into tables, and whether that is done (see --ccf and append_exposure).
+CCF_TABLES = {'products':['CCF_A','CCF_SKYSUB_A'],'extract':False}
+
+
+def read_ccf(filename):
+    """This reads the keywords of CCF_KEYWORDS from the header of a CCF product (see read_header), and its
+    CCF summed over all orders (the last row of the SCIDATA extension) with its error, as a row of the
+    CCF table and a dictionary of arrays. The velocities of the CCF (rv_grid) follow from its start and
+    step."""
+    import os
+    import numpy as np
+    try:
+        from astropy.io import fits
+    except ImportError:
+        raise RuntimeError(f'Reading {filename} into a CCF table needs astropy.')
+    values = read_header(filename,CCF_KEYWORDS.values())
+    row = {'file':filename.name,'size':os.path.getsize(filename),'mtime':os.path.getmtime(filename)}
+    row.update({key:values[keyword] for key,keyword in CCF_KEYWORDS.items()})
+    with fits.open(filename,memmap=True) as hdul:
+        arrays = {'ccf':np.array(hdul['SCIDATA'].data[-1],dtype='<f8'),'ccf_error':np.array(hdul['ERRDATA'].data[-1],dtype='<f8')}
+    arrays['rv_grid'] = np.full(len(arrays['ccf']),np.nan)
+    if row['rv_start'] != None and row['rv_step'] != None:
+        arrays['rv_grid'] = row['rv_start']+row['rv_step']*np.arange(len(arrays['ccf']))
+    return(row,arrays)
+
+
+def load_ccfs(folder,product):
+    """This returns the rows and arrays of the CCF table of product in folder that was written before
+    (see extract_ccfs), keyed by file name in the order of the table, or an empty dictionary if there
+    is none, or if it is incomplete (e.g. because it was being written when the script was stopped),
+    in which case it is made again."""
+    import csv
+    import os
+    import numpy as np
+    if not os.path.isfile(folder/(product+'.csv')) or not os.path.isfile(folder/(product+'_arrays.npz')):
+        return(dict())
+    try:
+        with open(folder/(product+'.csv'),'r',newline='') as f:
+            rows = list(csv.DictReader(f))
+        with np.load(folder/(product+'_arrays.npz')) as data:
+            arrays = {key:data[key] for key in data.files}
+        if any([len(array) != len(rows) for array in arrays.values()]):
+            return(dict())
+        ccfs = dict()
+        for i,row in enumerate(rows):
+            for key in ['mtime']+list(CCF_KEYWORDS):
+                row[key] = None if row[key] == '' else float(row[key])
+            row['size'] = int(row['size'])
+            ccfs[row['file']] = (row,{key:array[i] for key,array in arrays.items()})
+    except (OSError,ValueError,KeyError,TypeError):
+        return(dict())
+    return(ccfs)
+
+
+def ccf_order(row):
+    """This is the sort key of the rows of a CCF table: the order in which the exposures were taken."""
+    return((row['mjd'] == None,row['mjd'] or 0,row['file']))
+
+
+def extract_ccfs(products,folder,product):
+    """This collects the CCF products of one type (e.g. CCF_A) in the products folder into a table in
+    folder, with one row per exposure in the order in which they were taken: product.csv has the
+    keywords of CCF_KEYWORDS, and product_arrays.npz has the CCFs, their errors and their velocities
+    as arrays of exposures x velocities, in the same order. If pyarrow is installed, the same table
+    (including the arrays) is also written as product.parquet. Only the products that are new or that
+    have changed since the table was last written are read, in parallel, so this can be run after
+    every exposure. New exposures that were taken after those in the table are appended to product.csv;
+    otherwise the table is written again, in order, from what is in it already. Products of which the CCF
+    has a different length than the first one are left out."""
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from pathlib import Path
+    files = sorted(Path(products).glob('*_'+product+'.fits'))
+    if len(files) == 0:
+        return
+    os.makedirs(folder,exist_ok=True)
+    ccfs = load_ccfs(folder,product)
+    stats = {filename.name:os.stat(filename) for filename in files}
+    stale = [filename for filename in files if not filename.name in ccfs or ccfs[filename.name][0]['size'] != stats[filename.name].st_size
+        or ccfs[filename.name][0]['mtime'] != stats[filename.name].st_mtime]
+    gone = [name for name in ccfs if name not in stats]
+    if len(stale) == 0 and len(gone) == 0:
+        return
+    def read(filename):
+        try:
+            return(read_ccf(filename))
+        except (OSError,ValueError,KeyError,IndexError,TypeError) as e:
+            print(f'WARNING: {filename.name} could not be read ({e}). Leaving it out of the CCF table.')
+            return(None)
+    with ThreadPoolExecutor() as pool:
+        new = [ccf for ccf in pool.map(read,stale) if ccf != None]
+    names = set([filename.name for filename in stale]+gone)
+    old = [ccfs[name] for name in ccfs if name not in names]
+    new = sorted(new,key=lambda ccf: ccf_order(ccf[0]))
+    if len(gone) == 0 and len(old) == len(ccfs) and (len(old) == 0 or len(new) == 0 or ccf_order(new[0][0]) > ccf_order(old[-1][0])):
+        write_ccf_table(folder,product,old,new)
+    else:#Changed, removed or earlier exposures.
+        write_ccf_table(folder,product,[],sorted(old+new,key=lambda ccf: ccf_order(ccf[0])))
+
+
+def write_ccf_table(folder,product,old,new):
+    """This writes the CCF table of product in folder (see extract_ccfs), where old are the (row,arrays)
+    of the exposures that are in product.csv already, and new those that are added to it. The arrays are
+    small, so product_arrays.npz is written again as a whole, after the new rows were appended to
+    product.csv (see load_ccfs)."""
+    import csv
+    import os
+    import numpy as np
+    rows,arrays = [],{'ccf':[],'ccf_error':[],'rv_grid':[]}
+    length = len(old[0][1]['ccf']) if len(old) > 0 else None
+    for row,ccf in old+new:
+        if length != None and len(ccf['ccf']) != length:
+            print(f'WARNING: The CCF of {row["file"]} has {len(ccf["ccf"])} velocities instead of {length}. Leaving it out of the CCF table.')
+            continue
+        length = len(ccf['ccf'])
+        rows.append(row)
+        for key in arrays:
+            arrays[key].append(ccf[key])
+    if len(rows) == 0:
+        return
+    fieldnames = ['file','size','mtime']+list(CCF_KEYWORDS)
+    if len(old) > 0:
+        with open(folder/(product+'.csv'),'a',newline='') as f:
+            csv.DictWriter(f,fieldnames=fieldnames).writerows(rows[len(old):])
+            f.flush()
+            os.fsync(f.fileno())
+    else:
+        with open(folder/(product+'.csv.tmp'),'w',newline='') as f:
+            writer = csv.DictWriter(f,fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(folder/(product+'.csv.tmp'),folder/(product+'.csv'))
+    with open(folder/(product+'_arrays.npz.tmp'),'wb') as f:
+        np.savez(f,**{key:np.array(value) for key,value in arrays.items()})
+    os.replace(folder/(product+'_arrays.npz.tmp'),folder/(product+'_arrays.npz'))
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return
+    columns = {key:[row[key] for row in rows] for key in rows[0]}
+    columns.update({key:[list(i) for i in value] for key,value in arrays.items()})
+    pyarrow.parquet.write_table(pyarrow.table(columns),folder/(product+'.parquet.tmp'))
+    os.replace(folder/(product+'.parquet.tmp'),folder/(product+'.parquet'))
+
+
+def extract_ccf_tables(outpath):
+    """This brings the CCF tables (see extract_ccfs) of every SCIENCE_PRODUCTS folder in outpath up to
+    date. The tables are put in a CCF folder next to it."""
+    from pathlib import Path
+    if not CCF_TABLES['extract']:
+        return
+    print('==========>>>>> COLLECTING CCFS INTO TABLES <<<<<==========')
+    for folder in sorted(Path(outpath).glob('**/SCIENCE_PRODUCTS')):
+        for product in CCF_TABLES['products']:
+            extract_ccfs(folder,folder.parent/'CCF',product)
+            if (folder.parent/'CCF'/(product+'.csv')).exists():
+                print(f'---Wrote {folder.parent/"CCF"/(product+".csv")}')
 
 
 
@@ -1010,16 +3122,49 @@ parser.add_argument('outpath',metavar='path',type=str,help='The output folder')
 parser.add_argument('binning',metavar='binning',type=str,help='The detector binning mode',default = '2x1',nargs='?')
 parser.add_argument('FP',metavar='FP',type=str,help='Fiber b on sky?',default = '', nargs='?')
 parser.add_argument('scired_only',metavar='scired_only',type=str,help='Only run SCIRED?',default = '0', nargs='?')
+parser.add_argument('--batch',action='store_true',help='Reduce all nights and instrument modes found in inpath (a root folder or a text file listing folders) in one go, each into its own subfolder of outpath. The binning and FP arguments are then ignored.')
+parser.add_argument('--nproc',type=int,default=1,help='Number of science exposures to reduce in parallel. Set to 0 to choose automatically from the number of cores and --ram_per_job.')
+parser.add_argument('--ncal',type=int,default=1,help='Maximum number of calibration recipes to run at the same time. Recipes are only started once the products they need exist.')
+parser.add_argument('--resume',action='store_true',help='Skip the recipes and science exposures that were completed in a previous run into the same output folder (as recorded in its manifest.json).')
+parser.add_argument('--cache_dir',type=str,default=None,help='Folder in which calibration products are cached, so that identical recipe calls are not repeated. Can be shared between output folders. Caching is off if not set.')
+parser.add_argument('--cache_size',type=float,default=100.0,help='Maximum size of the calibration cache in GB. The least recently used products are removed first.')
+parser.add_argument('--cache_checksum',action='store_true',help='Identify cached recipe calls by the contents of the input files rather than their sizes and modification times.')
+parser.add_argument('--mem_budget',type=float,default=0.0,help='Memory (in GB) that recipes running in parallel may use together. Jobs are only started if their expected peak memory fits. Set to 0 to use the memory that is available when the script starts.')
+parser.add_argument('--memory_profile',type=str,default=None,help='File in which the measured peak memory use of each recipe is kept, to refine the expected memory use of later runs. Defaults to memory_profile.json in outpath.')
+parser.add_argument('--scratch',type=str,default=None,help='Folder in which each recipe gets its own temporary working folder. Defaults to the current working directory.')
+parser.add_argument('--watch',action='store_true',help='After the calibrations, keep watching inpath for new science frames and reduce each of them as soon as it has been completely written. Stop with Ctrl-C.')
+parser.add_argument('--watch_idle',type=float,default=0.0,help='In watch mode, stop after this many minutes without new frames. Set to 0 to keep watching until Ctrl-C is pressed.')
+parser.add_argument('--split_science',type=str,default=None,choices=['object','programme'],help='Reduce the science frames of each target (by the OBJECT keyword) or each observing programme into its own folder (outpath/TARGETS/name), all against the same calibrations and in one queue.')
+parser.add_argument('--plan','--dry-run',dest='plan',action='store_true',help='Only make the sof files, check that every file in them exists or is made by an earlier recipe, and print the order in which the recipes would be run, with their expected run times. No recipes are run.')
+parser.add_argument('--timeout',type=float,default=0.0,help='Stop an esorex call that has been running for more than this many minutes, and count it as failed. Set to 0 for no limit.')
+parser.add_argument('--retries',type=int,default=0,help='Number of times a failed esorex call is repeated before the recipe is given up.')
+parser.add_argument('--quiet',action='store_true',help='Do not print the output of esorex while it runs. It is still written to the esorex.log files, and shown if a recipe fails.')
+parser.add_argument('--executor',type=str,default='local',choices=['local','ssh','slurm'],help='Where the science exposures are reduced: on this machine, on the --hosts over ssh, or as jobs on a Slurm cluster (with srun). The calibrations are always made on this machine.')
+parser.add_argument('--hosts',type=str,default='',help='For --executor ssh, the hosts to use, with the number of exposures that each may reduce at the same time, e.g. node1:4,node2:4,user@node3 (1 if not given).')
+parser.add_argument('--remote_scratch',type=str,default='/tmp/espresso_pipeline',help='For --executor ssh, the folder on the hosts in which the calibrations are kept and the exposures are reduced.')
+parser.add_argument('--slurm_options',type=str,default='',help='For --executor slurm, extra options for srun, e.g. --slurm_options="--partition=short --mem=16G --time=2:00:00" (note the =).')
+parser.add_argument('--static_store',type=str,default=None,help='Folder in which the static calibration files (M.ESPRESSO*.fits) are kept between runs and datasets. The statics in inpath are added to it, and each dataset uses the ones that fit its instrument mode and date, so they only need to be downloaded once.')
+parser.add_argument('--gc',type=str,default='off',choices=['off','delete','compress'],help='Delete or gzip the intermediate products of the calibration cascade (e.g. background maps and raw line tables) as soon as all the recipes that read them have finished. The calibrations that the science recipe needs are always kept.')
+parser.add_argument('--keep',type=str,default='',help='With --gc, comma-separated filename patterns of intermediate products that are kept anyway, e.g. --keep "ESPRESSO_S2D_*,*LINE_TABLE*".')
+parser.add_argument('--min_free',type=float,default=0.0,help='Do not start new recipes or exposures while less than this many GB is free on the output (or scratch) disk. Set to 0 to not check.')
+parser.add_argument('--cubes',type=str,default='',help='Comma-separated types of science products (e.g. S2D_BLAZE_A,S1D_A) to combine into time-series cubes in CUBES/ after the science exposures are reduced, which can be opened with numpy.memmap.')
+parser.add_argument('--ccf',action='store_true',help='Collect the RVs, FWHMs, contrasts and bisector spans of the CCF products and their CCFs into tables (CSV, plus Parquet if pyarrow is installed) in CCF/, which are updated as each exposure is reduced.')
+parser.add_argument('--quicklook',action='store_true',help='Make quick-look reductions of the science frames with the same calibrations, keeping only the S2D_BLAZE_A and CCF_A products. Use --quicklook_options to switch off the expensive steps of espdr_sci_red. They are written to QUICKLOOK/ so that they do not mix with those of the full reduction. Combine with scired_only=1 to reuse the calibrations of an earlier run.')
+parser.add_argument('--quicklook_options',type=str,default=None,help='For --quicklook, the options passed to espdr_sci_red instead of those of the full reduction, e.g. --quicklook_options="--background_sw=off --rv_step=1.0" (note the =; see esorex --params espdr_sci_red for what your version of the DRS accepts). They are checked against esorex --params espdr_sci_red before anything is run.')
+parser.add_argument('--ram_per_job',type=float,default=16.0,help='RAM (in GB) needed by a single espdr_sci_red call, used when --nproc is 0.')
 args = parser.parse_args()
 globals().update(vars(args))
 
 
-inpath = Path(inpath)
-outpath= Path(outpath)
+#Esorex is run from scratch folders, so all paths written in the SOF files need to be absolute.
+inpath = Path(inpath).resolve()
+outpath= Path(outpath).resolve()
 
 
 #Test input:
-if not os.path.isdir(inpath):
+if batch and os.path.isfile(inpath):
+    pass#A list of input folders.
+elif not os.path.isdir(inpath):
     raise FileExistsError(f"Input directory {inpath} does not exist or is not a directory.")
 if str(inpath) == str(outpath):
     raise ValueError("Input and output directories should not be the same.")
@@ -1033,19 +3178,101 @@ if len(FP) == 0 or FP.lower()=='sky':
 else:
     sky = False
 
+if watch and batch:
+    raise ValueError("The watch mode can only be used for a single dataset, not together with --batch.")
+if watch and split_science != None:
+    raise ValueError("The watch mode can not be combined with --split_science.")
+if nproc < 0:
+    raise ValueError(f"nproc should be 0 (automatic) or a positive number of workers ({nproc}).")
+if ncal < 1:
+    raise ValueError(f"ncal should be a positive number of recipes ({ncal}).")
+if nproc == 0:
+    nproc = auto_nproc(ram_per_job)
+
+import shlex
+EXECUTOR.update({'name':executor,'hosts':parse_hosts(hosts),'remote_scratch':remote_scratch,'slurm_options':shlex.split(slurm_options)})
+if executor == 'ssh':
+    if len(EXECUTOR['hosts']) == 0:
+        raise ValueError("The ssh executor needs a list of --hosts to run on.")
+    nproc = max(nproc,sum(EXECUTOR['hosts'].values()))#Fill all the hosts.
+
+if scratch != None:
+    SCRATCH_ROOT['path'] = Path(scratch).resolve()
+
+if min_free < 0:
+    raise ValueError(f"min_free should be 0 (no check) or a positive number of GB ({min_free}).")
+RETENTION.update({'mode':gc,'keep':[i.strip() for i in keep.split(',') if len(i.strip()) > 0]})
+DISK_BUDGET.update({'min_free':min_free*1024**3 if min_free > 0 else None,'paths':[outpath]+([SCRATCH_ROOT['path']] if scratch != None else [])})
+
+if timeout < 0:
+    raise ValueError(f"timeout should be 0 (no limit) or a positive number of minutes ({timeout}).")
+if retries < 0:
+    raise ValueError(f"retries should be 0 or a positive number ({retries}).")
+ESOREX['timeout'] = timeout*60 if timeout > 0 else None
+ESOREX['retries'] = retries
+ESOREX['stream'] = not quiet
+
+if mem_budget < 0:
+    raise ValueError(f"mem_budget should be 0 (automatic) or a positive number of GB ({mem_budget}).")
+if mem_budget == 0:
+    memory_budget = available_memory()
+else:
+    memory_budget = mem_budget*1024**3
+if memory_profile == None:
+    memory_profile = outpath/'memory_profile.json'
+load_memory_profile(Path(memory_profile).resolve())
+
+if static_store != None:
+    static_store = Path(static_store).resolve()
+
+CUBES['products'] = [i.strip() for i in cubes.split(',') if len(i.strip()) > 0]
+CCF_TABLES['extract'] = ccf
+if quicklook_options != None:
+    QUICKLOOK_RECIPE['options'] = shlex.split(quicklook_options)
+if quicklook:
+    SCIENCE_RECIPE = QUICKLOOK_RECIPE
+    problems = check_recipe_options(SCIENCE_RECIPE)
+    if problems == None:
+        print(f"WARNING: Could not list the parameters of {SCIENCE_RECIPE['recipe']} with esorex --params, so the quick-look options ({' '.join(SCIENCE_RECIPE['options'])}) are not checked.")
+    elif len(problems) > 0:
+        print('ERROR: The quick-look options are not accepted by this version of the DRS. Set them with --quicklook_options (see esorex --params espdr_sci_red):')
+        for problem in problems:
+            print('  '+problem)
+        sys.exit()
+
+if cache_dir == None:
+    cache = None
+else:
+    cache = {'path':Path(cache_dir).resolve(),'max_size':cache_size*1024**3,'checksum':cache_checksum}
+
 scired_only = bool(int(scired_only))
-#Run the whole cascade:
-create_sof(inpath,outpath,binning,sky=sky)
-if not scired_only:
-    master_bias(outpath)
-    master_dark(outpath)
-    bad_pixels(outpath)
-    orderdef(outpath)
-    master_flat(outpath)
-    wave_FP_FP(outpath)
-    wave_FP_TH(outpath)
-    wave_TH_FP(outpath)
-    contamination(outpath)
-    relative_efficiency(outpath)
-    flux_calibration(outpath)
-reduce_science(outpath)
+#Run the whole cascade. The profiling report is written even if a recipe fails.
+import datetime
+run = datetime.datetime.now().isoformat(timespec='seconds')
+if plan:
+    if batch:
+        problems = run_batch(inpath,outpath,scired_only=scired_only,plan=True,split=split_science,static_store=static_store)
+    else:
+        create_sof(inpath,outpath,binning,sky=sky,static_store=static_store)
+        jobs = dict()
+        if not scired_only:
+            jobs = cascade_jobs(outpath)
+        jobs.update(science_jobs(outpath,sky=sky,after=set(jobs),split=split_science,plan=True))
+        problems = plan_jobs(jobs,runtimes=load_runtimes(outpath/'profile_report.json'))
+    sys.exit(1 if len(problems) > 0 else 0)
+try:
+    if batch:
+        run_batch(inpath,outpath,nproc=nproc,cache=cache,resume=resume,scired_only=scired_only,memory_budget=memory_budget,
+            split=split_science,static_store=static_store)
+    else:
+        create_sof(inpath,outpath,binning,sky=sky,require_science=not watch,static_store=static_store)
+        if not scired_only:
+            run_cascade(outpath,max_workers=ncal,cache=cache,resume=resume,memory_budget=memory_budget)
+        if watch:
+            watch_science(inpath,outpath,binning,nproc=nproc,sky=sky,resume=resume,memory_budget=memory_budget,idle=watch_idle*60)
+        else:
+            reduce_science(outpath,nproc=nproc,sky=sky,resume=resume,memory_budget=memory_budget,split=split_science)
+    build_cubes(outpath,CUBES['products'])
+    extract_ccf_tables(outpath)
+finally:
+    write_profile_report(outpath,run)